@@ -0,0 +1,602 @@
+"""Benchmarks of the simulator's hot paths."""
+import asyncio
+import gc
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+from importlib import metadata
+
+import websockets
+from ocpp.messages import MessageType
+from ocpp.v201.enums import ConnectorStatusEnumType, TransactionEventEnumType, TriggerReasonEnumType
+
+from .clock import get_clock
+from .codec import available_codecs, create_codec, get_codec
+from .metering import MeterHandle
+from .metrics import Histogram, get_metrics, reset_metrics
+from .models import Transaction
+from .templates import MeterValuesTemplate, TransactionEventTemplate
+
+TIMESTAMP = "2025-01-01T00:00:00+00:00"
+
+# Cases of the benchmark suite, see run_suite
+SUITE = ("construction", "save_state", "meter_tick", "transaction_event", "inbound_dispatch", "fleet")
+
+# A TxDefaultProfile of the whole station, as the handlers receive it
+SAMPLE_PROFILE = {
+    "id": 1,
+    "stack_level": 0,
+    "charging_profile_purpose": "TxDefaultProfile",
+    "charging_profile_kind": "Relative",
+    "charging_schedule": [
+        {"id": 1, "charging_rate_unit": "W", "charging_schedule_period": [{"start_period": 0, "limit": 11000}]}
+    ],
+}
+
+# CALLs of the CSMS dispatched by the inbound benchmark, as sent on the wire
+INBOUND_CALLS = (
+    ("GetTransactionStatus", {}),
+    ("TriggerMessage", {"requestedMessage": "Heartbeat"}),
+    ("GetVariables", {"getVariableData": [{"component": {"name": "OCPPCommCtrlr"}, "variable": {"name": "HeartbeatInterval"}}]}),
+    (
+        "SetVariables",
+        {"setVariableData": [{"attributeValue": "300", "component": {"name": "OCPPCommCtrlr"}, "variable": {"name": "HeartbeatInterval"}}]},
+    ),
+    ("ChangeAvailability", {"operationalStatus": "Operative"}),
+    (
+        "SetChargingProfile",
+        {
+            "evseId": 0,
+            "chargingProfile": {
+                "id": 1,
+                "stackLevel": 0,
+                "chargingProfilePurpose": "TxDefaultProfile",
+                "chargingProfileKind": "Relative",
+                "chargingSchedule": [
+                    {"id": 1, "chargingRateUnit": "W", "chargingSchedulePeriod": [{"startPeriod": 0, "limit": 11000}]}
+                ],
+            },
+        },
+    ),
+    ("GetCompositeSchedule", {"duration": 3600, "evseId": 1}),
+    ("ClearChargingProfile", {"chargingProfileId": 1}),
+)
+
+
+class LoopbackConnection:
+    """
+    Stands in for the WebSocket of a ChargePoint: every CALL it sends is
+    answered at once with an empty CallResult, encoded by `codec`.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.charge_point = None
+
+    async def send(self, message, text=None):
+        unique_id = self.codec.loads(message)[1]
+        response = self.codec.encode([MessageType.CallResult, unique_id, {}])
+        asyncio.get_running_loop().call_soon(self._deliver, response)
+
+    def _deliver(self, response):
+        asyncio.ensure_future(self.charge_point.route_message(response))
+
+    async def recv(self):
+        await asyncio.Future()
+
+
+def sample_frame(seq_no=1):
+    """Returns a TransactionEvent CALL frame as sent on every meter tick."""
+    meter_values = MeterValuesTemplate(1)
+    transaction_event = TransactionEventTemplate("3f1b8a3e-7c52-4f0e-9a55-2f7f0b6c1d2e", 1)
+    meter_value = meter_values.meter_value(TIMESTAMP, 1234.5 + seq_no)
+    return [
+        MessageType.Call,
+        f"msg-{seq_no}",
+        "TransactionEvent",
+        transaction_event.render(TIMESTAMP, seq_no, meter_value),
+    ]
+
+
+def bench_codec_frames(codec, messages):
+    """Encodes and decodes `messages` frames; returns frames per second."""
+    frames = [sample_frame(seq_no) for seq_no in range(100)]
+    started = time.perf_counter()
+    for index in range(messages):
+        codec.loads(codec.encode(frames[index % 100]))
+    return messages / (time.perf_counter() - started)
+
+
+async def bench_codec_round_trips(codec, messages):
+    """
+    Sends `messages` templated TransactionEvents through a ChargePoint over a
+    loopback connection; returns round trips per second. Outbound validation
+    is off so the codec cost is not hidden behind the schema checks.
+    """
+    from .client import ChargePoint
+
+    connection = LoopbackConnection(codec)
+    charge_point = ChargePoint("BENCH", connection, "Bench", "Bench", persist=False, outbound_validation="off")
+    charge_point.codec = codec
+    connection.charge_point = charge_point
+
+    meter_values = MeterValuesTemplate(1)
+    transaction_event = TransactionEventTemplate("3f1b8a3e-7c52-4f0e-9a55-2f7f0b6c1d2e", 1)
+    started = time.perf_counter()
+    for seq_no in range(messages):
+        meter_value = meter_values.meter_value(TIMESTAMP, seq_no * 2.5)
+        await charge_point.send_templated_transaction_event(transaction_event, TIMESTAMP, seq_no, meter_value)
+    return messages / (time.perf_counter() - started)
+
+
+def run_codec_benchmark(messages=20000, codecs=None):
+    """Benchmarks each installed codec on one core; returns the results per codec."""
+    results = {}
+    for name in codecs or available_codecs():
+        codec = create_codec(name)
+        results[name] = {
+            "frames_per_s": round(bench_codec_frames(codec, messages)),
+            "round_trips_per_s": round(asyncio.run(bench_codec_round_trips(codec, messages))),
+        }
+    return results
+
+
+class SinkConnection:
+    """Stands in for the WebSocket of a ChargePoint, dropping everything it sends."""
+
+    async def send(self, message, text=None):
+        pass
+
+    async def recv(self):
+        await asyncio.Future()
+
+
+def measure_station_memory(stations=1000, connectors=2):
+    """
+    Measures the memory of idle Charge Points and of one transaction on
+    each, with tracemalloc, and the size and cost of their state records.
+    """
+    from .client import ChargePoint
+    from .state import serialize_state
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        charge_points = [
+            ChargePoint(f"BENCH{index}", None, "Bench", "Bench", connectors=connectors, persist=False)
+            for index in range(stations)
+        ]
+        idle = tracemalloc.get_traced_memory()[0]
+        for charge_point in charge_points:
+            charge_point.transactions[1] = Transaction(str(uuid.uuid4()), 1, seq_no=12, energy=1234.5)
+        charging = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    started = time.perf_counter()
+    state_bytes = sum(len(record) for charge_point in charge_points for record in serialize_state(charge_point).values())
+    serialize_time = time.perf_counter() - started
+
+    for charge_point in charge_points:
+        # Drop them from the process-wide transaction index
+        del charge_point.transactions[1]
+    return {
+        "stations": stations,
+        "station_bytes": round((idle - before) / stations),
+        "transaction_bytes": round((charging - idle) / stations),
+        "state_bytes": round(state_bytes / stations),
+        "serialize_us": round(serialize_time / stations * 1e6, 1),
+    }
+
+
+def timing_summary(timings, elapsed=None, unit="ops"):
+    """
+    Summarizes the durations (s) of single operations: their rate over
+    `elapsed` seconds (their sum by default), percentiles and maximum in us.
+    """
+    ordered = sorted(timings)
+    if not ordered:
+        return {"count": 0}
+    elapsed = sum(ordered) if elapsed is None else elapsed
+
+    def percentile(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e6, 1)
+
+    return {
+        "count": len(ordered),
+        f"{unit}_per_s": round(len(ordered) / elapsed) if elapsed else 0,
+        "p50_us": percentile(0.5),
+        "p99_us": percentile(0.99),
+        "max_us": round(ordered[-1] * 1e6, 1),
+    }
+
+
+def rss_bytes():
+    """Returns the resident set size of the process; its peak where /proc is missing, None on Windows."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        try:
+            import resource
+        except ImportError:  # Not available on Windows
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, KiB elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def bench_construction(stations=1000, connectors=2):
+    """
+    Times the construction of Charge Points without saved state, then of
+    the same Charge Points restoring a transaction and a charging profile
+    each from a temporary state store through load_state.
+    """
+    from .client import ChargePoint
+    from .state import close_store, open_store, serialize_state
+
+    gc.collect()
+    fresh = []
+    charge_points = []
+    for index in range(stations):
+        started = time.perf_counter()
+        charge_point = ChargePoint(f"BENCH{index}", None, "Bench", "Bench", connectors=connectors, persist=False)
+        fresh.append(time.perf_counter() - started)
+        charge_points.append(charge_point)
+
+    with tempfile.TemporaryDirectory() as directory:
+        close_store()
+        store = open_store(os.path.join(directory, "bench.db"))
+        try:
+            for charge_point in charge_points:
+                # A transaction on an Available EVSE would be dropped when restored
+                charge_point.evses[1].status = ConnectorStatusEnumType.occupied
+                charge_point.transactions[1] = Transaction(str(uuid.uuid4()), 1, seq_no=12, energy=1234.5, is_charging=True)
+                charge_point.charging_profiles.add(0, SAMPLE_PROFILE)
+                store.save(charge_point.id, serialize_state(charge_point))
+                del charge_point.transactions[1]
+            store.flush()
+            charge_points.clear()
+            gc.collect()
+
+            restored = []
+            for index in range(stations):
+                started = time.perf_counter()
+                charge_point = ChargePoint(f"BENCH{index}", None, "Bench", "Bench", connectors=connectors)
+                restored.append(time.perf_counter() - started)
+                charge_points.append(charge_point)
+            for charge_point in charge_points:
+                # Drop them from the process-wide transaction index
+                del charge_point.transactions[1]
+        finally:
+            close_store()
+    return {
+        "fresh": timing_summary(fresh, unit="stations"),
+        "load_state": timing_summary(restored, unit="stations"),
+    }
+
+
+def bench_save_state(evses=100, profiles=100, queued=1000, rounds=50):
+    """
+    Times save_state on one large Charge Point: `evses` EVSEs charging,
+    `profiles` charging profiles and `queued` offline messages. The first
+    save writes every record; each later round changes one transaction.
+    Durations include the commit on the store thread.
+    """
+    from .client import ChargePoint
+    from .state import close_store, open_store, save_state, serialize_state
+
+    charge_point = ChargePoint("BENCH-LARGE", None, "Bench", "Bench", connectors=evses, persist=False, offline_queue_size=queued)
+    for evse_id in range(1, evses + 1):
+        charge_point.transactions[evse_id] = Transaction(str(uuid.uuid4()), evse_id, seq_no=12, energy=1234.5, is_charging=True)
+    for profile_id in range(1, profiles + 1):
+        charge_point.charging_profiles.add(0, {**SAMPLE_PROFILE, "id": profile_id, "stack_level": profile_id})
+    meter_values = MeterValuesTemplate(1)
+    for seq_no in range(queued):
+        charge_point.offline_queue.append("MeterValues", {"evseId": 1, "meterValue": meter_values.meter_value(TIMESTAMP, seq_no)})
+    records = serialize_state(charge_point)
+    charge_point.persist = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        close_store()
+        store = open_store(os.path.join(directory, "bench.db"))
+        try:
+            started = time.perf_counter()
+            save_state(charge_point)
+            store.flush()
+            full = time.perf_counter() - started
+
+            incremental = []
+            for index in range(rounds):
+                transaction = charge_point.transactions[index % evses + 1]
+                transaction.seq_no += 1
+                transaction.energy += 10
+                started = time.perf_counter()
+                save_state(charge_point)
+                store.flush()
+                incremental.append(time.perf_counter() - started)
+        finally:
+            close_store()
+            for evse_id in range(1, evses + 1):
+                del charge_point.transactions[evse_id]
+    return {
+        "records": len(records),
+        "state_bytes": sum(len(record) for record in records.values()),
+        "full_save_ms": round(full * 1000, 2),
+        "incremental": timing_summary(incremental, unit="saves"),
+    }
+
+
+async def bench_meter_tick(ticks=5000, validation="full"):
+    """
+    Times meter ticks of one charging transaction: the MeterValues and
+    TransactionEvent CALLs, answered at once over a loopback connection.
+    """
+    from .client import ChargePoint
+
+    connection = LoopbackConnection(get_codec())
+    charge_point = ChargePoint("BENCH", connection, "Bench", "Bench", persist=False, outbound_validation=validation)
+    connection.charge_point = charge_point
+    transaction = charge_point.transactions[1] = Transaction(str(uuid.uuid4()), 1)
+    handle = transaction.meter_task = MeterHandle(charge_point, 1, get_clock().time())
+
+    timings = []
+    began = time.perf_counter()
+    for _ in range(ticks):
+        started = time.perf_counter()
+        await charge_point.meter_tick(handle, TIMESTAMP)
+        timings.append(time.perf_counter() - started)
+    elapsed = time.perf_counter() - began
+    del charge_point.transactions[1]
+    result = timing_summary(timings, elapsed, unit="ticks")
+    result["msgs_per_s"] = round(charge_point.messages_sent / elapsed)
+    return result
+
+
+async def bench_transaction_events(messages=2000, validation="full"):
+    """
+    Times send_transaction_event round trips over a real WebSocket, against
+    a local server answering every CALL with an empty CallResult.
+    """
+    from .client import ChargePoint
+    from .replay import send_frame
+
+    codec = get_codec()
+
+    async def echo(ws):
+        async for frame in ws:
+            await send_frame(ws, codec.encode([MessageType.CallResult, codec.loads(frame)[1], {}]))
+
+    async with websockets.serve(echo, "127.0.0.1", 0, subprotocols=["ocpp2.0.1"], compression=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        async with websockets.connect(f"ws://127.0.0.1:{port}/BENCH", subprotocols=["ocpp2.0.1"], ping_interval=None) as ws:
+            charge_point = ChargePoint("BENCH", ws, "Bench", "Bench", persist=False, outbound_validation=validation)
+            receiver = asyncio.create_task(charge_point.start())
+            transaction_id = str(uuid.uuid4())
+            meter_values = MeterValuesTemplate(1)
+            timings = []
+            began = time.perf_counter()
+            try:
+                for seq_no in range(messages):
+                    started = time.perf_counter()
+                    await charge_point.send_transaction_event(
+                        event_type=TransactionEventEnumType.updated,
+                        transaction_id=transaction_id,
+                        trigger_reason=TriggerReasonEnumType.meter_value_periodic,
+                        seq_no=seq_no,
+                        meter_value=meter_values.meter_value(TIMESTAMP, seq_no * 2.5),
+                    )
+                    timings.append(time.perf_counter() - started)
+                elapsed = time.perf_counter() - began
+            finally:
+                receiver.cancel()
+    return timing_summary(timings, elapsed, unit="msgs")
+
+
+async def bench_inbound_dispatch(messages=5000):
+    """
+    Times the dispatch of CSMS CALLs to the CoreHandlers: decoding, schema
+    validation, the handler and the encoded response, per action.
+    """
+    from .client import ChargePoint
+
+    codec = get_codec()
+    charge_point = ChargePoint("BENCH", SinkConnection(), "Bench", "Bench", persist=False)
+    frames = [
+        (action, codec.encode([MessageType.Call, f"in-{index}", action, payload]))
+        for index, (action, payload) in enumerate(INBOUND_CALLS)
+    ]
+    timings = {action: [] for action, _ in INBOUND_CALLS}
+    began = time.perf_counter()
+    for index in range(messages):
+        action, frame = frames[index % len(frames)]
+        started = time.perf_counter()
+        await charge_point.route_message(frame)
+        timings[action].append(time.perf_counter() - started)
+    elapsed = time.perf_counter() - began
+    return {
+        **timing_summary([timing for durations in timings.values() for timing in durations], elapsed, unit="msgs"),
+        "actions": {action: timing_summary(durations, unit="msgs") for action, durations in timings.items()},
+    }
+
+
+def free_port():
+    """Returns a TCP port of the loopback interface that is free right now."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve_mock_csms(port):
+    # Runs in its own process, so the fleet measures the simulator alone
+    from .csms import CsmsBehavior, run_csms
+    from .fleet import raise_fd_limit
+
+    raise_fd_limit()
+    logging.basicConfig(level="ERROR")
+    asyncio.run(run_csms("127.0.0.1", port, CsmsBehavior(validation=False), report_interval=0))
+
+
+def start_mock_csms(timeout=10.0):
+    """Starts the mock CSMS in a child process; returns the process and its URL once it listens."""
+    port = free_port()
+    process = multiprocessing.Process(target=_serve_mock_csms, args=(port,), name="mock-csms", daemon=True)
+    process.start()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, f"ws://127.0.0.1:{port}"
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                process.terminate()
+                raise RuntimeError("The mock CSMS did not start")
+            time.sleep(0.05)
+
+
+async def bench_fleet(ws_url, count, connectors=2, validation="full", timeout=600.0):
+    """
+    Connects and boots a fleet of `count` Charge Points at once, herd-style;
+    measures the time until every one is booted, the connection phase
+    latencies and the resident memory added per Charge Point.
+    """
+    from .fleet import FleetStats, expand_ids, run_fleet
+
+    reset_metrics()
+    gc.collect()
+    rss_before = rss_bytes()
+    stats = FleetStats()
+    began = time.perf_counter()
+    fleet = asyncio.create_task(
+        run_fleet(
+            ws_url,
+            expand_ids("BENCH{00000}", count),
+            "Bench",
+            "Bench",
+            None,
+            connectors=(connectors, connectors),
+            report_interval=0,
+            stats=stats,
+            station_options={"outbound_validation": validation},
+        )
+    )
+    deadline = began + timeout
+    while stats.booted < count and not fleet.done() and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - began
+    rss_after = rss_bytes()
+    snapshot = stats.snapshot()
+    fleet.cancel()
+    await asyncio.gather(fleet, return_exceptions=True)
+
+    phases = snapshot["metrics"].get("histograms", {}).get("phase", {})
+
+    def p99_ms(phase):
+        data = phases.get(phase)
+        return round(Histogram.from_dict(data).quantile(0.99) * 1000, 1) if data else None
+
+    return {
+        "stations": count,
+        "booted": stats.booted,
+        "failed": stats.failed,
+        "seconds": round(elapsed, 2),
+        "boots_per_s": round(stats.booted / elapsed),
+        "msgs_per_s": round((snapshot["messages_sent"] + snapshot["messages_received"]) / elapsed),
+        "connect_p99_ms": p99_ms("connect"),
+        "boot_p99_ms": p99_ms("boot_accepted"),
+        "rss_per_cp_bytes": round((rss_after - rss_before) / count) if rss_before is not None else None,
+    }
+
+
+def run_suite(cases=SUITE, stations=1000, messages=2000, fleet_sizes=(1000, 10000), csms_url=None, validation="full", progress=None):
+    """
+    Runs the benchmark cases of the suite and returns their results, with
+    the environment they ran in, as a JSON-serializable dict. The fleet
+    cases run against `csms_url`, or a mock CSMS started in a child process.
+    `progress(case)` is called before each case.
+    """
+    try:
+        version = metadata.version("client-sim")
+    except metadata.PackageNotFoundError:
+        version = None
+    results = {}
+
+    def run(case, benchmark, *args, **kwargs):
+        if progress is not None:
+            progress(case)
+        result = benchmark(*args, **kwargs)
+        results[case] = asyncio.run(result) if asyncio.iscoroutine(result) else result
+
+    if "construction" in cases:
+        run("construction", bench_construction, stations)
+    if "save_state" in cases:
+        run("save_state", bench_save_state)
+    if "meter_tick" in cases:
+        run("meter_tick", bench_meter_tick, messages, validation)
+    if "transaction_event" in cases:
+        run("transaction_event", bench_transaction_events, messages, validation)
+    if "inbound_dispatch" in cases:
+        run("inbound_dispatch", bench_inbound_dispatch, messages)
+    if "fleet" in cases:
+        process = None
+        if csms_url is None:
+            process, csms_url = start_mock_csms()
+        try:
+            for count in fleet_sizes:
+                run(f"fleet_{count}", bench_fleet, csms_url, count, validation=validation)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.join()
+    return {
+        "version": version,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "codec": get_codec().name,
+        "validation": validation,
+        "results": results,
+    }
+
+
+def _numbers(results, prefix=""):
+    # Flattens nested results into {"case.field": number}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _numbers(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare_results(baseline, current, tolerance=0.1):
+    """
+    Returns the (field, baseline, current, change) of every rate that fell,
+    and every latency, duration or size that grew, by more than `tolerance`
+    (a fraction) between two suite results.
+    """
+    before = dict(_numbers(baseline.get("results", {})))
+    regressions = []
+    for field, value in _numbers(current.get("results", {})):
+        previous = before.get(field)
+        if not previous:
+            continue
+        change = (value - previous) / previous
+        if field.endswith("_per_s"):
+            worse = change < -tolerance
+        elif field.endswith(("_us", "_ms", "_bytes", "seconds")):
+            worse = change > tolerance
+        else:
+            continue
+        if worse:
+            regressions.append((field, previous, value, change))
+    return regressions
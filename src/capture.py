@@ -0,0 +1,132 @@
+"""Binary capture of the OCPP frames every Charge Point sends and receives."""
+import gzip
+import heapq
+import struct
+
+from .clock import get_clock
+
+MAGIC = b"OCPPCAP\x01"
+# Clock time (simulated epoch seconds), direction, Charge Point id length, frame length
+RECORD = struct.Struct("<dBHI")
+
+OUTBOUND = 0
+INBOUND = 1
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _open_zstd(path, mode):
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression is not installed (pip install zstandard)")
+    if mode == "wb":
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+
+
+class CaptureWriter:
+    """
+    Append-only capture file: a magic header, then one record per frame:
+    RECORD, the UTF-8 Charge Point id, and the frame exactly as on the
+    wire. The file is compressed as a whole with gzip or zstd, or not at all.
+    """
+
+    def __init__(self, path, compression="none"):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown capture compression '{compression}'")
+        self.path = path
+        if compression == "zstd":
+            self._file = _open_zstd(path, "wb")
+        elif compression == "gzip":
+            # Level 1: capturing runs on every send and receive
+            self._file = gzip.open(path, "wb", compresslevel=1)
+        else:
+            self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        # Clock times become simulated epoch seconds with one addition per frame
+        clock = get_clock()
+        self._offset = clock.now().timestamp() - clock.time()
+        self.frames = 0
+
+    def write(self, direction, cp_id, frame):
+        if isinstance(frame, str):
+            frame = frame.encode()
+        cp_id = cp_id.encode()
+        self._file.write(RECORD.pack(get_clock().time() + self._offset, direction, len(cp_id), len(frame)) + cp_id + frame)
+        self.frames += 1
+
+    def close(self):
+        self._file.close()
+
+
+def _open_capture(path):
+    with open(path, "rb") as f:
+        head = f.read(len(_ZSTD_MAGIC))
+    if head.startswith(_GZIP_MAGIC):
+        return gzip.open(path, "rb")
+    if head.startswith(_ZSTD_MAGIC):
+        return _open_zstd(path, "rb")
+    return open(path, "rb")
+
+
+def _read(f, size):
+    # Decompressing readers may return short reads before the end
+    data = f.read(size)
+    while len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def read_capture(path):
+    """Yields the (time, direction, cp_id, frame bytes) records of a capture file, in order."""
+    with _open_capture(path) as f:
+        if _read(f, len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an OCPP capture file")
+        while True:
+            header = _read(f, RECORD.size)
+            if len(header) < RECORD.size:
+                # The end, or a record cut short by a crash
+                return
+            moment, direction, id_length, frame_length = RECORD.unpack(header)
+            cp_id = _read(f, id_length)
+            frame = _read(f, frame_length)
+            if len(frame) < frame_length:
+                return
+            yield moment, direction, cp_id.decode(), frame
+
+
+def read_captures(paths):
+    """Merges the records of several capture files (e.g. one per fleet worker) by time."""
+    return heapq.merge(*(read_capture(path) for path in paths), key=lambda record: record[0])
+
+
+_capture = None
+
+
+def configure_capture(path=None, compression="none"):
+    """Starts capturing every frame of the process to `path` (None: no capture)."""
+    global _capture
+    close_capture()
+    if path:
+        _capture = CaptureWriter(path, compression)
+    return _capture
+
+
+def get_capture():
+    """Returns the process-wide capture writer, or None when not capturing."""
+    return _capture
+
+
+def close_capture():
+    """Flushes and closes the capture file, if any."""
+    global _capture
+    if _capture is not None:
+        capture, _capture = _capture, None
+        capture.close()
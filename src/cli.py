@@ -1,9 +1,34 @@
 import asyncio
+import json
 import logging
+import os
+import sys
 
 import click
 
-from .client import start_client
+from .bench import SUITE, compare_results, measure_station_memory, run_codec_benchmark, run_suite
+from .capture import COMPRESSIONS, close_capture, configure_capture
+from .client import OUTBOUND_VALIDATION_MODES, RECONNECT_RAMPS, Backoff, start_client
+from .clock import configure_clock
+from .codec import CODECS, configure_codec
+from .csms import COMMANDS, ERRORS, CsmsBehavior, CsmsStats, format_csms, run_csms
+from .device_model import REPORT_PART_SIZE, load_entries
+from .history import DEFAULT_CAPACITY, close_history, configure_history
+from .metering import METER_INTERVAL, METER_MESSAGES, configure_metering
+from .metrics import get_metrics, summarize
+from .outbound import DEFAULT_DEPTH, METER_VALUES_POLICIES
+from .replay import DEFAULT_ID_TEMPLATE, ReplayStats, format_replay, run_replay
+from .scenario import count_failures, format_results, load_scenario, parse_distribution
+from .state import STATE_DB, close_store, open_store
+from .fleet import (
+    FleetStats,
+    expand_ids,
+    format_stats,
+    parse_connectors,
+    raise_fd_limit,
+    run_fleet,
+    run_sharded_fleet,
+)
 
 
 @click.group()
@@ -11,6 +36,260 @@ def main():
     pass
 
 
+codec_option = click.option(
+    "--codec",
+    default="json",
+    type=click.Choice(list(CODECS)),
+    help="JSON codec for WebSocket frames and state records (orjson/msgspec are optional).",
+)
+
+validation_option = click.option(
+    "--validation",
+    default="full",
+    type=click.Choice(OUTBOUND_VALIDATION_MODES),
+    help="Outbound schema validation: every CALL, the first of each payload shape, or none.",
+)
+
+
+def metrics_options(command):
+    """Adds the metrics endpoint and summary options to a command."""
+    options = [
+        click.option(
+            "--metrics-port",
+            default=None,
+            type=int,
+            help="Serve Prometheus metrics on this port (/metrics, /metrics.json).",
+        ),
+        click.option(
+            "--metrics-host",
+            default="127.0.0.1",
+            help="Address the metrics endpoint listens on.",
+        ),
+        click.option(
+            "--metrics-json",
+            default=None,
+            type=click.Path(dir_okay=False, allow_dash=True),
+            help="Write a JSON summary of the metrics here on exit ('-' for stdout).",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def clock_options(command):
+    """Adds the simulated clock options to a command."""
+    options = [
+        click.option(
+            "--clock-speed",
+            default="1",
+            help="Simulated seconds per real second, or 'max' to skip every idle wait.",
+        ),
+        click.option(
+            "--start-time",
+            default=None,
+            help="Simulated start date, ISO 8601 (default: now).",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def setup_clock(clock_speed, start_time):
+    """Configures the process clock, returning its settings for worker processes."""
+    try:
+        clock = configure_clock(clock_speed, start_time)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--clock-speed/--start-time")
+    # Workers share one simulated start date, so their timestamps line up
+    start = getattr(clock, "start", None)
+    return dict(speed=clock_speed, start=start.isoformat() if start else None)
+
+
+def history_options(command):
+    """Adds the event history options to a command."""
+    options = [
+        click.option(
+            "--history-size",
+            default=DEFAULT_CAPACITY,
+            help="Events kept per Charge Point for the 'logs' command (0: none).",
+        ),
+        click.option(
+            "--history-spill",
+            default=None,
+            type=click.Path(dir_okay=False),
+            help="Append older events, and the rest on exit, to this gzip JSON lines file.",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def setup_history(history_size, history_spill, workers=1):
+    """
+    Configures the event histories, returning their settings for worker
+    processes: with workers, only they spill, each to its own file.
+    """
+    history = dict(capacity=history_size, spill_path=history_spill)
+    try:
+        configure_history(history_size, history_spill if workers == 1 else None)
+    except (ValueError, OSError) as e:
+        raise click.BadParameter(str(e), param_hint="--history-size/--history-spill")
+    return history
+
+
+def capture_options(command):
+    """Adds the wire capture options to a command."""
+    options = [
+        click.option(
+            "--capture",
+            default=None,
+            type=click.Path(dir_okay=False),
+            help="Record every frame sent and received to this capture file, for 'replay'.",
+        ),
+        click.option(
+            "--capture-compression",
+            default="none",
+            type=click.Choice(COMPRESSIONS),
+            help="Compression of the capture file (zstd is optional).",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def setup_capture(capture, capture_compression, workers=1):
+    """
+    Starts the wire capture, returning its settings for worker processes:
+    with workers, only they capture, each to its own file.
+    """
+    settings = dict(path=capture, compression=capture_compression)
+    try:
+        configure_capture(capture if workers == 1 else None, capture_compression)
+    except (ValueError, OSError) as e:
+        raise click.BadParameter(str(e), param_hint="--capture/--capture-compression")
+    return settings
+
+
+def distribution(ctx, param, value):
+    """Click callback parsing a distribution option such as 'exponential:1800'."""
+    try:
+        return parse_distribution(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def device_model_file(ctx, param, value):
+    """Click callback checking a device model definition file."""
+    if value is not None:
+        try:
+            load_entries(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
+def write_metrics_summary(path, snapshot):
+    """Writes the JSON summary of a snapshot to `path`, or to stdout for '-'."""
+    summary = json.dumps(summarize(snapshot), indent=2)
+    if path == "-":
+        print(summary)
+        return
+    with open(path, "w") as f:
+        f.write(summary + "\n")
+
+
+def connection_options(command):
+    """Adds the reconnection, offline queue and outbound queue options to a command."""
+    options = [
+        click.option(
+            "--reconnect-initial",
+            default=1.0,
+            help="Seconds before the first reconnection attempt.",
+        ),
+        click.option(
+            "--reconnect-max",
+            default=60.0,
+            help="Maximum seconds between reconnection attempts.",
+        ),
+        click.option(
+            "--reconnect-jitter",
+            default=0.5,
+            help="Fraction of each reconnection delay that is randomized (0: none).",
+        ),
+        click.option(
+            "--offline-queue-size",
+            default=1000,
+            help="TransactionEvent/MeterValues kept while offline (oldest dropped).",
+        ),
+        click.option(
+            "--offline-drain-rate",
+            default=10.0,
+            help="Queued messages per second sent after reconnecting (0: no limit).",
+        ),
+        click.option(
+            "--outbound-queue-size",
+            default=DEFAULT_DEPTH,
+            help="CALLs waiting for the one in flight per Charge Point; stale MeterValues and Heartbeats are dropped beyond it (0: no limit).",
+        ),
+        click.option(
+            "--meter-values-policy",
+            default="coalesce",
+            type=click.Choice(METER_VALUES_POLICIES),
+            help="A MeterValues finding an older one of its EVSE still waiting: merge the samples, keep only the latest, or queue both.",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def metering_options(command):
+    """Adds the options of the meter scheduler to a command."""
+    options = [
+        click.option(
+            "--meter-interval",
+            default=METER_INTERVAL,
+            type=click.FloatRange(min=0, min_open=True),
+            help="Seconds between the MeterValues of a charging transaction.",
+        ),
+        click.option(
+            "--meter-jitter",
+            default=0.0,
+            help="Random +/- seconds added to each meter interval.",
+        ),
+        click.option(
+            "--meter-phase",
+            default="spread",
+            type=click.Choice(["spread", "aligned"]),
+            help="Spread first ticks over the interval, or align them on the clock (bursty).",
+        ),
+        click.option(
+            "--meter-rate",
+            default=0.0,
+            help="Maximum meter ticks per second for the process (0: unlimited).",
+        ),
+        click.option(
+            "--meter-messages",
+            default="both",
+            type=click.Choice(METER_MESSAGES),
+            help="Send the samples in TransactionEvent(Updated), in MeterValues, or both.",
+        ),
+        click.option(
+            "--meter-batch",
+            default=1,
+            type=click.IntRange(min=1),
+            help="Samples sent together in each message; an unfinished batch is sent with the TransactionEvent stopping the charge.",
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
 @main.command()
 @click.argument("ws_url", type=str)
 @click.option(
@@ -38,13 +317,39 @@ def main():
     default=2,
     help="The number of connectors.",
 )
+@click.option(
+    "--device-model",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    callback=device_model_file,
+    help="JSON device model definition: a list of NotifyReport reportData entries (default: built-in).",
+)
+@click.option(
+    "--report-part-size",
+    default=REPORT_PART_SIZE,
+    type=click.IntRange(min=1),
+    help="reportData entries per NotifyReport sent for GetBaseReport/GetReport.",
+)
+@click.option(
+    "--state-flush-interval",
+    default=1.0,
+    help="Seconds between writes of changed state.",
+)
+@metering_options
+@clock_options
+@history_options
+@capture_options
+@validation_option
+@codec_option
+@connection_options
+@metrics_options
 @click.option(
     "--log-level",
     default="INFO",
     type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
     help="Sets the logging level.",
 )
-def run(ws_url, cp_id, vendor, model, firmware, connectors, log_level):
+def run(ws_url, cp_id, vendor, model, firmware, connectors, device_model, report_part_size, state_flush_interval, meter_interval, meter_jitter, meter_phase, meter_rate, meter_messages, meter_batch, clock_speed, start_time, history_size, history_spill, capture, capture_compression, validation, codec, reconnect_initial, reconnect_max, reconnect_jitter, offline_queue_size, offline_drain_rate, outbound_queue_size, meter_values_policy, metrics_port, metrics_host, metrics_json, log_level):
     """
     Starts the OCPP client simulator.
 
@@ -61,7 +366,646 @@ def run(ws_url, cp_id, vendor, model, firmware, connectors, log_level):
     ocpp_logger.addHandler(file_handler)
     ocpp_logger.propagate = False
 
-    asyncio.run(start_client(ws_url, cp_id, vendor, model, firmware, connectors))
+    configure_metering(interval=meter_interval, jitter=meter_jitter, phase=meter_phase, rate=meter_rate, messages=meter_messages, batch=meter_batch)
+    configure_codec(codec)
+    setup_clock(clock_speed, start_time)
+    setup_history(history_size, history_spill)
+    setup_capture(capture, capture_compression)
+    try:
+        asyncio.run(
+            start_client(
+                ws_url,
+                cp_id,
+                vendor,
+                model,
+                firmware,
+                connectors,
+                flush_interval=state_flush_interval,
+                outbound_validation=validation,
+                backoff=Backoff(initial=reconnect_initial, maximum=reconnect_max, jitter=reconnect_jitter),
+                offline_queue_size=offline_queue_size,
+                offline_drain_rate=offline_drain_rate,
+                outbound_queue_size=outbound_queue_size,
+                meter_values_policy=meter_values_policy,
+                device_model=device_model,
+                report_part_size=report_part_size,
+                metrics_address=(metrics_host, metrics_port) if metrics_port else None,
+            )
+        )
+    finally:
+        close_store()
+        close_history()
+        close_capture()
+    if metrics_json:
+        write_metrics_summary(metrics_json, {"metrics": get_metrics().snapshot()})
+
+
+@main.command()
+@click.argument("ws_url", type=str)
+@click.option(
+    "--count",
+    default=100,
+    help="The number of Charge Points to simulate.",
+)
+@click.option(
+    "--id-template",
+    default="CP{00000}",
+    help="Charge Point ID template; the zeros set the padded index width.",
+)
+@click.option(
+    "--start-index",
+    default=1,
+    help="The index of the first Charge Point.",
+)
+@click.option(
+    "--vendor",
+    default="AcmeCorp",
+    help="The manufacturer's name.",
+)
+@click.option(
+    "--model",
+    default="ModelX",
+    help="The station model.",
+)
+@click.option(
+    "--firmware",
+    default=None,
+    help="The firmware version.",
+)
+@click.option(
+    "--connectors",
+    default="2",
+    help="Connectors per Charge Point: a number (2) or a random range (1-4).",
+)
+@click.option(
+    "--device-model",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    callback=device_model_file,
+    help="JSON device model definition: a list of NotifyReport reportData entries (default: built-in).",
+)
+@click.option(
+    "--report-part-size",
+    default=REPORT_PART_SIZE,
+    type=click.IntRange(min=1),
+    help="reportData entries per NotifyReport sent for GetBaseReport/GetReport.",
+)
+@click.option(
+    "--ramp-up",
+    default=0.0,
+    help="Seconds over which the connections are spread.",
+)
+@click.option(
+    "--reconnect-ramp",
+    default="herd",
+    type=click.Choice(RECONNECT_RAMPS),
+    help="Admission of connection attempts: all at once, evenly paced, or a token bucket.",
+)
+@click.option(
+    "--reconnect-rate",
+    default=0.0,
+    help="Connection attempts admitted per second by the linear and token-bucket ramps.",
+)
+@click.option(
+    "--reconnect-burst",
+    default=1,
+    help="Token-bucket size: attempts admitted at once before pacing.",
+)
+@click.option(
+    "--duration",
+    default=None,
+    type=float,
+    help="Seconds to run before stopping (default: until Ctrl+C).",
+)
+@click.option(
+    "--report-interval",
+    default=10.0,
+    help="Seconds between progress reports (0 disables them).",
+)
+@click.option(
+    "--seed",
+    default=None,
+    type=int,
+    help="Random seed for reproducible fleets.",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="Worker processes sharing the fleet (0: one per CPU core).",
+)
+@click.option(
+    "--session-rate",
+    default=0.0,
+    help="EV sessions arriving per second on free EVSEs, as a Poisson process (0: none).",
+)
+@click.option(
+    "--session-length",
+    default="exponential:1800",
+    callback=distribution,
+    help="Seconds an EV stays plugged in: a number or e.g. 'exponential:1800', 'uniform:600,3600'.",
+)
+@click.option(
+    "--session-energy",
+    default="uniform:5000,40000",
+    callback=distribution,
+    help="Wh an EV charges before it stops drawing power (same syntax).",
+)
+@click.option(
+    "--session-power",
+    default="choice:3700,7400,11000,22000",
+    callback=distribution,
+    help="Maximum W an EV draws (same syntax).",
+)
+@click.option(
+    "--scenario",
+    "scenario_path",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Run this JSON/YAML scenario on every Charge Point, then stop.",
+)
+@click.option(
+    "--state-db",
+    default=None,
+    help=f"Persist each Charge Point's state in this SQLite file (e.g. {STATE_DB}).",
+)
+@click.option(
+    "--state-flush-interval",
+    default=1.0,
+    help="Seconds between writes of changed state.",
+)
+@metering_options
+@clock_options
+@history_options
+@capture_options
+@validation_option
+@codec_option
+@connection_options
+@metrics_options
+@click.option(
+    "--log-level",
+    default="WARNING",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+    help="Sets the logging level.",
+)
+def fleet(ws_url, count, id_template, start_index, vendor, model, firmware, connectors, device_model, report_part_size, ramp_up, reconnect_ramp, reconnect_rate, reconnect_burst, duration, report_interval, seed, workers, session_rate, session_length, session_energy, session_power, scenario_path, state_db, state_flush_interval, meter_interval, meter_jitter, meter_phase, meter_rate, meter_messages, meter_batch, clock_speed, start_time, history_size, history_spill, capture, capture_compression, validation, codec, reconnect_initial, reconnect_max, reconnect_jitter, offline_queue_size, offline_drain_rate, outbound_queue_size, meter_values_policy, metrics_port, metrics_host, metrics_json, log_level):
+    """
+    Runs a fleet of Charge Points on one event loop, without the REPL.
+
+    WS_URL: The WebSocket URL of the CSMS.
+    """
+    log_level = log_level.upper()
+    workers = workers or os.cpu_count()
+    metering = dict(interval=meter_interval, jitter=meter_jitter, phase=meter_phase, rate=meter_rate, messages=meter_messages, batch=meter_batch)
+    station_options = dict(
+        outbound_validation=validation,
+        offline_queue_size=offline_queue_size,
+        offline_drain_rate=offline_drain_rate,
+        outbound_queue_size=outbound_queue_size,
+        meter_values_policy=meter_values_policy,
+        device_model=device_model,
+        report_part_size=report_part_size,
+    )
+    backoff_options = dict(initial=reconnect_initial, maximum=reconnect_max, jitter=reconnect_jitter)
+    if reconnect_ramp != "herd" and reconnect_rate <= 0:
+        raise click.BadParameter(f"the '{reconnect_ramp}' ramp needs a positive rate", param_hint="--reconnect-rate")
+    admission_options = dict(ramp=reconnect_ramp, rate=reconnect_rate, burst=reconnect_burst)
+    metrics_address = (metrics_host, metrics_port) if metrics_port else None
+    load_options = None
+    if session_rate:
+        load_options = dict(rate=session_rate, length=session_length, energy=session_energy, power=session_power)
+    try:
+        scenario = load_scenario(scenario_path) if scenario_path else None
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--scenario")
+    configure_codec(codec)
+    clock = setup_clock(clock_speed, start_time)
+    history = setup_history(history_size, history_spill, workers)
+    capture = setup_capture(capture, capture_compression, workers)
+    cp_ids = expand_ids(id_template, count, start_index)
+    print(f"Starting fleet of {count} Charge Points ({cp_ids[0]}..{cp_ids[-1]})...")
+
+    if workers > 1:
+        print(f"Sharding the fleet across {workers} worker processes...")
+        snapshot = run_sharded_fleet(
+            ws_url,
+            cp_ids,
+            workers,
+            report_interval=report_interval,
+            log_level=log_level,
+            seed=seed,
+            state_db=state_db,
+            metering=metering,
+            codec=codec,
+            clock=clock,
+            history=history,
+            capture=capture,
+            vendor=vendor,
+            model=model,
+            firmware=firmware,
+            connectors=parse_connectors(connectors),
+            ramp_up=ramp_up,
+            duration=duration,
+            flush_interval=state_flush_interval,
+            station_options=station_options,
+            backoff_options=backoff_options,
+            admission_options=admission_options,
+            metrics_address=metrics_address,
+            scenario=scenario,
+            load_options=load_options,
+        )
+        report_fleet(snapshot, scenario, metrics_json)
+        return
+
+    logging.basicConfig(level=log_level)
+    # Per-message logging of the ocpp library dominates CPU at fleet scale
+    logging.getLogger("ocpp").setLevel(max(logging.getLevelName(log_level), logging.WARNING))
+    raise_fd_limit()
+    if state_db:
+        open_store(state_db)
+    configure_metering(seed=seed, **metering)
+
+    stats = FleetStats()
+    try:
+        asyncio.run(
+            run_fleet(
+                ws_url,
+                cp_ids,
+                vendor,
+                model,
+                firmware,
+                connectors=parse_connectors(connectors),
+                ramp_up=ramp_up,
+                duration=duration,
+                report_interval=report_interval,
+                seed=seed,
+                stats=stats,
+                persist=bool(state_db),
+                flush_interval=state_flush_interval,
+                station_options=station_options,
+                backoff_options=backoff_options,
+                admission_options=admission_options,
+                metrics_address=metrics_address,
+                scenario=scenario,
+                load_options=load_options,
+            )
+        )
+    except KeyboardInterrupt:
+        print("Fleet stopped.")
+    finally:
+        close_store()
+        close_history()
+        close_capture()
+    report_fleet(stats.snapshot(), scenario, metrics_json)
+
+
+def report_fleet(snapshot, scenario, metrics_json):
+    """Prints the final fleet report; a scenario with failed steps exits with status 1."""
+    print(format_stats(snapshot))
+    if metrics_json:
+        write_metrics_summary(metrics_json, snapshot)
+    if scenario is None:
+        return
+    print(f"--- Scenario '{scenario.name}' ---")
+    for line in format_results(snapshot):
+        print(line)
+    failures = count_failures(snapshot)
+    if failures:
+        print(f"Scenario failed: {failures} failed steps.")
+        sys.exit(1)
+
+
+def replay_speed(ctx, param, value):
+    """Click callback parsing a replay speed: a positive factor, or 'max' (None)."""
+    if value.lower() == "max":
+        return None
+    try:
+        speed = float(value)
+    except ValueError:
+        speed = 0
+    if speed <= 0:
+        raise click.BadParameter(f"expected a positive number or 'max', got '{value}'")
+    return speed
+
+
+@main.command()
+@click.argument("ws_url", type=str)
+@click.argument("captures", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--speed",
+    default="1",
+    callback=replay_speed,
+    help="Replay pace: 1 as captured, a factor such as 10, or 'max' to send each CALL once the previous is answered.",
+)
+@click.option(
+    "--copies",
+    default=1,
+    help="Times each captured Charge Point is replayed, as distinct stations.",
+)
+@click.option(
+    "--id-template",
+    default=DEFAULT_ID_TEMPLATE,
+    help="Replayed Charge Point ids, from the captured {id} and the {copy} number.",
+)
+@click.option(
+    "--report-interval",
+    default=10.0,
+    help="Seconds between progress reports (0 disables them).",
+)
+@codec_option
+@click.option(
+    "--metrics-json",
+    default=None,
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="Write a JSON summary of the replay here on exit ('-' for stdout).",
+)
+@click.option(
+    "--log-level",
+    default="WARNING",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+    help="Sets the logging level.",
+)
+def replay(ws_url, captures, speed, copies, id_template, report_interval, codec, metrics_json, log_level):
+    """
+    Replays capture files (see --capture) against a CSMS.
+
+    Each captured Charge Point sends its CALLs again under a new id, with
+    fresh transaction ids, and answers the CSMS as it did when captured.
+
+    WS_URL: The WebSocket URL of the CSMS.
+    """
+    logging.basicConfig(level=log_level.upper())
+    configure_codec(codec)
+    raise_fd_limit()
+    stats = ReplayStats()
+    try:
+        asyncio.run(run_replay(ws_url, captures, speed, copies, id_template, stats, report_interval))
+    except KeyboardInterrupt:
+        print("Replay stopped.")
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    snapshot = stats.snapshot()
+    print(format_replay(snapshot))
+    if metrics_json:
+        write_metrics_summary(metrics_json, snapshot)
+
+
+def csms_commands(ctx, param, value):
+    """Click callback parsing the ACTION=RATE commands of the mock CSMS into a dict."""
+    commands = {}
+    for item in value:
+        action, _, rate = item.partition("=")
+        if action not in COMMANDS:
+            raise click.BadParameter(f"'{action}' is not one of {', '.join(COMMANDS)}")
+        try:
+            commands[action] = float(rate)
+        except ValueError:
+            raise click.BadParameter(f"expected ACTION=RATE, got '{item}'")
+    return commands
+
+
+@main.command("mock-csms")
+@click.option(
+    "--host",
+    default="127.0.0.1",
+    help="Address the mock CSMS listens on.",
+)
+@click.option(
+    "--port",
+    default=9000,
+    help="Port the mock CSMS listens on.",
+)
+@click.option(
+    "--heartbeat-interval",
+    default=300,
+    help="Heartbeat interval given to the Charge Points in the BootNotification response.",
+)
+@click.option(
+    "--response-delay",
+    default="0",
+    callback=distribution,
+    help="Seconds before answering each CALL: a number, or a distribution such as 'exponential:0.05'.",
+)
+@click.option(
+    "--error-rate",
+    default=0.0,
+    help="Fraction of the CALLs answered with a CallError instead (0-1).",
+)
+@click.option(
+    "--error-code",
+    default="InternalError",
+    type=click.Choice(list(ERRORS)),
+    help="Error code of the injected CallErrors.",
+)
+@click.option(
+    "--command",
+    "commands",
+    multiple=True,
+    callback=csms_commands,
+    metavar="ACTION=RATE",
+    help=f"Send ACTION to every Charge Point RATE times per second on average (repeatable): {', '.join(COMMANDS)}.",
+)
+@click.option(
+    "--validation/--no-validation",
+    default=True,
+    help="Validate the CALLs and responses against the OCPP schemas.",
+)
+@click.option(
+    "--duration",
+    default=None,
+    type=float,
+    help="Seconds to serve before exiting (default: until interrupted).",
+)
+@click.option(
+    "--report-interval",
+    default=10.0,
+    help="Seconds between progress reports (0 disables them).",
+)
+@click.option(
+    "--seed",
+    default=None,
+    type=int,
+    help="Seed of the response delays, injected errors and commands, for reproducible runs.",
+)
+@metrics_options
+@click.option(
+    "--log-level",
+    default="WARNING",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"], case_sensitive=False),
+    help="Sets the logging level.",
+)
+def mock_csms(host, port, heartbeat_interval, response_delay, error_rate, error_code, commands, validation, duration, report_interval, seed, metrics_port, metrics_host, metrics_json, log_level):
+    """
+    Runs a mock CSMS, to benchmark the simulator on one machine.
+
+    Charge Points connect to ws://HOST:PORT/<cp_id>. Every CALL they send
+    is accepted, after the response delay, unless an error is injected;
+    the --command actions are sent to each of them once it booted.
+    """
+    logging.basicConfig(level=log_level.upper())
+    try:
+        behavior = CsmsBehavior(heartbeat_interval, response_delay, error_rate, error_code, commands, validation, seed)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    raise_fd_limit()
+    stats = CsmsStats()
+    try:
+        asyncio.run(
+            run_csms(
+                host,
+                port,
+                behavior,
+                stats,
+                duration=duration,
+                report_interval=report_interval,
+                metrics_address=(metrics_host, metrics_port) if metrics_port else None,
+            )
+        )
+    except KeyboardInterrupt:
+        print("Mock CSMS stopped.")
+    except OSError as e:
+        raise click.ClickException(f"Cannot listen on {host}:{port}: {e}")
+    snapshot = stats.snapshot()
+    print(format_csms(snapshot))
+    if metrics_json:
+        write_metrics_summary(metrics_json, snapshot)
+
+
+@main.group()
+def bench():
+    """Benchmarks of the simulator's hot paths."""
+
+
+@bench.command("codec")
+@click.option(
+    "--messages",
+    default=20000,
+    help="Messages per codec.",
+)
+@click.option(
+    "--codec",
+    "codecs",
+    multiple=True,
+    type=click.Choice(list(CODECS)),
+    help="Codecs to benchmark (default: every installed one).",
+)
+def bench_codec(messages, codecs):
+    """
+    Measures messages per second on one core with each JSON codec:
+    frame encode+decode, and TransactionEvent round trips through a
+    ChargePoint over a loopback connection.
+    """
+    results = run_codec_benchmark(messages, codecs)
+    for name, result in results.items():
+        print(f"{name:>8}: {result['frames_per_s']:>9} frames/s  {result['round_trips_per_s']:>7} round trips/s")
+    print(json.dumps(results))
+
+
+@bench.command("memory")
+@click.option(
+    "--count",
+    default=1000,
+    help="Charge Points to create.",
+)
+@click.option(
+    "--connectors",
+    default=2,
+    help="EVSEs per Charge Point.",
+)
+def bench_memory(count, connectors):
+    """
+    Measures the memory of an idle Charge Point and of one transaction,
+    and the size and serialization time of a station's state records.
+    """
+    result = measure_station_memory(count, connectors)
+    print(f"Station:      {result['station_bytes']:>7} B")
+    print(f"Transaction:  {result['transaction_bytes']:>7} B")
+    print(f"State:        {result['state_bytes']:>7} B in {result['serialize_us']} us")
+    print(json.dumps(result))
+
+
+@bench.command("suite")
+@click.option(
+    "--output",
+    default="bench-results.json",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="Write the results here as JSON ('-' for stdout).",
+)
+@click.option(
+    "--case",
+    "cases",
+    multiple=True,
+    type=click.Choice(SUITE),
+    help="Cases to run (default: all of them).",
+)
+@click.option(
+    "--stations",
+    default=1000,
+    help="Charge Points constructed and restored by the construction case.",
+)
+@click.option(
+    "--messages",
+    default=2000,
+    help="Meter ticks, TransactionEvents and inbound CALLs of the message cases.",
+)
+@click.option(
+    "--fleet-size",
+    "fleet_sizes",
+    multiple=True,
+    type=int,
+    default=(1000, 10000),
+    show_default=True,
+    help="Fleet sizes of the fleet connect and boot case.",
+)
+@click.option(
+    "--csms",
+    "csms_url",
+    default=None,
+    help="WebSocket URL of the CSMS the fleet case connects to (default: a mock CSMS in a child process).",
+)
+@click.option(
+    "--baseline",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Earlier results to compare with; exits with status 1 on a regression.",
+)
+@click.option(
+    "--tolerance",
+    default=0.1,
+    help="Relative change from the baseline that counts as a regression.",
+)
+@validation_option
+@codec_option
+def bench_suite(output, cases, stations, messages, fleet_sizes, csms_url, baseline, tolerance, validation, codec):
+    """
+    Runs the benchmark suite of the simulator's hot paths and saves the
+    messages per second, latency percentiles and memory per Charge Point
+    as JSON, to track regressions between releases.
+    """
+    configure_codec(codec)
+    raise_fd_limit()
+    results = run_suite(
+        cases or SUITE,
+        stations=stations,
+        messages=messages,
+        fleet_sizes=fleet_sizes,
+        csms_url=csms_url,
+        validation=validation,
+        progress=lambda case: click.echo(f"Running {case}...", err=True),
+    )
+    text = json.dumps(results, indent=2)
+    if output == "-":
+        print(text)
+    else:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+        click.echo(f"Results written to {output}", err=True)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare_results(json.load(f), results, tolerance)
+        for field, before, after, change in regressions:
+            click.echo(f"Regression: {field} {before} -> {after} ({change:+.0%})", err=True)
+        if regressions:
+            sys.exit(1)
 
 
 if __name__ == "__main__":
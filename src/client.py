@@ -1,9 +1,15 @@
 import asyncio
-import collections
+import functools
+import inspect
 import logging
-from datetime import datetime, timezone
+import random
+import time
 
 import websockets
+from ocpp.charge_point import camel_to_snake_case, remove_nones, serialize_as_dict, snake_to_camel_case
+from ocpp.exceptions import OCPPError
+from ocpp.messages import Call, MessageType, validate_payload
+from ocpp.routing import create_route_map
 from ocpp.v201 import ChargePoint as ocpp_ChargePoint
 from ocpp.v201 import call
 from ocpp.v201.enums import (
@@ -14,156 +20,492 @@ from ocpp.v201.enums import (
     TriggerReasonEnumType,
 )
 
+from .capture import INBOUND, OUTBOUND, get_capture
+from .clock import get_clock
+from .codec import decode_message, get_codec
+from .device_model import (
+    ALIGNED_DATA_ENABLED,
+    HEARTBEAT_INTERVAL,
+    REPORT_PART_SIZE,
+    SAMPLED_DATA_ENABLED,
+    TX_UPDATED_INTERVAL,
+    DeviceModel,
+    station_definition,
+)
 from .handlers import CoreHandlers
+from .history import EVENT, RECEIVED, SENT, History
+from .metering import get_meter_scheduler
+from .metrics import get_metrics, serve_metrics
+from .models import Evse, Transaction
+from .offline_queue import QUEUED_ACTIONS, OfflineQueue
+from .outbound import DEFAULT_DEPTH, OutboundQueue
 from .repl.cmd import REPL
 from .senders import ChargePointSenderMixin
-from .state import load_state
+from .smart_charging import ChargingProfiles
+from .state import load_state, mark_dirty, read_state_file, retire_state_file, start_flusher, stop_flusher
+from .templates import MeterValuesTemplate, TransactionEventTemplate
+from .transactions import TransactionRegistry
+
+
+OUTBOUND_VALIDATION_MODES = ("full", "first", "off")
+
+# (action, payload shape) pairs that already passed outbound validation
+_validated_shapes = set()
+
+# Put in the response queue to wake up a CALL whose connection was lost
+CONNECTION_LOST = object()
+
+# Seconds before resending a Pending/Rejected BootNotification whose response has no interval
+BOOT_RETRY_INTERVAL = 30
+
+RECONNECT_RAMPS = ("herd", "linear", "token-bucket")
+
+
+def payload_shape(payload):
+    """
+    Returns a hashable signature of a payload's structure: its keys and
+    value types, without the values themselves.
+    """
+    if isinstance(payload, dict):
+        return tuple((key, payload_shape(value)) for key, value in payload.items())
+    if isinstance(payload, list):
+        return (list, tuple(dict.fromkeys(payload_shape(item) for item in payload)))
+    return type(payload)
+
+
+def instrument_handlers(cls):
+    """
+    Class decorator wrapping every @on handler of `cls` so its run time and
+    outcome are recorded in the "handler" metrics family. Wrapping happens
+    once per class, not per Charge Point.
+    """
+    for name in dir(cls):
+        handler = getattr(cls, name)
+        action = getattr(handler, "_on_action", None)
+        if action is not None and not getattr(handler, "_instrumented", False):
+            setattr(cls, name, _timed_handler(action, handler))
+    return cls
+
+
+def _timed_handler(action, handler):
+    # functools.wraps keeps the route attributes and the signature the ocpp library inspects
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "call_error"
+        try:
+            response = handler(*args, **kwargs)
+            if inspect.isawaitable(response):
+                response = await response
+            outcome = "ok"
+            return response
+        finally:
+            get_metrics().record("handler", action, outcome, time.perf_counter() - started)
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+@functools.cache
+def class_routes(cls):
+    """Returns the route map of a Charge Point class, with its unbound handlers."""
+    return create_route_map(cls)
+
+
+class RouteMap:
+    """
+    Route map of one Charge Point, binding the handlers of its class on
+    lookup: the map the ocpp library builds holds a bound method per action
+    and is a large part of the memory of an idle station.
+    """
 
+    __slots__ = ("charge_point", "_routes")
 
+    def __init__(self, charge_point):
+        self.charge_point = charge_point
+        self._routes = class_routes(type(charge_point))
+
+    def __getitem__(self, action):
+        return {
+            option: value.__get__(self.charge_point) if callable(value) else value
+            for option, value in self._routes[action].items()
+        }
+
+    def __contains__(self, action):
+        return action in self._routes
+
+
+@instrument_handlers
 class ChargePoint(ocpp_ChargePoint, CoreHandlers, ChargePointSenderMixin):
-    def __init__(self, cp_id, connection, vendor, model, firmware_version=None, connectors=2):
+    def __init__(
+        self,
+        cp_id,
+        connection,
+        vendor,
+        model,
+        firmware_version=None,
+        connectors=2,
+        persist=True,
+        outbound_validation="full",
+        offline_queue_size=1000,
+        offline_drain_rate=10.0,
+        outbound_queue_size=DEFAULT_DEPTH,
+        meter_values_policy="coalesce",
+        device_model=None,
+        report_part_size=REPORT_PART_SIZE,
+        legacy_state=False,
+    ):
+        if outbound_validation not in OUTBOUND_VALIDATION_MODES:
+            raise ValueError(f"Unknown outbound validation mode '{outbound_validation}'")
         super().__init__(cp_id, connection)
+        self.route_map = RouteMap(self)
         self.vendor = vendor
         self.model = model
         self.firmware_version = firmware_version
-        self.history = collections.deque(maxlen=50)
-
-        saved_state = load_state()
+        self.history = History(cp_id)
+        # Fleet members run without a state file: they all start fresh
+        self.persist = persist
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.codec = get_codec()
+        # Prebuilt meter tick payloads, per transaction key
+        self._meter_templates = {}
+        # "full" validates every outbound CALL against the OCPP schemas,
+        # "first" only the first one of each action and payload shape,
+        # "off" none. Inbound messages are always validated.
+        self.outbound_validation = outbound_validation
+        # A ChargePoint outlives its connections: see attach() and detach()
+        self.connected = connection is not None
+        self._heartbeat_task = None
+        # NotifyReport and ReportChargingProfiles tasks still sending
+        self._report_tasks = set()
+        # Monotonic times of the last attach() and detach(), for the phase latencies
+        self._connected_at = time.monotonic()
+        self._disconnected_at = None
+        self.boot_retries = 0
+        # Set while the CSMS has accepted the BootNotification of the current connection
+        self.boot_accepted = asyncio.Event()
+        # Last CallResult or CallError received per action, for scenario assertions
+        self.last_responses = {}
+        self.offline_queue = OfflineQueue(offline_queue_size)
+        self.offline_drain_rate = offline_drain_rate
+        # CALLs waiting for the one in flight, by priority
+        self.outbound = OutboundQueue(outbound_queue_size, meter_values_policy)
+
+        saved_state = load_state(cp_id) if persist else None
+        # Only the single station of `run` takes over the legacy state file
+        imported = False
+        if saved_state is None and persist and legacy_state:
+            saved_state = read_state_file()
+            imported = saved_state is not None
         if saved_state:
             raw_evses = saved_state.get("evses", {})
-            self.evses = {int(k): v for k, v in raw_evses.items()}
-            for evse in self.evses.values():
-                if "status" in evse:
-                    evse["status"] = ConnectorStatusEnumType(evse["status"])
-                elif "connectors" in evse:
-                    # Migration from old connector-based structure
-                    first_connector = list(evse["connectors"].values())[0]
-                    evse["status"] = ConnectorStatusEnumType(first_connector["status"])
-                    del evse["connectors"]
+            self.evses = {int(k): Evse.from_record(v) for k, v in raw_evses.items()}
 
             # Load transactions and clean up invalid ones
             raw_transactions = saved_state.get("transactions", {})
-            self.transactions = {}
+            self.transactions = TransactionRegistry()
             for tx_key, tx_data in raw_transactions.items():
-                evse_id = tx_data.get("evse_id")
+                transaction = Transaction.from_record(tx_data)
+                evse_id = transaction.evse_id
                 # Skip transactions on available EVSEs (inconsistent state)
                 if evse_id and evse_id in self.evses:
-                    if self.evses[evse_id]["status"] == ConnectorStatusEnumType.available:
-                        logging.warning(f"Skipping transaction {tx_data.get('transaction_id')} on available EVSE {evse_id}")
+                    if self.evses[evse_id].status == ConnectorStatusEnumType.available:
+                        logging.warning(f"Skipping transaction {transaction.transaction_id} on available EVSE {evse_id}")
                         continue
-                self.transactions[tx_key] = tx_data
+                self.transactions[int(tx_key)] = transaction
         else:
-            self.evses = {
-                i: {"status": ConnectorStatusEnumType.available}
-                for i in range(1, connectors + 1)
-            }
-            self.transactions = {}
+            self.evses = {i: Evse() for i in range(1, connectors + 1)}
+            self.transactions = TransactionRegistry()
         
-        raw_profiles = saved_state.get("charging_profiles", {}) if saved_state else {}
-        self.charging_profiles = {int(k): v for k, v in raw_profiles.items()} if raw_profiles else {}
-
-    def get_power_limit(self, evse_id):
-        # Simplified: assumes one profile per EVSE and a simple schedule.
-        if evse_id in self.charging_profiles:
-            profile = self.charging_profiles[evse_id]
-            schedule = profile.get("charging_schedule", {})
+        self.charging_profiles = ChargingProfiles(saved_state.get("charging_profiles") if saved_state else None)
 
-            if not schedule:
-                return 9999  # No schedule defined
+        # Definition from the `device_model` JSON file (None: the built-in one), shared by similar stations
+        scheduler = get_meter_scheduler()
+        definition = station_definition(device_model, len(self.evses), scheduler.interval, scheduler.messages)
+        self.device_model = DeviceModel(definition, saved_state.get("variables") if saved_state else None)
+        # reportData entries per NotifyReport of GetBaseReport/GetReport
+        self.report_part_size = report_part_size
 
-            charging_rate_unit = schedule.get("charging_rate_unit", "").lower()
-            charging_schedule_period = schedule.get("charging_schedule_period", [])
+        if saved_state:
+            self.offline_queue.restore(saved_state.get("offline_queue", {}))
+        if imported:
+            retire_state_file(self)
+
+    def attach(self, connection):
+        """Starts using a new WebSocket connection after a (re)connection."""
+        self._connection = connection
+        self._response_queue = asyncio.Queue()
+        self.connected = True
+        self._connected_at = time.monotonic()
+
+    def detach(self):
+        """
+        Marks the Charge Point offline after its connection was lost. A CALL
+        waiting for its response fails at once instead of timing out.
+        """
+        if not self.connected:
+            return
+        self.connected = False
+        self.boot_accepted.clear()
+        self._disconnected_at = time.monotonic()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        if self.outbound.busy:
+            self._response_queue.put_nowait(CONNECTION_LOST)
+
+    async def route_message(self, raw_msg):
+        """Routes an inbound frame like the ocpp base class, decoding it with `self.codec`."""
+        self.messages_received += 1
+        capture = get_capture()
+        if capture is not None:
+            capture.write(INBOUND, self.id, raw_msg)
+        try:
+            msg = decode_message(raw_msg, self.codec)
+        except OCPPError as e:
+            self.logger.exception("Unable to parse message: '%s', it doesn't seem to be valid OCPP: %s", raw_msg, e)
+            return
+
+        if msg.message_type_id == MessageType.Call:
+            try:
+                await self._handle_call(msg)
+            except OCPPError as error:
+                # Rejected before reaching its handler, e.g. by schema validation
+                get_metrics().record("handler", msg.action, "call_error")
+                self.logger.exception("Error while handling request '%s'", msg)
+                await self._send(msg.create_call_error(error).to_json())
+
+        elif msg.message_type_id in (MessageType.CallResult, MessageType.CallError):
+            self._response_queue.put_nowait(msg)
+
+    async def _send(self, message):
+        self.messages_sent += 1
+        self.logger.info("%s: send %s", self.id, message)
+        capture = get_capture()
+        if capture is not None:
+            capture.write(OUTBOUND, self.id, message)
+        if isinstance(message, bytes):
+            # Encoded by a bytes codec: still an OCPP-J text frame
+            await self._connection.send(message, text=True)
+        else:
+            await self._connection.send(message)
+
+    async def call(self, payload, suppress=True, unique_id=None, skip_schema_validation=False):
+        camel_case_payload = remove_nones(snake_to_camel_case(serialize_as_dict(payload)))
+        return await self.call_payload(
+            payload.__class__.__name__,
+            camel_case_payload,
+            suppress=suppress,
+            unique_id=unique_id,
+            skip_schema_validation=skip_schema_validation,
+        )
 
-            if not charging_schedule_period:
-                return 9999  # No periods defined
+    async def call_payload(self, action, payload, suppress=True, unique_id=None, skip_schema_validation=False):
+        """
+        Sends a CALL whose payload is already a camelCase dict and returns
+        the matching call_result, like `call` does for dataclass payloads.
 
-            # Use the first period (simplified - should check timestamps in real implementation)
-            limit = charging_schedule_period[0].get("limit", 9999)
+        TransactionEvent and MeterValues go to the offline queue instead,
+        while the Charge Point is offline or older ones are still queued.
+        """
+        if action in QUEUED_ACTIONS and (not self.connected or self.offline_queue):
+            return self._enqueue_offline(action, payload)
+        try:
+            return await self.send_call(action, payload, suppress, unique_id, skip_schema_validation)
+        except (ConnectionError, websockets.ConnectionClosed):
+            if action not in QUEUED_ACTIONS:
+                raise
+            return self._enqueue_offline(action, payload)
+
+    def _enqueue_offline(self, action, payload):
+        # No answer yet: scenario expectations must not see an older one
+        self.last_responses.pop(action, None)
+        if action == "TransactionEvent" and not self.connected:
+            payload = {**payload, "offline": True}
+        self.offline_queue.append(action, payload)
+        mark_dirty(self)
+        # Stands in for the CSMS answer: the message was not rejected
+        return getattr(self._call_result, action)()
+
+    async def send_call(self, action, payload, suppress=True, unique_id=None, skip_schema_validation=False):
+        """Sends a camelCase CALL right away, raising ConnectionError while offline."""
+        unique_id = unique_id if unique_id is not None else str(self._unique_id_generator())
+        request = Call(unique_id=unique_id, action=action, payload=payload)
+
+        metrics = get_metrics()
+        # Simulated time stands still while waiting for the CSMS (see clock.VirtualClock)
+        with get_clock().hold():
+            if not skip_schema_validation:
+                await self.validate_outbound(request)
+
+            # Only one CALL may be outstanding at a time: wait for the turn of this one
+            payload = await self.outbound.acquire(action, payload)
+            if payload is None:
+                # Merged into a waiting MeterValues, or dropped from the full outbound queue:
+                # no answer, like a suppressed CallError
+                self.last_responses.pop(action, None)
+                return None
+            try:
+                if not self.connected:
+                    raise ConnectionError(f"{self.id} is offline")
+                started = time.perf_counter()
+                try:
+                    await self._send(self.codec.encode([MessageType.Call, unique_id, action, payload]))
+                    response = await self._get_specific_response(unique_id, self._response_timeout)
+                except asyncio.TimeoutError:
+                    metrics.record("call", action, "timeout")
+                    raise asyncio.TimeoutError(
+                        f"Waited {self._response_timeout}s for response on {action} ({unique_id})."
+                    )
+                except (ConnectionError, websockets.ConnectionClosed):
+                    metrics.record("call", action, "connection_lost")
+                    raise
+                elapsed = time.perf_counter() - started
+            finally:
+                self.outbound.release()
+
+        self.last_responses[action] = response
+        if response.message_type_id == MessageType.CallError:
+            metrics.record("call", action, "call_error", elapsed)
+            self.logger.warning("Received a CALLError: %s'", response)
+            if suppress:
+                return
+            raise response.to_exception()
+        metrics.record("call", action, "ok", elapsed)
+        if not skip_schema_validation:
+            response.action = action
+            await validate_payload(response, self._ocpp_version)
+
+        return getattr(self._call_result, action)(**camel_to_snake_case(response.payload))
+
+    async def _get_specific_response(self, unique_id, timeout):
+        """Like the ocpp base class, but fails at once when the connection is lost."""
+        queue = self._response_queue
+        wait_until = time.monotonic() + timeout
+        while True:
+            response = await asyncio.wait_for(queue.get(), timeout)
+            if response is CONNECTION_LOST:
+                raise ConnectionError(f"{self.id}: connection lost while waiting for {unique_id}")
+            if response.unique_id == unique_id:
+                return response
+
+            self.logger.error("Ignoring response with unknown unique id: %s", response)
+            timeout = wait_until - time.monotonic()
+            if timeout < 0:
+                raise asyncio.TimeoutError
+
+    async def validate_outbound(self, request):
+        """Validates an outbound CALL according to the outbound validation mode."""
+        if self.outbound_validation == "off":
+            return
+        if self.outbound_validation == "first":
+            key = (request.action, payload_shape(request.payload))
+            if key in _validated_shapes:
+                return
+            await validate_payload(request, self._ocpp_version)
+            _validated_shapes.add(key)
+            return
+        await validate_payload(request, self._ocpp_version)
 
-            if charging_rate_unit == "w":  # Power in Watts
-                return limit
-            elif charging_rate_unit == "a":  # Current in Amps, convert to Watts (assuming 230V monophase)
-                return limit * 230
+    def get_power_limit(self, evse_id):
+        """Returns the composite charging limit of an EVSE right now, in W."""
+        return self.charging_profiles.limit(evse_id, self.transactions.get(evse_id))
+
+    def start_metering(self, tx_key):
+        """Registers a charging transaction with the meter scheduler."""
+        # Relative charging profiles start with the first energy transfer
+        transaction = self.transactions[tx_key]
+        if transaction.charging_since is None:
+            transaction.charging_since = get_clock().timestamp()
+        transaction.is_charging = True
+        interval = self.device_model.number(TX_UPDATED_INTERVAL)
+        # A device model file may hold a non-positive interval: use the scheduler's then
+        transaction.meter_task = get_meter_scheduler().register(self, tx_key, interval if interval and interval > 0 else None)
+
+    def stop_metering(self, tx_key):
+        """
+        Stops the meter ticks of a transaction, if it is charging. Returns the
+        samples of an unfinished batch, to be sent with the next
+        TransactionEvent, or None.
+        """
+        transaction = self.transactions[tx_key]
+        handle, transaction.meter_task = transaction.meter_task, None
+        transaction.is_charging = False
+        if handle is None:
+            return None
+        handle.cancel()
+        samples, handle.samples = handle.samples, []
+        return samples or None
+
+    def meter_templates(self, tx_key, transaction):
+        """Returns the prebuilt meter tick payloads of a transaction."""
+        templates = self._meter_templates.get(tx_key)
+        if templates is None or templates[1].transaction_id != transaction.transaction_id:
+            # Clock-aligned samples are reported as such
+            if get_meter_scheduler().phase == "aligned":
+                context, trigger_reason = ReadingContextEnumType.sample_clock, TriggerReasonEnumType.meter_value_clock
+            else:
+                context, trigger_reason = ReadingContextEnumType.sample_periodic, TriggerReasonEnumType.meter_value_periodic
+            templates = (
+                MeterValuesTemplate(transaction.evse_id, context),
+                TransactionEventTemplate(transaction.transaction_id, transaction.evse_id, trigger_reason=trigger_reason),
+            )
+            self._meter_templates[tx_key] = templates
+        return templates
 
-        return 9999  # Default high limit if no profile
+    async def meter_tick(self, handle, timestamp):
+        """
+        Takes the energy sample of one scheduler tick for a transaction, and
+        sends the samples once the batch is complete. `timestamp` is shared
+        by every transaction ticking at the same time.
+        """
+        tx_key = handle.tx_key
+
+        # Verifica che la transazione esista ancora e che il tick sia quello registrato
+        transaction = self.transactions.get(tx_key)
+        if transaction is None or transaction.meter_task is not handle:
+            logging.info(f"Meter ticks for EVSE {tx_key} are no longer registered, stopping them")
+            handle.cancel()
+            return
+
+        now = get_clock().time()
+        elapsed, handle.last_sample = now - handle.last_sample, now
+
+        power_limit = self.get_power_limit(transaction.evse_id)
+        # The EV draws at most its own maximum power, when known
+        power = power_limit if transaction.ev_power is None else min(power_limit, transaction.ev_power)
+        # Simulate energy added since the previous tick (Wh)
+        energy_added = (power * elapsed) / 3600
+        transaction.energy += energy_added
+
+        meter_values, transaction_event = self.meter_templates(tx_key, transaction)
+        handle.samples.append(meter_values.sample(timestamp, transaction.energy))
+        scheduler = get_meter_scheduler()
+        if len(handle.samples) < scheduler.batch:
+            return
+        meter_value, handle.samples = handle.samples, []
+
+        # The device model of the station turns either message off
+        if self.device_model.flag(ALIGNED_DATA_ENABLED, scheduler.messages != "transaction"):
+            await self.send_templated_meter_values(meter_values, meter_value)
+        if not self.device_model.flag(SAMPLED_DATA_ENABLED, scheduler.messages != "standalone"):
+            return
+
+        # Send TransactionEvent with meter values
+        transaction.seq_no += 1
+        response = await self.send_templated_transaction_event(
+            transaction_event, timestamp, transaction.seq_no, meter_value
+        )
 
-    async def meter_values_sender(self, tx_key):
-        """Periodically sends MeterValues for a transaction."""
-        try:
-            # Salva il transaction_id originale per verificare che la transazione non sia cambiata
-            if tx_key not in self.transactions:
-                return
-            original_tx_id = self.transactions[tx_key]["transaction_id"]
-
-            while True:
-                await asyncio.sleep(10)
-
-                # Verifica che la transazione esista ancora e sia la stessa
-                if tx_key not in self.transactions:
-                    logging.info(f"Transaction for EVSE {tx_key} no longer exists, stopping meter values")
-                    break
-
-                transaction = self.transactions[tx_key]
-
-                # Verifica che sia ancora la stessa transazione (non sostituita)
-                if transaction["transaction_id"] != original_tx_id:
-                    logging.info(f"Transaction for EVSE {tx_key} has changed, stopping meter values for old transaction")
-                    break
-
-                # Verifica che il task sia ancora quello registrato
-                if transaction.get("meter_task") != asyncio.current_task():
-                    logging.info(f"Meter task for EVSE {tx_key} has been replaced, stopping old task")
-                    break
-
-                power_limit = self.get_power_limit(transaction["evse_id"])
-                # Simulate energy added in 10 seconds (Wh)
-                energy_added = (power_limit * 10) / 3600
-                transaction["energy"] += energy_added
-                transaction["seq_no"] += 1
-
-                meter_value = [
-                    {
-                        "timestamp": datetime.now(timezone.utc).isoformat(),
-                        "sampledValue": [
-                            {
-                                "value": transaction["energy"],
-                                "context": ReadingContextEnumType.sample_periodic,
-                                "measurand": "Energy.Active.Import.Register",
-                                "unitOfMeasure": {"unit": "Wh"},
-                            }
-                        ],
-                    }
-                ]
-                # Send MeterValues message
-                await self.send_meter_values(
-                    evse_id=transaction["evse_id"],
-                    meter_value=meter_value,
-                )
-
-                # Send TransactionEvent with meter values
-                response = await self.send_transaction_event(
-                    event_type=TransactionEventEnumType.updated,
-                    transaction_id=transaction["transaction_id"],
-                    trigger_reason=TriggerReasonEnumType.meter_value_periodic,
-                    seq_no=transaction["seq_no"],
-                    evse_id=transaction["evse_id"],
-                    connector_id=1,
-                    meter_value=meter_value,
-                )
-
-                # If server rejected the transaction, stop sending updates
-                if response is None:
-                    logging.warning(f"Server rejected transaction {transaction['transaction_id']}, stopping meter values sender")
-                    # Clean up the transaction
-                    if tx_key in self.transactions:
-                        del self.transactions[tx_key]
-                    # Save state
-                    from .state import save_state
-                    save_state(self)
-                    break
-        except asyncio.CancelledError:
-            logging.info(f"Meter values sender for EVSE {tx_key} was cancelled")
-            raise
+        # If server rejected the transaction, stop sending updates
+        if response is None:
+            logging.warning(f"Server rejected transaction {transaction.transaction_id}, stopping meter values")
+            handle.cancel()
+            # Clean up the transaction
+            if self.transactions.get(tx_key) is transaction:
+                del self.transactions[tx_key]
+            mark_dirty(self)
 
     async def resume_transactions(self):
         """
@@ -174,12 +516,12 @@ class ChargePoint(ocpp_ChargePoint, CoreHandlers, ChargePointSenderMixin):
         transactions_to_remove = []
 
         for tx_key, tx_data in self.transactions.items():
-            transaction_id = tx_data.get("transaction_id")
-            evse_id = tx_data.get("evse_id")
+            transaction_id = tx_data.transaction_id
+            evse_id = tx_data.evse_id
 
             # Remove transaction if EVSE is available (no vehicle connected)
             if evse_id and evse_id in self.evses:
-                if self.evses[evse_id]["status"] == ConnectorStatusEnumType.available:
+                if self.evses[evse_id].status == ConnectorStatusEnumType.available:
                     logging.warning(f"Removing transaction {transaction_id} - EVSE {evse_id} is available (no vehicle)")
                     transactions_to_remove.append(tx_key)
                     continue
@@ -191,21 +533,21 @@ class ChargePoint(ocpp_ChargePoint, CoreHandlers, ChargePointSenderMixin):
                 continue
 
             # Handle pending_remote_start transactions - invalidate them
-            if tx_data.get("pending_remote_start"):
+            if tx_data.pending_remote_start:
                 logging.info(f"Invalidating pending remote start transaction {transaction_id} after restart")
                 transactions_to_remove.append(tx_key)
                 continue
 
             # For active transactions, send TransactionEvent updated
-            tx_data["seq_no"] += 1
+            tx_data.seq_no += 1
 
             # Build meter values with current energy
             meter_value = [
                 {
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "timestamp": get_clock().timestamp(),
                     "sampledValue": [
                         {
-                            "value": tx_data.get("energy", 0),
+                            "value": tx_data.energy,
                             "context": ReadingContextEnumType.sample_periodic,
                             "measurand": "Energy.Active.Import.Register",
                             "unitOfMeasure": {"unit": "Wh"},
@@ -215,16 +557,14 @@ class ChargePoint(ocpp_ChargePoint, CoreHandlers, ChargePointSenderMixin):
             ]
 
             logging.info(f"Resuming transaction {transaction_id} on EVSE {evse_id}")
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] Resuming transaction {transaction_id} after restart"
-            )
+            self.history.record(EVENT, "TransactionEvent", evse_id, transaction_id, "Resuming transaction {} after restart", transaction_id)
 
             # Send TransactionEvent with trigger ChargingStateChanged
             response = await self.send_transaction_event(
                 event_type=TransactionEventEnumType.updated,
                 transaction_id=transaction_id,
                 trigger_reason=TriggerReasonEnumType.charging_state_changed,
-                seq_no=tx_data["seq_no"],
+                seq_no=tx_data.seq_no,
                 evse_id=evse_id,
                 connector_id=1,
                 meter_value=meter_value,
@@ -242,18 +582,16 @@ class ChargePoint(ocpp_ChargePoint, CoreHandlers, ChargePointSenderMixin):
 
         # Save state after cleanup
         if transactions_to_remove:
-            from .state import save_state
-            save_state(self)
+            mark_dirty(self)
 
     async def resume_ongoing_tasks(self):
         """Resumes background tasks after loading the state."""
         for tx_key, tx_data in self.transactions.items():
-            if tx_data.get("is_charging"):
-                logging.info(f"Resuming charging for transaction {tx_data['transaction_id']}")
-                task = asyncio.create_task(self.meter_values_sender(tx_key))
-                self.transactions[tx_key]["meter_task"] = task
+            if tx_data.is_charging:
+                logging.info(f"Resuming charging for transaction {tx_data.transaction_id}")
+                self.start_metering(tx_key)
 
-    async def send_boot_notification(self):
+    async def send_boot_notification(self, reason=BootReasonEnumType.power_up):
         request = call.BootNotification(
             charging_station={
                 "model": self.model,
@@ -261,54 +599,264 @@ class ChargePoint(ocpp_ChargePoint, CoreHandlers, ChargePointSenderMixin):
                 "serial_number": f"mz2x5a38-{self.id}",
                 "firmware_version": self.firmware_version,
             },
-            reason=BootReasonEnumType.power_up,
+            reason=reason,
         )
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] >> BootNotification")
-        response = await self.call(request)
-        if response.status == "Accepted":
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] << BootNotification Confirmed"
-            )
-            asyncio.create_task(self.send_heartbeat(response.interval))
-
-            # Send StatusNotification for all EVSEs after successful BootNotification
-            for evse_id, evse_data in self.evses.items():
-                await self.send_status_notification(evse_id, evse_data["status"])
-
-            # Resume transactions: inform CSMS about ongoing transactions
-            await self.resume_transactions()
+        while True:
+            self.history.record(SENT, "BootNotification")
+            response = await self.call(request)
+            if response is not None and response.status == "Accepted":
+                break
+            if response is None:
+                # A CallError: retried like a Rejected without interval
+                status, retry = "CallError", BOOT_RETRY_INTERVAL
+            else:
+                # Pending or Rejected: the CSMS says when to try again
+                status, retry = response.status, response.interval or BOOT_RETRY_INTERVAL
+            self.boot_retries += 1
+            self.history.record(RECEIVED, "BootNotification", None, None, "{}, retrying in {}s", status, retry)
+            await get_clock().sleep(retry)
+
+        self.history.record(RECEIVED, "BootNotification", None, None, "Accepted")
+        now = time.monotonic()
+        metrics = get_metrics()
+        metrics.observe("phase", "boot_accepted", now - self._connected_at)
+        if self._disconnected_at is not None:
+            # From the lost connection to being accepted again
+            metrics.observe("phase", "recovery", now - self._disconnected_at)
+            self._disconnected_at = None
+        self.device_model.update(HEARTBEAT_INTERVAL, str(response.interval))
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        self._heartbeat_task = asyncio.create_task(self.send_heartbeat(response.interval))
+
+        # Send StatusNotification for all EVSEs after successful BootNotification
+        for evse_id, evse_data in self.evses.items():
+            await self.send_status_notification(evse_id, evse_data.status)
+
+        # Send what was queued while offline, before any newer event
+        await self.offline_queue.drain(self, self.offline_drain_rate)
+
+        # Resume transactions: inform CSMS about ongoing transactions
+        await self.resume_transactions()
+
+        self.boot_accepted.set()
+        return response
 
     async def send_heartbeat(self, interval):
+        """Sends a Heartbeat every OCPPCommCtrlr.HeartbeatInterval seconds, or every `interval` without one."""
+        first = True
         while True:
             await self.call(call.Heartbeat())
-            self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] >> Heartbeat")
-            await asyncio.sleep(interval)
-
-
-async def start_client(ws_url, cp_id, vendor, model, firmware, connectors):
+            if first:
+                get_metrics().observe("phase", "first_heartbeat", time.monotonic() - self._connected_at)
+                first = False
+            self.history.record(SENT, "Heartbeat")
+            heartbeat_interval = self.device_model.number(HEARTBEAT_INTERVAL)
+            await get_clock().sleep(heartbeat_interval if heartbeat_interval and heartbeat_interval > 0 else interval)
+
+
+class Backoff:
+    """Jittered exponential backoff between reconnection attempts."""
+
+    def __init__(self, initial=1.0, maximum=60.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        # Fraction of each delay that is randomized, so stations spread out
+        self.jitter = jitter
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+
+class Admission:
+    """
+    Paces the connection attempts of every station of a process.
+
+    "herd" lets every attempt through at once, like real stations after a
+    CSMS restart. "linear" admits attempts evenly, `rate` per second.
+    "token-bucket" admits `rate` per second on average, in bursts of up to
+    `burst` attempts.
+    """
+
+    def __init__(self, ramp="herd", rate=0.0, burst=1):
+        if ramp not in RECONNECT_RAMPS:
+            raise ValueError(f"Unknown reconnect ramp '{ramp}'")
+        if ramp != "herd" and rate <= 0:
+            raise ValueError(f"The '{ramp}' reconnect ramp needs a positive rate")
+        self.ramp = ramp
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = None
+        self._next_slot = 0.0
+        self.waiting = 0
+
+    def _reserve(self, now):
+        """Books the next admission and returns the seconds to wait for it."""
+        if self.ramp == "linear":
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.rate
+            return slot - now
+        if self._updated is not None:
+            self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # A negative balance books a token that has not been refilled yet
+        self._tokens -= 1
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    async def acquire(self):
+        if self.ramp == "herd":
+            return
+        delay = self._reserve(asyncio.get_running_loop().time())
+        if delay > 0:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.waiting -= 1
+
+
+async def supervise(charge_point, uri, backoff=None, listener=None, admission=None):
+    """
+    Keeps `charge_point` connected to `uri`. After a failed attempt or a lost
+    connection it waits for the backoff and reconnects, keeping the
+    in-memory transactions; every connection starts with a BootNotification.
+    Each attempt first waits for its turn from `admission`, if given.
+
+    `listener`, if given, gets on_connected, on_boot, on_disconnected and
+    on_failed calls.
+    """
+    backoff = backoff or Backoff()
+    boot_reason = BootReasonEnumType.power_up
+    metrics = get_metrics()
+    while True:
+        connected = False
+        try:
+            with get_clock().hold():
+                if admission is not None:
+                    await admission.acquire()
+                attempt_started = time.monotonic()
+                ws = await websockets.connect(uri, subprotocols=["ocpp2.0.1"], ping_interval=None)
+            async with ws:
+                connected = True
+                metrics.observe("phase", "connect", time.monotonic() - attempt_started)
+                backoff.reset()
+                charge_point.attach(ws)
+                if listener is not None:
+                    listener.on_connected(charge_point)
+
+                serve_task = asyncio.create_task(charge_point.start())
+                serve_task.add_done_callback(lambda _: charge_point.detach())
+                # A Pending/Rejected boot may retry for a while: stop if the connection drops meanwhile
+                boot_task = asyncio.create_task(charge_point.send_boot_notification(boot_reason))
+                try:
+                    await asyncio.wait((boot_task, serve_task), return_when=asyncio.FIRST_COMPLETED)
+                    if boot_task.done():
+                        response = boot_task.result()
+                        # Later boots are reconnections, not power-ups
+                        boot_reason = BootReasonEnumType.unknown
+                        if listener is not None:
+                            listener.on_boot(charge_point, response)
+                    await serve_task
+                finally:
+                    boot_task.cancel()
+                    serve_task.cancel()
+                    charge_point.detach()
+                    if listener is not None:
+                        listener.on_disconnected(charge_point)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.info(f"{charge_point.id}: connection {'lost' if connected else 'failed'}: {e!r}")
+            if not connected and listener is not None:
+                listener.on_failed(charge_point, e)
+
+        delay = backoff.next_delay()
+        logging.info(f"{charge_point.id}: reconnecting in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+def station_snapshot(charge_point):
+    """Returns the counters and metrics of a single Charge Point, like a fleet snapshot."""
+    return {
+        "connected": int(charge_point.connected),
+        "offline_queued": len(charge_point.offline_queue),
+        "outbound_waiting": charge_point.outbound.depth,
+        "outbound_blocked": charge_point.outbound.blocked,
+        "outbound_coalesced": charge_point.outbound.coalesced,
+        "outbound_dropped": charge_point.outbound.dropped,
+        "boot_retries": charge_point.boot_retries,
+        "messages_sent": charge_point.messages_sent,
+        "messages_received": charge_point.messages_received,
+        "metrics": get_metrics().snapshot(),
+    }
+
+
+async def start_client(
+    ws_url,
+    cp_id,
+    vendor,
+    model,
+    firmware,
+    connectors,
+    flush_interval=1.0,
+    outbound_validation="full",
+    backoff=None,
+    offline_queue_size=1000,
+    offline_drain_rate=10.0,
+    outbound_queue_size=DEFAULT_DEPTH,
+    meter_values_policy="coalesce",
+    device_model=None,
+    report_part_size=REPORT_PART_SIZE,
+    metrics_address=None,
+):
     uri = f"{ws_url}/{cp_id}"
     print(f"Connecting to {uri}...")
+    start_flusher(flush_interval)
+    charge_point = ChargePoint(
+        cp_id=cp_id,
+        connection=None,
+        vendor=vendor,
+        model=model,
+        firmware_version=firmware,
+        connectors=connectors,
+        outbound_validation=outbound_validation,
+        offline_queue_size=offline_queue_size,
+        offline_drain_rate=offline_drain_rate,
+        outbound_queue_size=outbound_queue_size,
+        meter_values_policy=meter_values_policy,
+        device_model=device_model,
+        report_part_size=report_part_size,
+        legacy_state=True,
+    )
+    await charge_point.resume_ongoing_tasks()
+
+    connection_task = asyncio.create_task(supervise(charge_point, uri, backoff))
+    exporter = None
+    if metrics_address:
+        exporter = asyncio.create_task(serve_metrics(*metrics_address, lambda: station_snapshot(charge_point)))
     try:
-        async with websockets.connect(
-            uri, subprotocols=["ocpp2.0.1"], ping_interval=None
-        ) as ws:
-            charge_point = ChargePoint(
-                cp_id=cp_id,
-                connection=ws,
-                vendor=vendor,
-                model=model,
-                firmware_version=firmware,
-                connectors=connectors,
-            )
-
-            await charge_point.resume_ongoing_tasks()
-
-            ocpp_task = asyncio.create_task(charge_point.start())
-            asyncio.create_task(charge_point.send_boot_notification())
-            print("Starting REPL...")
-            repl = REPL(charge_point)
-            await repl.run()
-
-            ocpp_task.cancel()
+        print("Starting REPL...")
+        repl = REPL(charge_point)
+        await repl.run()
+    except EOFError:
+        # Raised by the quit command
+        pass
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        if exporter is not None:
+            exporter.cancel()
+        connection_task.cancel()
+        try:
+            await connection_task
+        except asyncio.CancelledError:
+            pass
+        await stop_flusher()
@@ -0,0 +1,171 @@
+"""Process-wide simulation clock: real time, accelerated, or as fast as possible."""
+import asyncio
+import contextlib
+import heapq
+import time
+from datetime import datetime, timedelta, timezone
+
+
+class Clock:
+    """
+    Real time, the default. Everything the simulated stations do on a
+    schedule (heartbeats, meter ticks, sessions, scenario sleeps) sleeps
+    and stamps its messages through the process clock, so swapping it
+    speeds the whole simulation up consistently.
+    """
+
+    def time(self):
+        """Monotonic simulated seconds, for intervals."""
+        return time.monotonic()
+
+    def now(self):
+        """The simulated UTC date and time."""
+        return datetime.now(timezone.utc)
+
+    def timestamp(self):
+        """The simulated UTC date and time as an ISO 8601 string, as sent in OCPP messages."""
+        return self.now().isoformat()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def hold(self):
+        """
+        Context manager around real waits (CSMS round trips, connection
+        attempts) that simulated time must not skip over.
+        """
+        return contextlib.nullcontext()
+
+
+class ScaledClock(Clock):
+    """Simulated time running `speed` times faster than real time, from `start` (default: now)."""
+
+    def __init__(self, speed, start=None):
+        if speed <= 0:
+            raise ValueError("The clock speed must be positive")
+        self.speed = speed
+        self.start = start or datetime.now(timezone.utc)
+        self._origin = time.monotonic()
+
+    def time(self):
+        return (time.monotonic() - self._origin) * self.speed
+
+    def now(self):
+        return self.start + timedelta(seconds=self.time())
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds / self.speed)
+
+
+class VirtualClock(Clock):
+    """
+    Event-driven simulated time, from `start` (default: now).
+
+    Sleepers wait in a heap ordered by wake-up time. A driver task lets
+    everything runnable run, then jumps the clock to the earliest wake-up
+    and wakes that sleeper. While anything holds the clock (see `hold`),
+    time stands still: a CSMS round trip takes no simulated time, so runs
+    do not depend on how fast the CSMS answers, and a simulated day only
+    takes as long as its messages.
+    """
+
+    def __init__(self, start=None):
+        self.start = start or datetime.now(timezone.utc)
+        self._now = 0.0
+        self._timers = []
+        self._seq = 0
+        self._holds = 0
+        self._driver = None
+        self._pending = None
+        self._released = None
+
+    def time(self):
+        return self._now
+
+    def now(self):
+        return self.start + timedelta(seconds=self._now)
+
+    async def sleep(self, seconds):
+        loop = asyncio.get_running_loop()
+        if self._driver is None or self._driver.done() or self._driver.get_loop() is not loop:
+            # Timers of a previous event loop can never fire
+            self._timers = []
+            self._pending = asyncio.Event()
+            self._released = asyncio.Event()
+            self._driver = loop.create_task(self._drive())
+        future = loop.create_future()
+        # The sequence number keeps sleepers with the same wake-up time in FIFO order
+        heapq.heappush(self._timers, (self._now + max(seconds, 0.0), self._seq, future))
+        self._seq += 1
+        self._pending.set()
+        await future
+
+    @contextlib.contextmanager
+    def hold(self):
+        self._holds += 1
+        try:
+            yield
+        finally:
+            self._holds -= 1
+            if not self._holds and self._released is not None:
+                self._released.set()
+
+    async def _drive(self):
+        while True:
+            if not self._timers:
+                self._pending.clear()
+                await self._pending.wait()
+            # Let every callback that is ready now run before time moves on
+            await asyncio.sleep(0)
+            if self._holds:
+                self._released.clear()
+                await self._released.wait()
+                continue
+            due = self._timers[0][0]
+            self._now = max(self._now, due)
+            # Wake every sleeper due at that time together
+            while self._timers and self._timers[0][0] <= due:
+                _, _, future = heapq.heappop(self._timers)
+                # Done when its sleeper was cancelled
+                if not future.done():
+                    future.set_result(None)
+
+
+def create_clock(speed="1", start=None):
+    """
+    Creates a clock from a speed: '1' for real time, a factor such as '60'
+    for accelerated time, or 'max' for event-driven time. `start` is an ISO
+    8601 string setting the simulated start date (default: now).
+    """
+    start_time = None
+    if start:
+        start_time = datetime.fromisoformat(start)
+        if start_time.tzinfo is None:
+            start_time = start_time.replace(tzinfo=timezone.utc)
+    if str(speed).lower() == "max":
+        return VirtualClock(start_time)
+    try:
+        factor = float(speed)
+    except ValueError:
+        raise ValueError(f"Invalid clock speed '{speed}': expected a number or 'max'")
+    if factor == 1 and start_time is None:
+        return Clock()
+    return ScaledClock(factor, start_time)
+
+
+_clock = None
+
+
+def configure_clock(speed="1", start=None):
+    """Sets the process-wide clock."""
+    global _clock
+    _clock = create_clock(speed, start)
+    return _clock
+
+
+def get_clock():
+    """Returns the process-wide clock (real time unless configured)."""
+    global _clock
+    if _clock is None:
+        _clock = Clock()
+    return _clock
@@ -0,0 +1,158 @@
+"""Pluggable JSON codecs for OCPP frames and state records."""
+import decimal
+import json
+
+from ocpp.exceptions import FormatViolationError, PropertyConstraintViolationError, ProtocolError
+from ocpp.messages import Call, CallError, CallResult
+
+
+def _default(obj):
+    # The ocpp library parses some schedule values as Decimal
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    """The standard-library json module, with compact separators."""
+
+    name = "json"
+    errors = (ValueError, UnicodeDecodeError)
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(",", ":"), default=_default)
+
+    def encode(self, obj):
+        """Encodes a wire frame as a str, sent as a text frame."""
+        return self._encoder.encode(obj)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """orjson: encodes straight to UTF-8 bytes, sent as text frames unchanged."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+        self.errors = (orjson.JSONDecodeError, UnicodeDecodeError)
+
+    def encode(self, obj):
+        return self._orjson.dumps(obj, default=_default)
+
+    def dumps(self, obj):
+        return self._orjson.dumps(obj, default=_default).decode()
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class MsgspecCodec:
+    """msgspec: reuses one encoder buffer and one decoder for every message."""
+
+    name = "msgspec"
+
+    def __init__(self):
+        import msgspec
+
+        self._encoder = msgspec.json.Encoder(enc_hook=_default)
+        self._decoder = msgspec.json.Decoder()
+        self.errors = (msgspec.DecodeError, UnicodeDecodeError)
+
+    def encode(self, obj):
+        return self._encoder.encode(obj)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).decode()
+
+    def loads(self, data):
+        return self._decoder.decode(data)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "orjson": OrjsonCodec,
+    "msgspec": MsgspecCodec,
+}
+
+
+def create_codec(name):
+    """Creates a codec by name; optional backends raise ValueError when not installed."""
+    try:
+        codec_class = CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec '{name}'")
+    try:
+        return codec_class()
+    except ImportError:
+        raise ValueError(f"Codec '{name}' is not installed (pip install {name})")
+
+
+def available_codecs():
+    """Returns the names of the codecs whose backend is installed."""
+    names = []
+    for name in CODECS:
+        try:
+            create_codec(name)
+        except ValueError:
+            continue
+        names.append(name)
+    return names
+
+
+_codec = None
+
+
+def configure_codec(name):
+    """Sets the process-wide codec."""
+    global _codec
+    _codec = create_codec(name)
+    return _codec
+
+
+def get_codec():
+    """Returns the process-wide codec (stdlib json unless configured)."""
+    global _codec
+    if _codec is None:
+        _codec = JsonCodec()
+    return _codec
+
+
+def decode_message(raw_msg, codec):
+    """Decodes an OCPP-J frame into a Call, CallResult or CallError, like ocpp's unpack."""
+    try:
+        msg = codec.loads(raw_msg)
+    except codec.errors:
+        raise FormatViolationError(
+            details={"cause": "Message is not valid JSON", "ocpp_message": raw_msg}
+        )
+
+    if not isinstance(msg, list):
+        raise ProtocolError(
+            details={
+                "cause": (
+                    "OCPP message hasn't the correct format. It "
+                    f"should be a list, but got '{type(msg)}' instead"
+                )
+            }
+        )
+
+    for cls in (Call, CallResult, CallError):
+        try:
+            if msg[0] == cls.message_type_id:
+                return cls(*msg[1:])
+        except IndexError:
+            raise ProtocolError(details={"cause": "Message does not contain MessageTypeId"})
+        except TypeError:
+            raise ProtocolError(details={"cause": "Message is missing elements."})
+
+    raise PropertyConstraintViolationError(
+        details={"cause": f"MessageTypeId '{msg[0]}' isn't valid"}
+    )
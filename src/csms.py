@@ -0,0 +1,387 @@
+"""Mock CSMS: a local OCPP 2.0.1 central system, to benchmark the simulator end to end on one machine."""
+import asyncio
+import itertools
+import logging
+import random
+import time
+from datetime import datetime, timezone
+
+import websockets
+from ocpp.exceptions import GenericError, InternalError, NotSupportedError, OCPPError, SecurityError
+from ocpp.routing import on
+from ocpp.v201 import ChargePoint as ocpp_ChargePoint
+from ocpp.v201 import call, call_result
+from ocpp.v201.enums import Action, ConnectorStatusEnumType, TransactionEventEnumType
+
+from .metrics import format_latencies, get_metrics, serve_metrics
+from .scenario import sample
+
+# Error codes the mock CSMS can inject in its answers, see CsmsBehavior
+ERRORS = {error.code: error for error in (InternalError, GenericError, NotSupportedError, SecurityError)}
+
+# CALLs the mock CSMS can send to each Charge Point, see CsmsSession.command
+COMMANDS = (
+    "RequestStartTransaction",
+    "RequestStopTransaction",
+    "GetTransactionStatus",
+    "SetChargingProfile",
+    "ClearChargingProfile",
+    "GetVariables",
+    "SetVariables",
+    "GetBaseReport",
+    "TriggerMessage",
+)
+
+# Id of the TxDefaultProfile the mock CSMS sets and clears
+PROFILE_ID = 1
+PROFILE_LIMITS = (3700, 7400, 11000, 22000)
+
+
+class CsmsBehavior:
+    """
+    How the mock CSMS answers, and what it asks, the same for every
+    connection: the response delay (a constant or a distribution, see
+    scenario.sample), the fraction of CALLs answered with a `error_code`
+    CallError instead, and the rate, per Charge Point and per second, at
+    which each of `commands` ({action: rate}) is sent.
+    """
+
+    def __init__(
+        self,
+        heartbeat_interval=300,
+        response_delay=0.0,
+        error_rate=0.0,
+        error_code="InternalError",
+        commands=None,
+        validation=True,
+        seed=None,
+    ):
+        if not 0 <= error_rate <= 1:
+            raise ValueError("The error rate must be between 0 and 1")
+        if error_code not in ERRORS:
+            raise ValueError(f"Unknown error code '{error_code}'")
+        for action, rate in (commands or {}).items():
+            if action not in COMMANDS:
+                raise ValueError(f"The mock CSMS cannot send {action}")
+            if rate < 0:
+                raise ValueError(f"The rate of {action} cannot be negative")
+        self.heartbeat_interval = heartbeat_interval
+        self.response_delay = response_delay
+        self.error_rate = error_rate
+        self.error = ERRORS[error_code]
+        self.commands = {action: rate for action, rate in (commands or {}).items() if rate > 0}
+        self.validation = validation
+        self.rng = random.Random(seed)
+
+
+class StationView:
+    """What the mock CSMS knows of a Charge Point, kept across its reconnections."""
+
+    __slots__ = ("evses", "transactions")
+
+    def __init__(self):
+        # EVSE id to its last reported connector status
+        self.evses = {}
+        # Id of each ongoing transaction to its EVSE id
+        self.transactions = {}
+
+    def free_evses(self):
+        busy = set(self.transactions.values())
+        return [
+            evse_id for evse_id, status in self.evses.items()
+            if status == ConnectorStatusEnumType.available and evse_id not in busy
+        ]
+
+
+class CsmsStats:
+    """Counters of the mock CSMS."""
+
+    def __init__(self):
+        self.connected = 0
+        self.closed = 0
+        self.rejected = 0
+        self.booted = 0
+        self.received = 0
+        self.errors_injected = 0
+        self.commands = 0
+        self.stations = {}
+        self.started = time.monotonic()
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "connected": self.connected,
+            "online": self.connected - self.closed,
+            "rejected": self.rejected,
+            "booted": self.booted,
+            "stations": len(self.stations),
+            "transactions": sum(len(view.transactions) for view in self.stations.values()),
+            "received": self.received,
+            "received_per_s": round(self.received / elapsed) if elapsed else 0,
+            "errors_injected": self.errors_injected,
+            "commands": self.commands,
+            "metrics": get_metrics().snapshot(),
+        }
+
+
+def format_csms(snapshot):
+    """Formats the counters on one line, followed by the latencies of received and sent CALLs."""
+    counters = " ".join(f"{key}={value}" for key, value in snapshot.items() if key != "metrics")
+    metrics = snapshot.get("metrics", {})
+    return "\n".join([counters, *format_latencies(metrics, "csms_received"), *format_latencies(metrics, "csms_command")])
+
+
+def _not_injected(record):
+    # Injected CallErrors are expected: no traceback for each of them
+    return not (record.exc_info and getattr(record.exc_info[1], "injected", False))
+
+
+logger = logging.getLogger("ocpp.mock_csms")
+logger.addFilter(_not_injected)
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class CsmsSession(ocpp_ChargePoint):
+    """The mock CSMS side of one Charge Point connection."""
+
+    def __init__(self, cp_id, connection, behavior, stats):
+        super().__init__(cp_id, connection, logger=logger)
+        self.behavior = behavior
+        self.stats = stats
+        self.view = stats.stations.get(cp_id)
+        if self.view is None:
+            self.view = stats.stations[cp_id] = StationView()
+        self.booted = asyncio.Event()
+        if not behavior.validation:
+            self.route_map = {
+                action: {**handlers, "_skip_schema_validation": True} for action, handlers in self.route_map.items()
+            }
+
+    async def answer(self, action):
+        """Waits the response delay of `action`, then fails it when an error is injected."""
+        behavior = self.behavior
+        self.stats.received += 1
+        started = time.perf_counter()
+        delay = sample(behavior.response_delay, behavior.rng)
+        if delay:
+            await asyncio.sleep(delay)
+        if behavior.error_rate and behavior.rng.random() < behavior.error_rate:
+            self.stats.errors_injected += 1
+            get_metrics().record("csms_received", action, "call_error", time.perf_counter() - started)
+            error = behavior.error(description="Injected by the mock CSMS")
+            error.injected = True
+            raise error
+        get_metrics().record("csms_received", action, "ok", time.perf_counter() - started)
+
+    @on(Action.boot_notification)
+    async def on_boot_notification(self, **kwargs):
+        await self.answer("BootNotification")
+        self.stats.booted += 1
+        self.booted.set()
+        return call_result.BootNotification(
+            current_time=utc_now(), interval=self.behavior.heartbeat_interval, status="Accepted"
+        )
+
+    @on(Action.heartbeat)
+    async def on_heartbeat(self, **kwargs):
+        await self.answer("Heartbeat")
+        return call_result.Heartbeat(current_time=utc_now())
+
+    @on(Action.status_notification)
+    async def on_status_notification(self, evse_id, connector_status, **kwargs):
+        await self.answer("StatusNotification")
+        self.view.evses[evse_id] = connector_status
+        return call_result.StatusNotification()
+
+    @on(Action.authorize)
+    async def on_authorize(self, **kwargs):
+        await self.answer("Authorize")
+        return call_result.Authorize(id_token_info={"status": "Accepted"})
+
+    @on(Action.transaction_event)
+    async def on_transaction_event(self, event_type, transaction_info, evse=None, id_token=None, **kwargs):
+        await self.answer("TransactionEvent")
+        transaction_id = transaction_info["transaction_id"]
+        if event_type == TransactionEventEnumType.ended:
+            self.view.transactions.pop(transaction_id, None)
+        elif evse is not None:
+            self.view.transactions[transaction_id] = evse["id"]
+        if id_token is not None:
+            return call_result.TransactionEvent(id_token_info={"status": "Accepted"})
+        return call_result.TransactionEvent()
+
+    @on(Action.meter_values)
+    async def on_meter_values(self, **kwargs):
+        await self.answer("MeterValues")
+        return call_result.MeterValues()
+
+    @on(Action.notify_event)
+    async def on_notify_event(self, **kwargs):
+        await self.answer("NotifyEvent")
+        return call_result.NotifyEvent()
+
+    @on(Action.notify_report)
+    async def on_notify_report(self, **kwargs):
+        await self.answer("NotifyReport")
+        return call_result.NotifyReport()
+
+    @on(Action.report_charging_profiles)
+    async def on_report_charging_profiles(self, **kwargs):
+        await self.answer("ReportChargingProfiles")
+        return call_result.ReportChargingProfiles()
+
+    @on(Action.firmware_status_notification)
+    async def on_firmware_status_notification(self, **kwargs):
+        await self.answer("FirmwareStatusNotification")
+        return call_result.FirmwareStatusNotification()
+
+    @on(Action.log_status_notification)
+    async def on_log_status_notification(self, **kwargs):
+        await self.answer("LogStatusNotification")
+        return call_result.LogStatusNotification()
+
+    def command(self, action):
+        """Returns the payload of a CALL to send, or None when it has no target right now."""
+        view = self.view
+        rng = self.behavior.rng
+        if action == "RequestStartTransaction":
+            free = view.free_evses()
+            if not free:
+                return None
+            remote_start_id = next(_remote_start_ids)
+            return call.RequestStartTransaction(
+                id_token={"id_token": f"MOCK{remote_start_id}", "type": "Central"},
+                remote_start_id=remote_start_id,
+                evse_id=rng.choice(free),
+            )
+        if action == "RequestStopTransaction":
+            if not view.transactions:
+                return None
+            return call.RequestStopTransaction(transaction_id=rng.choice(list(view.transactions)))
+        if action == "GetTransactionStatus":
+            transaction_id = rng.choice(list(view.transactions)) if view.transactions else None
+            return call.GetTransactionStatus(transaction_id=transaction_id)
+        if action == "SetChargingProfile":
+            return call.SetChargingProfile(
+                evse_id=0,
+                charging_profile={
+                    "id": PROFILE_ID,
+                    "stack_level": 0,
+                    "charging_profile_purpose": "TxDefaultProfile",
+                    "charging_profile_kind": "Relative",
+                    "charging_schedule": [
+                        {
+                            "id": PROFILE_ID,
+                            "charging_rate_unit": "W",
+                            "charging_schedule_period": [{"start_period": 0, "limit": rng.choice(PROFILE_LIMITS)}],
+                        }
+                    ],
+                },
+            )
+        if action == "ClearChargingProfile":
+            return call.ClearChargingProfile(charging_profile_id=PROFILE_ID)
+        if action == "GetVariables":
+            return call.GetVariables(
+                get_variable_data=[{"component": {"name": "OCPPCommCtrlr"}, "variable": {"name": "HeartbeatInterval"}}]
+            )
+        if action == "SetVariables":
+            return call.SetVariables(
+                set_variable_data=[
+                    {
+                        "attribute_value": str(self.behavior.heartbeat_interval),
+                        "component": {"name": "OCPPCommCtrlr"},
+                        "variable": {"name": "HeartbeatInterval"},
+                    }
+                ]
+            )
+        if action == "GetBaseReport":
+            return call.GetBaseReport(request_id=next(_report_ids), report_base="FullInventory")
+        return call.TriggerMessage(requested_message="Heartbeat")
+
+    async def send_commands(self, action, rate):
+        """Sends `action` to the Charge Point as a Poisson process of `rate` per second, once it booted."""
+        await self.booted.wait()
+        metrics = get_metrics()
+        rng = self.behavior.rng
+        while True:
+            await asyncio.sleep(rng.expovariate(rate))
+            payload = self.command(action)
+            if payload is None:
+                continue
+            self.stats.commands += 1
+            started = time.perf_counter()
+            try:
+                await self.call(payload, suppress=False, skip_schema_validation=not self.behavior.validation)
+            except OCPPError:
+                metrics.record("csms_command", action, "call_error", time.perf_counter() - started)
+                continue
+            except asyncio.TimeoutError:
+                metrics.record("csms_command", action, "timeout")
+                continue
+            metrics.record("csms_command", action, "ok", time.perf_counter() - started)
+
+
+_remote_start_ids = itertools.count(1)
+_report_ids = itertools.count(1)
+
+
+async def run_csms(
+    host,
+    port,
+    behavior,
+    stats=None,
+    duration=None,
+    report_interval=10.0,
+    metrics_address=None,
+):
+    """
+    Serves the mock CSMS on ws://`host`:`port`/<cp_id> until `duration`
+    seconds have passed (or forever when None) and returns its stats.
+    """
+    stats = stats if stats is not None else CsmsStats()
+
+    async def handler(ws):
+        if ws.subprotocol is None:
+            stats.rejected += 1
+            await ws.close(1002, "The ocpp2.0.1 subprotocol is required")
+            return
+        cp_id = ws.request.path.rstrip("/").rsplit("/", 1)[-1]
+        session = CsmsSession(cp_id, ws, behavior, stats)
+        stats.connected += 1
+        commands = [
+            asyncio.create_task(session.send_commands(action, rate)) for action, rate in behavior.commands.items()
+        ]
+        try:
+            await session.start()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            stats.closed += 1
+            for task in commands:
+                task.cancel()
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            print(format_csms(stats.snapshot()))
+
+    reporter = asyncio.create_task(report()) if report_interval else None
+    exporter = asyncio.create_task(serve_metrics(*metrics_address, stats.snapshot)) if metrics_address else None
+    # No permessage-deflate: compressing every frame would make the CSMS the bottleneck
+    async with websockets.serve(
+        handler, host, port, subprotocols=["ocpp2.0.1"], ping_interval=None, compression=None, backlog=4096
+    ):
+        logging.info(f"Mock CSMS listening on ws://{host}:{port}")
+        try:
+            if duration is None:
+                await asyncio.Future()
+            else:
+                await asyncio.sleep(duration)
+        finally:
+            for task in (reporter, exporter):
+                if task is not None:
+                    task.cancel()
+    return stats
@@ -0,0 +1,335 @@
+"""Device model of the Charge Points: components, variables and their attributes."""
+import functools
+import json
+
+from ocpp.v201.enums import GetVariableStatusEnumType, SetVariableStatusEnumType
+
+# Components instantiated on every EVSE when their definition names none
+PER_EVSE = ("EVSE", "Connector")
+
+MEASURANDS = "Energy.Active.Import.Register"
+
+# reportData entries per NotifyReport message
+REPORT_PART_SIZE = 100
+# Variables of a SummaryInventory report: the state of every component
+SUMMARY_VARIABLES = ("AvailabilityState", "Available", "Problem", "Tripped", "Overload", "Fallback")
+
+
+def component_id(name, instance=None, evse_id=None, connector_id=None):
+    return (name, instance, evse_id, connector_id)
+
+
+def request_key(component, variable, attribute_type=None):
+    """Index key of the attribute a GetVariables/SetVariables item names, from its snake_case dicts."""
+    evse = component.get("evse") or {}
+    return (
+        component_id(component["name"], component.get("instance"), evse.get("id"), evse.get("connector_id")),
+        variable["name"],
+        variable.get("instance"),
+        attribute_type or "Actual",
+    )
+
+
+def station_key(component, variable):
+    """Index key of the Actual attribute of a variable of the station itself."""
+    return (component_id(component), variable, None, "Actual")
+
+
+# Variables driving the simulator
+HEARTBEAT_INTERVAL = station_key("OCPPCommCtrlr", "HeartbeatInterval")
+TX_UPDATED_INTERVAL = station_key("SampledDataCtrlr", "TxUpdatedInterval")
+SAMPLED_DATA_ENABLED = station_key("SampledDataCtrlr", "Enabled")
+ALIGNED_DATA_ENABLED = station_key("AlignedDataCtrlr", "Enabled")
+# Intervals the simulator waits on: only positive values, whatever the definition says
+POSITIVE_VARIABLES = frozenset({HEARTBEAT_INTERVAL, TX_UPDATED_INTERVAL, station_key("AlignedDataCtrlr", "Interval")})
+
+
+def _entry(component, variable, value, mutability="ReadOnly", data_type="string", unit=None, values_list=None, instance=None, min_limit=None):
+    characteristics = {"dataType": data_type, "supportsMonitoring": False}
+    if unit:
+        characteristics["unit"] = unit
+    if min_limit is not None:
+        characteristics["minLimit"] = min_limit
+    if values_list:
+        characteristics["valuesList"] = values_list
+    variable = {"name": variable, **({"instance": instance} if instance else {})}
+    return {
+        "component": {"name": component},
+        "variable": variable,
+        "variableAttribute": [{"type": "Actual", "value": value, "mutability": mutability, "persistent": True, "constant": False}],
+        "variableCharacteristics": characteristics,
+    }
+
+
+def builtin_entries(meter_interval, meter_messages):
+    """
+    The definition used without --device-model, as report data: the
+    controllers the simulator implements, with the meter settings of the
+    process as their initial values.
+    """
+    sampled = "false" if meter_messages == "standalone" else "true"
+    aligned = "false" if meter_messages == "transaction" else "true"
+    return [
+        _entry("ChargingStation", "AvailabilityState", "Available", values_list="Available,Occupied,Reserved,Unavailable,Faulted", data_type="OptionList"),
+        _entry("ChargingStation", "Available", "true", data_type="boolean"),
+        _entry("ChargingStation", "SupplyPhases", "3", data_type="integer"),
+        _entry("OCPPCommCtrlr", "HeartbeatInterval", "300", "ReadWrite", "integer", "s", min_limit=1),
+        _entry("OCPPCommCtrlr", "MessageTimeout", "30", data_type="integer", unit="s", instance="Default"),
+        _entry("OCPPCommCtrlr", "NetworkConfigurationPriority", "1", "ReadWrite", "SequenceList", values_list="1"),
+        _entry("OCPPCommCtrlr", "OfflineThreshold", "60", "ReadWrite", "integer", "s"),
+        _entry("DeviceDataCtrlr", "ItemsPerMessage", "1000", data_type="integer", instance="GetReport"),
+        _entry("DeviceDataCtrlr", "ItemsPerMessage", "1000", data_type="integer", instance="GetVariables"),
+        _entry("DeviceDataCtrlr", "ItemsPerMessage", "1000", data_type="integer", instance="SetVariables"),
+        _entry("DeviceDataCtrlr", "BytesPerMessage", "65535", data_type="integer", instance="GetReport"),
+        _entry("SampledDataCtrlr", "Enabled", sampled, "ReadWrite", "boolean"),
+        _entry("SampledDataCtrlr", "TxUpdatedInterval", str(int(meter_interval)), "ReadWrite", "integer", "s", min_limit=1),
+        _entry("SampledDataCtrlr", "TxUpdatedMeasurands", MEASURANDS, "ReadWrite", "MemberList", values_list=MEASURANDS),
+        _entry("SampledDataCtrlr", "TxEndedMeasurands", MEASURANDS, "ReadWrite", "MemberList", values_list=MEASURANDS),
+        _entry("AlignedDataCtrlr", "Enabled", aligned, "ReadWrite", "boolean"),
+        _entry("AlignedDataCtrlr", "Interval", str(int(meter_interval)), "ReadWrite", "integer", "s", min_limit=1),
+        _entry("AlignedDataCtrlr", "Measurands", MEASURANDS, "ReadWrite", "MemberList", values_list=MEASURANDS),
+        _entry("TxCtrlr", "EVConnectionTimeOut", "60", "ReadWrite", "integer", "s"),
+        _entry("TxCtrlr", "StopTxOnEVSideDisconnect", "true", data_type="boolean"),
+        _entry("TxCtrlr", "TxStartPoint", "PowerPathClosed", "ReadWrite", "MemberList", values_list="ParkingBayOccupancy,EVConnected,Authorized,PowerPathClosed,EnergyTransfer"),
+        _entry("TxCtrlr", "TxStopPoint", "EVConnected", "ReadWrite", "MemberList", values_list="ParkingBayOccupancy,EVConnected,Authorized,PowerPathClosed,EnergyTransfer"),
+        _entry("AuthCtrlr", "AuthorizeRemoteStart", "true", "ReadWrite", "boolean"),
+        _entry("AuthCtrlr", "LocalPreAuthorize", "false", "ReadWrite", "boolean"),
+        _entry("SmartChargingCtrlr", "Enabled", "true", data_type="boolean"),
+        _entry("SmartChargingCtrlr", "ProfileStackLevel", "10", data_type="integer"),
+        _entry("SmartChargingCtrlr", "PeriodsPerSchedule", "24", data_type="integer"),
+        _entry("SmartChargingCtrlr", "RateUnit", "A,W", data_type="MemberList", values_list="A,W"),
+        _entry("EVSE", "AvailabilityState", "Available", values_list="Available,Occupied,Reserved,Unavailable,Faulted", data_type="OptionList"),
+        _entry("EVSE", "Power", "22000", data_type="decimal", unit="W"),
+        _entry("EVSE", "SupplyPhases", "3", data_type="integer"),
+        _entry("Connector", "ConnectorType", "cType2"),
+        _entry("Connector", "AvailabilityState", "Available", values_list="Available,Occupied,Reserved,Unavailable,Faulted", data_type="OptionList"),
+    ]
+
+
+def load_entries(path):
+    """Reads a device model definition: a JSON list of NotifyReport reportData entries."""
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Cannot read the device model {path}: {e}")
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) and "component" in entry and "variable" in entry for entry in entries):
+        raise ValueError(f"{path} is not a list of component and variable entries")
+    return entries
+
+
+class Definition:
+    """
+    The components, variables and attributes of a station model, shared by
+    every Charge Point with the same definition and number of EVSEs.
+    `entries` keeps (variable key, report data) in definition order;
+    `attributes` indexes each (component, evse, variable, attribute) to
+    its entry.
+    """
+
+    __slots__ = ("entries", "attributes", "components", "variables")
+
+    def __init__(self, entries, evse_count):
+        self.entries = []
+        self.attributes = {}
+        self.components = set()
+        self.variables = set()
+        for entry in entries:
+            component = entry["component"]
+            if component["name"] in PER_EVSE and "evse" not in component:
+                for evse_id in range(1, evse_count + 1):
+                    evse = {"id": evse_id, "connectorId": 1} if component["name"] == "Connector" else {"id": evse_id}
+                    self._add({**entry, "component": {**component, "evse": evse}})
+            else:
+                self._add(entry)
+
+    def _add(self, entry):
+        component, variable = entry["component"], entry["variable"]
+        evse = component.get("evse") or {}
+        component_key = component_id(component["name"], component.get("instance"), evse.get("id"), evse.get("connectorId"))
+        variable_key = (component_key, variable["name"], variable.get("instance"))
+        self.components.add(component_key)
+        self.variables.add(variable_key)
+        self.entries.append((variable_key, entry))
+        for attribute in entry.get("variableAttribute", ()):
+            self.attributes[(*variable_key, attribute.get("type", "Actual"))] = (entry, attribute)
+
+
+@functools.cache
+def station_definition(path, evse_count, meter_interval, meter_messages):
+    """Returns the shared definition of a station from `path` (None: the built-in one)."""
+    entries = load_entries(path) if path else builtin_entries(meter_interval, meter_messages)
+    return Definition(entries, evse_count)
+
+
+def _valid(characteristics, value):
+    # Checks a value against the dataType, limits and valuesList of a variable
+    data_type = characteristics.get("dataType", "string")
+    try:
+        if data_type in ("integer", "decimal"):
+            number = int(value) if data_type == "integer" else float(value)
+            if "minLimit" in characteristics and number < characteristics["minLimit"]:
+                return False
+            return "maxLimit" not in characteristics or number <= characteristics["maxLimit"]
+    except ValueError:
+        return False
+    if data_type == "boolean":
+        return value in ("true", "false")
+    allowed = characteristics.get("valuesList")
+    if allowed is not None and data_type in ("OptionList", "MemberList", "SequenceList"):
+        allowed = allowed.split(",")
+        return value in allowed if data_type == "OptionList" else all(item in allowed for item in value.split(","))
+    return len(value) <= characteristics.get("maxLimit", len(value))
+
+
+def _positive(value):
+    try:
+        return float(value) > 0
+    except ValueError:
+        return False
+
+
+class DeviceModel:
+    """
+    The device model of one Charge Point: a shared Definition, plus the
+    values set on this station. Lookups by attribute key are a dict access.
+    """
+
+    __slots__ = ("definition", "values")
+
+    def __init__(self, definition, records=None):
+        self.definition = definition
+        self.values = {}
+        for key, value in (records or {}).items():
+            self.values[_key_from_record(key)] = value
+
+    def records(self):
+        """Returns the values set on this station as state records."""
+        return {json.dumps([*key[0], *key[1:]]): value for key, value in self.values.items()}
+
+    def value(self, key, default=None):
+        """Returns the value of an attribute, or `default` if the definition has no such attribute."""
+        value = self.values.get(key)
+        if value is not None:
+            return value
+        found = self.definition.attributes.get(key)
+        return default if found is None else found[1].get("value", default)
+
+    def number(self, key, default=None):
+        value = self.value(key)
+        try:
+            return default if value is None else float(value)
+        except ValueError:
+            return default
+
+    def flag(self, key, default=False):
+        value = self.value(key)
+        return default if value is None else value == "true"
+
+    def _missing(self, key, statuses):
+        # The status of a key the definition has no attribute for
+        component, name, instance, _ = key
+        if component not in self.definition.components:
+            return statuses.unknown_component
+        if (component, name, instance) not in self.definition.variables:
+            return statuses.unknown_variable
+        return statuses.not_supported_attribute_type
+
+    def get(self, key):
+        """Returns the GetVariables status and value of an attribute."""
+        found = self.definition.attributes.get(key)
+        if found is None:
+            return self._missing(key, GetVariableStatusEnumType), None
+        if found[1].get("mutability") == "WriteOnly":
+            return GetVariableStatusEnumType.rejected, None
+        return GetVariableStatusEnumType.accepted, self.values.get(key, found[1].get("value", ""))
+
+    def set(self, key, value):
+        """Sets an attribute as the CSMS asked; returns the SetVariables status."""
+        found = self.definition.attributes.get(key)
+        if found is None:
+            return self._missing(key, SetVariableStatusEnumType)
+        entry, attribute = found
+        if attribute.get("mutability", "ReadWrite") == "ReadOnly" or not _valid(entry.get("variableCharacteristics", {}), value):
+            return SetVariableStatusEnumType.rejected
+        if key in POSITIVE_VARIABLES and not _positive(value):
+            return SetVariableStatusEnumType.rejected
+        self.values[key] = value
+        return SetVariableStatusEnumType.accepted
+
+    def select(self, report_base=None, component_criteria=None, component_variables=None):
+        """
+        Yields the (variable key, entry) pairs of the definition a
+        GetBaseReport `report_base` or a GetReport asks for, in definition
+        order. GetReport selects the variables of `component_variables`
+        (snake_case ComponentVariable items), and of the components whose
+        variable named after one of `component_criteria` is true.
+        """
+        for variable_key, entry in self.definition.entries:
+            if report_base == "ConfigurationInventory" and not _configurable(entry):
+                continue
+            if report_base == "SummaryInventory" and variable_key[1] not in SUMMARY_VARIABLES:
+                continue
+            if component_variables and not any(_matches(variable_key, item) for item in component_variables):
+                continue
+            if component_criteria and not any(self.flag((variable_key[0], criterion, None, "Actual")) for criterion in component_criteria):
+                continue
+            yield variable_key, entry
+
+    def report_parts(self, selected, part_size=REPORT_PART_SIZE):
+        """
+        Yields the reportData of the `selected` pairs (see `select`) in
+        lists of at most `part_size`, each built once the previous one is
+        consumed. Entries the station did not change are the shared ones.
+        """
+        part = []
+        for variable_key, entry in selected:
+            part.append(self._report_data(variable_key, entry))
+            if len(part) == part_size:
+                yield part
+                part = []
+        if part:
+            yield part
+
+    def _report_data(self, variable_key, entry):
+        # The definition entry, with the values of this station and without write-only values
+        attributes = entry.get("variableAttribute", ())
+        overlaid = []
+        changed = False
+        for attribute in attributes:
+            value = self.values.get((*variable_key, attribute.get("type", "Actual"))) if self.values else None
+            if value is not None:
+                attribute = {**attribute, "value": value}
+                changed = True
+            if attribute.get("mutability") == "WriteOnly" and "value" in attribute:
+                attribute = {name: item for name, item in attribute.items() if name != "value"}
+                changed = True
+            overlaid.append(attribute)
+        return {**entry, "variableAttribute": overlaid} if changed else entry
+
+    def update(self, key, value):
+        """Sets an attribute the station itself changes, if the definition has it."""
+        if key in self.definition.attributes:
+            self.values[key] = value
+
+
+def _configurable(entry):
+    return any(attribute.get("mutability", "ReadWrite") != "ReadOnly" for attribute in entry.get("variableAttribute", ()))
+
+
+def _matches(variable_key, item):
+    # Whether a variable is one a GetReport componentVariable item (snake_case) names
+    (name, instance, evse_id, connector_id), variable_name, variable_instance = variable_key
+    component = item["component"]
+    evse = component.get("evse")
+    if name != component["name"] or component.get("instance", instance) != instance:
+        return False
+    if evse and (evse["id"] != evse_id or evse.get("connector_id", connector_id) != connector_id):
+        return False
+    variable = item.get("variable")
+    return not variable or (variable["name"] == variable_name and variable.get("instance", variable_instance) == variable_instance)
+
+
+def _key_from_record(record_key):
+    name, instance, evse_id, connector_id, variable, variable_instance, attribute = json.loads(record_key)
+    return (component_id(name, instance, evse_id, connector_id), variable, variable_instance, attribute)
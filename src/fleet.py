@@ -0,0 +1,458 @@
+"""Fleet mode: many simulated Charge Points on a single event loop."""
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import re
+import time
+
+from .capture import close_capture, configure_capture
+from .client import Admission, Backoff, ChargePoint, supervise
+from .clock import configure_clock, get_clock
+from .codec import configure_codec
+from .history import close_history, configure_history
+from .load import SessionGenerator
+from .metering import configure_metering
+from .metrics import format_latencies, get_metrics, merge_metrics, serve_metrics, serve_metrics_in_thread
+from .repl.handlers import set_echo
+from .state import close_store, open_store, start_flusher, stop_flusher
+
+ID_TEMPLATE_FIELD = re.compile(r"\{(0*)\}")
+
+
+def expand_ids(id_template, count, start=1):
+    """
+    Expands an ID template such as 'CP{00000}' into a list of Charge Point IDs.
+
+    The number of zeros inside the braces sets the zero-padded width of the
+    index; '{}' inserts the bare index.
+    """
+    match = ID_TEMPLATE_FIELD.search(id_template)
+    if match is None:
+        raise ValueError(f"ID template '{id_template}' has no '{{000}}' index field")
+
+    width = len(match.group(1))
+    prefix, suffix = id_template[:match.start()], id_template[match.end():]
+    return [f"{prefix}{index:0{width}d}{suffix}" for index in range(start, start + count)]
+
+
+def parse_connectors(spec):
+    """
+    Parses a connector count spec: either a fixed number ('2') or an
+    inclusive range ('1-4') from which each Charge Point draws its count.
+    """
+    low, _, high = str(spec).partition("-")
+    low = int(low)
+    high = int(high) if high else low
+    if low < 1 or high < low:
+        raise ValueError(f"Invalid connector spec '{spec}'")
+    return low, high
+
+
+class FleetStats:
+    """Counters shared by all the Charge Points of a fleet."""
+
+    def __init__(self):
+        self.started = 0
+        self.connected = 0
+        self.booted = 0
+        self.failed = 0
+        self.closed = 0
+        self.stations = {}
+        self.admission = None
+        self.load = None
+
+    @property
+    def online(self):
+        return self.connected - self.closed
+
+    def on_connected(self, charge_point):
+        self.connected += 1
+
+    def on_boot(self, charge_point, response):
+        if response is not None and response.status == "Accepted":
+            self.booted += 1
+
+    def on_disconnected(self, charge_point):
+        self.closed += 1
+
+    def on_failed(self, charge_point, error):
+        self.failed += 1
+
+    def snapshot(self):
+        messages_sent = sum(cp.messages_sent for cp in self.stations.values())
+        messages_received = sum(cp.messages_received for cp in self.stations.values())
+        sessions = self.load.snapshot() if self.load is not None else {}
+        return {
+            "started": self.started,
+            "connected": self.connected,
+            "online": self.online,
+            "booted": self.booted,
+            "failed": self.failed,
+            "closed": self.closed,
+            "offline_queued": sum(len(cp.offline_queue) for cp in self.stations.values()),
+            "outbound_waiting": sum(cp.outbound.depth for cp in self.stations.values()),
+            "outbound_blocked": sum(cp.outbound.blocked for cp in self.stations.values()),
+            "outbound_coalesced": sum(cp.outbound.coalesced for cp in self.stations.values()),
+            "outbound_dropped": sum(cp.outbound.dropped for cp in self.stations.values()),
+            "boot_retries": sum(cp.boot_retries for cp in self.stations.values()),
+            "admission_waiting": self.admission.waiting if self.admission is not None else 0,
+            "messages_sent": messages_sent,
+            "messages_received": messages_received,
+            **sessions,
+            "metrics": get_metrics().snapshot(),
+        }
+
+
+async def run_station(
+    ws_url,
+    cp_id,
+    vendor,
+    model,
+    firmware,
+    connectors,
+    stats,
+    persist=False,
+    station_options=None,
+    backoff_options=None,
+    admission=None,
+    scenario=None,
+    index=0,
+    seed=None,
+):
+    """
+    Runs one Charge Point of the fleet, reconnecting whenever its connection
+    is lost. `station_options` are extra ChargePoint keyword arguments,
+    `backoff_options` configure its reconnection Backoff and `admission`
+    paces its connection attempts with the rest of the fleet.
+
+    With a `scenario`, the station runs it as the `index`-th station of the
+    fleet and disconnects once it is done.
+    """
+    stats.started += 1
+    charge_point = ChargePoint(
+        cp_id=cp_id,
+        connection=None,
+        vendor=vendor,
+        model=model,
+        firmware_version=firmware,
+        connectors=connectors,
+        persist=persist,
+        **(station_options or {}),
+    )
+    stats.stations[cp_id] = charge_point
+    await charge_point.resume_ongoing_tasks()
+    connection = supervise(
+        charge_point,
+        f"{ws_url}/{cp_id}",
+        Backoff(**(backoff_options or {})),
+        listener=stats,
+        admission=admission,
+    )
+    if scenario is None:
+        await connection
+        return
+
+    supervisor = asyncio.create_task(connection)
+    try:
+        await scenario.run(charge_point, index, seed)
+    finally:
+        supervisor.cancel()
+        await asyncio.gather(supervisor, return_exceptions=True)
+
+
+async def report_progress(stats, interval):
+    """Periodically prints the fleet counters."""
+    while True:
+        await asyncio.sleep(interval)
+        print(format_stats(stats.snapshot()))
+
+
+def format_stats(snapshot):
+    """Formats the counters on one line, followed by a line per latency phase."""
+    counters = " ".join(f"{key}={value}" for key, value in snapshot.items() if key != "metrics")
+    return "\n".join([counters, *format_latencies(snapshot.get("metrics", {}), "phase")])
+
+
+async def run_fleet(
+    ws_url,
+    cp_ids,
+    vendor,
+    model,
+    firmware,
+    connectors=(2, 2),
+    ramp_up=0.0,
+    duration=None,
+    report_interval=10.0,
+    seed=None,
+    stats=None,
+    persist=False,
+    flush_interval=1.0,
+    station_options=None,
+    backoff_options=None,
+    admission_options=None,
+    metrics_address=None,
+    scenario=None,
+    start_index=0,
+    load_options=None,
+):
+    """
+    Runs every Charge Point in `cp_ids` on the current event loop.
+
+    Connections are spread evenly over `ramp_up` seconds. The fleet runs until
+    `duration` seconds have passed (or forever when None) and returns its stats.
+    Both are measured on the process clock (see `clock`).
+    With `persist`, each Charge Point restores its own state from the state
+    store, and changes are flushed every `flush_interval` seconds.
+    `station_options` are extra ChargePoint keyword arguments,
+    `backoff_options` configure the reconnection Backoff of each station and
+    `admission_options` the Admission shared by every connection attempt.
+    With `metrics_address` (host, port), the stats are served over HTTP.
+    With a `scenario`, every station runs it, numbered from `start_index`,
+    and the fleet stops once they are all done. With `load_options`, a
+    SessionGenerator starts EV sessions on the fleet.
+    """
+    stats = stats if stats is not None else FleetStats()
+    stats.admission = Admission(**(admission_options or {}))
+    rng = random.Random(seed)
+    clock = get_clock()
+    step = ramp_up / len(cp_ids) if cp_ids else 0
+    tasks = []
+    reporter = asyncio.create_task(report_progress(stats, report_interval)) if report_interval else None
+    exporter = asyncio.create_task(serve_metrics(*metrics_address, stats.snapshot)) if metrics_address else None
+    if persist:
+        start_flusher(flush_interval)
+    if scenario is not None or load_options:
+        set_echo(False)
+    generator = None
+    if load_options:
+        stats.load = SessionGenerator(seed=seed, **load_options)
+        generator = asyncio.create_task(stats.load.run(stats.stations))
+
+    async def launch():
+        started_at = clock.time()
+        for index, cp_id in enumerate(cp_ids):
+            delay = started_at + index * step - clock.time()
+            if delay > 0:
+                await clock.sleep(delay)
+            tasks.append(
+                asyncio.create_task(
+                    run_station(
+                        ws_url,
+                        cp_id,
+                        vendor,
+                        model,
+                        firmware,
+                        rng.randint(*connectors),
+                        stats,
+                        persist,
+                        station_options,
+                        backoff_options,
+                        stats.admission,
+                        scenario,
+                        start_index + index,
+                        seed,
+                    )
+                )
+            )
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    launcher = asyncio.create_task(launch())
+    # The duration is simulated time, like the ramp-up
+    timer = asyncio.create_task(clock.sleep(duration)) if duration is not None else None
+    try:
+        await asyncio.wait([task for task in (launcher, timer) if task is not None], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (launcher, timer):
+            if task is not None:
+                task.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(launcher, *tasks, return_exceptions=True)
+        if reporter is not None:
+            reporter.cancel()
+        if exporter is not None:
+            exporter.cancel()
+        if generator is not None:
+            generator.cancel()
+            await asyncio.gather(generator, return_exceptions=True)
+        await stop_flusher()
+
+    return stats
+
+
+def split_ids(cp_ids, shards):
+    """Splits the Charge Point IDs into `shards` contiguous, nearly equal ranges."""
+    shards = max(1, min(shards, len(cp_ids)))
+    size, extra = divmod(len(cp_ids), shards)
+    chunks = []
+    start = 0
+    for index in range(shards):
+        end = start + size + (1 if index < extra else 0)
+        chunks.append(cp_ids[start:end])
+        start = end
+    return chunks
+
+
+def merge_snapshots(snapshots):
+    """Sums the counters of several worker snapshots into one, merging their metrics."""
+    merged = {}
+    metrics = []
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            if key == "metrics":
+                metrics.append(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    merged["metrics"] = merge_metrics(metrics)
+    return merged
+
+
+def shard_path(path, index):
+    """Returns the file of worker `index` for a per-process output file: history.jsonl.gz to history.1.jsonl.gz."""
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    return os.path.join(directory, f"{stem}.{index}{dot}{extensions}")
+
+
+def _fleet_worker(conn, worker_index, ws_url, cp_ids, fleet_kwargs, report_interval, log_level, state_db, metering, codec, clock, history, capture):
+    """Entry point of a fleet worker process: runs its shard and reports over `conn`."""
+    logging.basicConfig(level=log_level)
+    logging.getLogger("ocpp").setLevel(max(logging.getLevelName(log_level), logging.WARNING))
+    raise_fd_limit()
+    if state_db:
+        open_store(state_db)
+    configure_metering(**metering)
+    configure_codec(codec)
+    configure_clock(**clock)
+    configure_history(**history)
+    configure_capture(**capture)
+    stats = FleetStats()
+
+    async def publish():
+        while True:
+            await asyncio.sleep(report_interval)
+            conn.send(("metrics", worker_index, stats.snapshot()))
+
+    async def main():
+        publisher = asyncio.create_task(publish()) if report_interval else None
+        try:
+            await run_fleet(ws_url, cp_ids, report_interval=0, stats=stats, **fleet_kwargs)
+        finally:
+            if publisher is not None:
+                publisher.cancel()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_store()
+        close_history()
+        close_capture()
+        conn.send(("done", worker_index, stats.snapshot()))
+        conn.close()
+
+
+def run_sharded_fleet(ws_url, cp_ids, workers, report_interval=10.0, log_level="WARNING", seed=None, state_db=None, metering=None, codec="json", clock=None, history=None, capture=None, metrics_address=None, **fleet_kwargs):
+    """
+    Splits the fleet across `workers` processes, each with its own event loop.
+
+    Workers send their counters to the parent over a pipe; the parent prints
+    the merged counters every `report_interval` seconds and returns the final
+    merged snapshot. With `state_db`, every worker persists its shard in it;
+    `metering` holds the settings of each worker's meter scheduler,
+    `codec` names its JSON codec, `clock` holds its `configure_clock`
+    settings, and `history` and `capture` the `configure_history` and
+    `configure_capture` ones, each worker writing its own files (see
+    `shard_path`). The admission rate and burst are split
+    evenly between the workers, and so is the session rate: Poisson
+    arrivals split evenly stay Poisson. With `metrics_address` (host,
+    port), the parent serves the merged counters over HTTP.
+    """
+    shards = split_ids(cp_ids, workers)
+    offsets = [sum(len(shard) for shard in shards[:index]) for index in range(len(shards))]
+    load_options = fleet_kwargs.pop("load_options", None)
+    if load_options:
+        load_options = dict(load_options, rate=load_options["rate"] / len(shards))
+    admission_options = fleet_kwargs.pop("admission_options", None) or {}
+    if "rate" in admission_options:
+        admission_options = dict(
+            admission_options,
+            rate=admission_options["rate"] / len(shards),
+            burst=max(1, admission_options.get("burst", 1) // len(shards)),
+        )
+    readers = {}
+    processes = []
+    for index, shard in enumerate(shards):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        worker_seed = None if seed is None else seed + index
+        kwargs = dict(
+            fleet_kwargs,
+            seed=worker_seed,
+            persist=bool(state_db),
+            admission_options=admission_options,
+            start_index=offsets[index],
+            load_options=load_options,
+        )
+        worker_metering = dict(metering or {}, seed=worker_seed)
+        worker_history = dict(history or {})
+        if worker_history.get("spill_path"):
+            worker_history["spill_path"] = shard_path(worker_history["spill_path"], index)
+        worker_capture = dict(capture or {})
+        if worker_capture.get("path"):
+            worker_capture["path"] = shard_path(worker_capture["path"], index)
+        process = multiprocessing.Process(
+            target=_fleet_worker,
+            args=(writer, index, ws_url, shard, kwargs, report_interval, log_level, state_db, worker_metering, codec, clock or {}, worker_history, worker_capture),
+            name=f"fleet-worker-{index}",
+        )
+        process.start()
+        writer.close()
+        readers[reader] = index
+        processes.append(process)
+
+    latest = {}
+    last_report = time.monotonic()
+    if metrics_address:
+        serve_metrics_in_thread(*metrics_address, lambda: merge_snapshots(list(latest.values())))
+    try:
+        while readers:
+            try:
+                ready = multiprocessing.connection.wait(list(readers), timeout=report_interval or None)
+            except KeyboardInterrupt:
+                # Workers receive the same SIGINT and send their final counters
+                continue
+            for reader in ready:
+                try:
+                    kind, index, snapshot = reader.recv()
+                except EOFError:
+                    del readers[reader]
+                    continue
+                latest[index] = snapshot
+                if kind == "done":
+                    del readers[reader]
+            if report_interval and latest and time.monotonic() - last_report >= report_interval:
+                last_report = time.monotonic()
+                print(f"workers={len(shards)} {format_stats(merge_snapshots(latest.values()))}")
+    finally:
+        for process in processes:
+            process.join()
+
+    return merge_snapshots(latest.values())
+
+
+def raise_fd_limit():
+    """Raises the soft open-files limit to the hard limit, so thousands of sockets fit."""
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            logging.warning(f"Could not raise open-files limit: {e}")
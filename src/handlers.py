@@ -1,5 +1,5 @@
 import asyncio
-from datetime import datetime, timezone
+import logging
 
 from ocpp.routing import on
 from ocpp.v201 import call_result
@@ -10,9 +10,9 @@ from ocpp.v201.enums import (
     ConnectorStatusEnumType,
     DataTransferStatusEnumType,
     FirmwareStatusEnumType,
+    GenericDeviceModelStatusEnumType,
     GenericStatusEnumType,
     GetChargingProfileStatusEnumType,
-    GetVariableStatusEnumType,
     LogStatusEnumType,
     RequestStartStopStatusEnumType,
     ResetStatusEnumType,
@@ -25,18 +25,22 @@ from ocpp.v201.enums import (
     UploadLogStatusEnumType,
 )
 
+from .clock import get_clock
+from .device_model import TX_UPDATED_INTERVAL, request_key
+from .history import EVENT, RECEIVED
+from .models import Transaction
+from .smart_charging import STATION_MAX, TX, VOLTAGE
+
 
 class CoreHandlers:
     @on(Action.reset)
     async def on_reset(self, **kwargs):
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] << Reset")
+        self.history.record(RECEIVED, "Reset")
         return call_result.Reset(status=ResetStatusEnumType.accepted)
 
     @on(Action.request_start_transaction)
     async def on_request_start_transaction(self, remote_start_id: int, id_token: dict, evse_id=None, **kwargs):
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << RequestStartTransaction (EVSE {evse_id})"
-        )
+        self.history.record(RECEIVED, "RequestStartTransaction", evse_id, None, "EVSE {}", evse_id)
 
         # Se non è specificato un evse_id, usa il primo disponibile
         if evse_id is None:
@@ -67,55 +71,46 @@ class CoreHandlers:
             tx = self.transactions[evse_id]
 
             # Se sta già caricando, ignora
-            if "meter_task" in tx:
-                self.history.append(
-                    f"[{datetime.now(timezone.utc).isoformat()}] Remote start ignored: EVSE {evse_id} is already charging"
-                )
+            if tx.meter_task is not None:
+                self.history.record(EVENT, "RequestStartTransaction", evse_id, None, "Remote start ignored: EVSE {} is already charging", evse_id)
                 return
 
             # Se è una transazione normale (già connessa ma non in carica), avvia la ricarica
-            if not tx.get("pending_remote_start"):
-                tx["seq_no"] += 1
+            if not tx.pending_remote_start:
+                tx.seq_no += 1
 
                 # Invia TransactionEvent updated con trigger RemoteStart
                 response = await self.send_transaction_event(
                     event_type=TransactionEventEnumType.updated,
-                    transaction_id=tx["transaction_id"],
+                    transaction_id=tx.transaction_id,
                     trigger_reason=TriggerReasonEnumType.remote_start,
-                    seq_no=tx["seq_no"],
+                    seq_no=tx.seq_no,
                     evse_id=evse_id,
                     connector_id=1
                 )
 
                 # If server rejected, stop here
                 if response is None:
-                    self.history.append(
-                        f"[{datetime.now(timezone.utc).isoformat()}] Remote start rejected by server for EVSE {evse_id}"
-                    )
+                    self.history.record(EVENT, "RequestStartTransaction", evse_id, None, "Remote start rejected by server for EVSE {}", evse_id)
                     return
 
                 # Cambia lo stato a unavailable durante la ricarica
-                self.evses[evse_id]["status"] = ConnectorStatusEnumType.unavailable
+                self.evses[evse_id].status = ConnectorStatusEnumType.unavailable
                 await self.send_status_notification(evse_id, ConnectorStatusEnumType.unavailable)
 
-                # Avvia il meter values sender
-                task = asyncio.create_task(self.meter_values_sender(evse_id))
-                tx["meter_task"] = task
-                tx["remote_start_id"] = remote_start_id
+                # Avvia l'invio dei meter values
+                self.start_metering(evse_id)
+                tx.remote_start_id = remote_start_id
 
-                self.history.append(
-                    f"[{datetime.now(timezone.utc).isoformat()}] Remote start: charging started on already connected EVSE {evse_id}"
-                )
+                self.history.record(EVENT, "RequestStartTransaction", evse_id, None, "Remote start: charging started on already connected EVSE {}", evse_id)
 
                 # Salva lo stato
-                from .state import save_state
-                save_state(self)
+                from .state import mark_dirty
+                mark_dirty(self)
                 return
             else:
                 # È già un remote start pending, ignora
-                self.history.append(
-                    f"[{datetime.now(timezone.utc).isoformat()}] Remote start ignored: EVSE {evse_id} already has a pending remote start"
-                )
+                self.history.record(EVENT, "RequestStartTransaction", evse_id, None, "Remote start ignored: EVSE {} already has a pending remote start", evse_id)
                 return
 
         # Nessuna transazione esistente: crea una nuova transazione con stato pending_remote_start
@@ -133,41 +128,28 @@ class CoreHandlers:
 
         if response is not None:
             # Salva la transazione con flag che indica che è in attesa del plug-in
-            self.transactions[evse_id] = {
-                "transaction_id": tx_id,
-                "seq_no": 0,
-                "energy": 0,
-                "evse_id": evse_id,
-                "pending_remote_start": True,
-                "remote_start_id": remote_start_id,
-                "id_token": id_token
-            }
-
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] Remote start transaction {tx_id} created for EVSE {evse_id}, waiting for plug-in"
+            self.transactions[evse_id] = Transaction(
+                tx_id,
+                evse_id,
+                id_token=id_token,
+                remote_start_id=remote_start_id,
+                pending_remote_start=True,
             )
 
+            self.history.record(EVENT, "RequestStartTransaction", evse_id, tx_id, "Remote start transaction {} created for EVSE {}, waiting for plug-in", tx_id, evse_id)
+
             # Salva lo stato
-            from .state import save_state
-            save_state(self)
+            from .state import mark_dirty
+            mark_dirty(self)
 
     @on(Action.request_stop_transaction)
     async def on_request_stop_transaction(self, transaction_id: str, **kwargs):
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << RequestStopTransaction (TxId: {transaction_id})"
-        )
+        self.history.record(RECEIVED, "RequestStopTransaction", None, transaction_id, "TxId: {}", transaction_id)
         
         # Trova la transazione corrispondente
-        evse_id = None
-        for eid, tx in self.transactions.items():
-            if tx["transaction_id"] == transaction_id:
-                evse_id = eid
-                break
-        
+        evse_id = self.transactions.evse_of(transaction_id)
         if evse_id is None:
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] RequestStopTransaction rejected: transaction {transaction_id} not found"
-            )
+            self.history.record(EVENT, "RequestStopTransaction", None, transaction_id, "RequestStopTransaction rejected: transaction {} not found", transaction_id)
             return call_result.RequestStopTransaction(
                 status=RequestStartStopStatusEnumType.rejected
             )
@@ -175,10 +157,8 @@ class CoreHandlers:
         tx = self.transactions[evse_id]
         
         # Verifica se sta caricando
-        if "meter_task" not in tx:
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] RequestStopTransaction: transaction {transaction_id} is not charging"
-            )
+        if tx.meter_task is None:
+            self.history.record(EVENT, "RequestStopTransaction", None, transaction_id, "RequestStopTransaction: transaction {} is not charging", transaction_id)
             return call_result.RequestStopTransaction(
                 status=RequestStartStopStatusEnumType.accepted
             )
@@ -194,91 +174,153 @@ class CoreHandlers:
         """Gestisce lo stop della ricarica per RequestStopTransaction."""
         tx = self.transactions[evse_id]
         
-        # Cancella il meter task
-        if "meter_task" in tx:
-            tx["meter_task"].cancel()
-            try:
-                await tx["meter_task"]
-            except asyncio.CancelledError:
-                pass
-            del tx["meter_task"]
+        # Ferma l'invio dei meter values
+        meter_value = self.stop_metering(evse_id)
         
         # Invia TransactionEvent updated con trigger remote_stop
-        tx["seq_no"] += 1
+        tx.seq_no += 1
         await self.send_transaction_event(
             event_type=TransactionEventEnumType.updated,
             transaction_id=transaction_id,
             trigger_reason=TriggerReasonEnumType.remote_stop,
-            seq_no=tx["seq_no"],
+            seq_no=tx.seq_no,
             evse_id=evse_id,
-            connector_id=1
+            connector_id=1,
+            meter_value=meter_value,
         )
         
         # Cambia lo stato a occupied (cavo ancora connesso ma non in carica)
-        self.evses[evse_id]["status"] = ConnectorStatusEnumType.occupied
+        self.evses[evse_id].status = ConnectorStatusEnumType.occupied
         await self.send_status_notification(evse_id, ConnectorStatusEnumType.occupied)
         
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] Remote stop: charging stopped for transaction {transaction_id} on EVSE {evse_id}"
-        )
+        self.history.record(EVENT, "RequestStopTransaction", evse_id, transaction_id, "Remote stop: charging stopped for transaction {} on EVSE {}", transaction_id, evse_id)
         
         # Salva lo stato
-        from .state import save_state
-        save_state(self)
+        from .state import mark_dirty
+        mark_dirty(self)
+
+    @on(Action.get_transaction_status)
+    async def on_get_transaction_status(self, transaction_id: str = None, **kwargs):
+        self.history.record(RECEIVED, "GetTransactionStatus", None, transaction_id, "TxId: {}", transaction_id)
+        if transaction_id is None:
+            return call_result.GetTransactionStatus(messages_in_queue=self.offline_queue.has_messages())
+        return call_result.GetTransactionStatus(
+            messages_in_queue=self.offline_queue.has_messages(transaction_id),
+            ongoing_indicator=self.transactions.evse_of(transaction_id) is not None,
+        )
 
     @on(Action.change_availability)
     async def on_change_availability(self, **kwargs):
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << ChangeAvailability"
-        )
+        self.history.record(RECEIVED, "ChangeAvailability")
         return call_result.ChangeAvailability(status=GenericStatusEnumType.accepted)
 
     @on(Action.unlock_connector)
     async def on_unlock_connector(self, **kwargs):
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << UnlockConnector"
-        )
+        self.history.record(RECEIVED, "UnlockConnector")
         return call_result.UnlockConnector(status=UnlockStatusEnumType.unlocked)
 
     @on(Action.set_variables)
     async def on_set_variables(self, set_variable_data: list, **kwargs):
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] << SetVariables")
+        self.history.record(RECEIVED, "SetVariables", None, None, "{} variables", len(set_variable_data))
         response_payload = []
+        changed = False
         for item in set_variable_data:
+            key = request_key(item["component"], item["variable"], item.get("attribute_type"))
+            status = self.device_model.set(key, item["attribute_value"])
+            if status == SetVariableStatusEnumType.accepted:
+                changed = True
+                if key == TX_UPDATED_INTERVAL:
+                    self._apply_tx_updated_interval()
             response_payload.append(
                 {
-                    "attribute_status": SetVariableStatusEnumType.accepted,
+                    "attribute_type": key[3],
+                    "attribute_status": status,
                     "component": item["component"],
                     "variable": item["variable"],
                 }
             )
+        if changed:
+            from .state import mark_dirty
+            mark_dirty(self)
         return call_result.SetVariables(set_variable_result=response_payload)
 
+    def _apply_tx_updated_interval(self):
+        # Charging transactions tick at the new interval from their next tick
+        interval = self.device_model.number(TX_UPDATED_INTERVAL)
+        if interval is None or interval <= 0:
+            return
+        for transaction in self.transactions.values():
+            if transaction.meter_task is not None:
+                transaction.meter_task.interval = interval
+
     @on(Action.trigger_message)
     async def on_trigger_message(self, **kwargs):
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] << TriggerMessage")
+        self.history.record(RECEIVED, "TriggerMessage")
         return call_result.TriggerMessage(status=TriggerMessageStatusEnumType.accepted)
 
     @on(Action.get_variables)
     async def on_get_variables(self, get_variable_data: list, **kwargs):
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] << GetVariables")
+        self.history.record(RECEIVED, "GetVariables", None, None, "{} variables", len(get_variable_data))
         response_payload = []
         for item in get_variable_data:
-            response_payload.append(
-                {
-                    "attribute_status": GetVariableStatusEnumType.unknown_component,
-                    "component": item["component"],
-                    "variable": item["variable"],
-                }
-            )
+            key = request_key(item["component"], item["variable"], item.get("attribute_type"))
+            status, value = self.device_model.get(key)
+            result = {
+                "attribute_type": key[3],
+                "attribute_status": status,
+                "component": item["component"],
+                "variable": item["variable"],
+            }
+            if value is not None:
+                result["attribute_value"] = value
+            response_payload.append(result)
         return call_result.GetVariables(get_variable_result=response_payload)
 
+    @on(Action.get_base_report)
+    async def on_get_base_report(self, request_id: int, report_base: str, **kwargs):
+        self.history.record(RECEIVED, "GetBaseReport", None, None, "RequestId: {}, {}", request_id, report_base)
+        status = self._start_report(request_id, self.device_model.select(report_base=report_base))
+        return call_result.GetBaseReport(status=status)
+
+    @on(Action.get_report)
+    async def on_get_report(self, request_id: int, component_variable: list = None, component_criteria: list = None, **kwargs):
+        self.history.record(RECEIVED, "GetReport", None, None, "RequestId: {}", request_id)
+        selected = self.device_model.select(component_criteria=component_criteria, component_variables=component_variable)
+        status = self._start_report(request_id, selected)
+        return call_result.GetReport(status=status)
+
+    def _start_report(self, request_id, selected):
+        # Pages the report lazily: only the part being sent and the next one are built
+        parts = self.device_model.report_parts(selected, self.report_part_size)
+        first = next(parts, None)
+        if first is None:
+            return GenericDeviceModelStatusEnumType.empty_result_set
+        self._spawn_report(self._notify_report(request_id, first, parts))
+        return GenericDeviceModelStatusEnumType.accepted
+
+    def _spawn_report(self, coroutine):
+        # Reports are sent after the response: keep their tasks referenced until done
+        task = asyncio.create_task(coroutine)
+        self._report_tasks.add(task)
+        task.add_done_callback(self._report_tasks.discard)
+
+    async def _notify_report(self, request_id, part, parts):
+        # One NotifyReport per part, sent after the response; tbc on all but the last
+        generated_at = get_clock().timestamp()
+        seq_no = 0
+        try:
+            while part is not None:
+                following = next(parts, None)
+                await self.send_notify_report(request_id, generated_at, seq_no, part, tbc=following is not None)
+                part = following
+                seq_no += 1
+        except Exception as e:
+            logging.error(f"NotifyReport {request_id} stopped at part {seq_no}: {e!r}")
+
     @on(Action.set_charging_profile)
     async def on_set_charging_profile(self, evse_id: int, charging_profile: dict, **kwargs):
         profile_id = charging_profile.get("id", "unknown")
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << SetChargingProfile (EVSE: {evse_id}, Profile ID: {profile_id})"
-        )
+        self.history.record(RECEIVED, "SetChargingProfile", evse_id, None, "EVSE: {}, Profile ID: {}", evse_id, profile_id)
 
         # Basic validation
         if not charging_profile:
@@ -288,57 +330,70 @@ class CoreHandlers:
 
         # Validate required fields
         if "id" not in charging_profile:
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] SetChargingProfile rejected: missing 'id'"
-            )
+            self.history.record(EVENT, "SetChargingProfile", None, None, "SetChargingProfile rejected: missing 'id'")
             return call_result.SetChargingProfile(
                 status=ChargingProfileStatusEnumType.rejected
             )
 
         if "charging_schedule" not in charging_profile:
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] SetChargingProfile rejected: missing 'charging_schedule'"
-            )
+            self.history.record(EVENT, "SetChargingProfile", None, None, "SetChargingProfile rejected: missing 'charging_schedule'")
             return call_result.SetChargingProfile(
                 status=ChargingProfileStatusEnumType.rejected
             )
 
         schedule_list = charging_profile["charging_schedule"]
         if not isinstance(schedule_list, list) or len(schedule_list) == 0:
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] SetChargingProfile rejected: charging_schedule must be a non-empty list"
-            )
+            self.history.record(EVENT, "SetChargingProfile", None, None, "SetChargingProfile rejected: charging_schedule must be a non-empty list")
             return call_result.SetChargingProfile(
                 status=ChargingProfileStatusEnumType.rejected
             )
 
         schedule = schedule_list[0]
         if "charging_rate_unit" not in schedule or "charging_schedule_period" not in schedule:
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] SetChargingProfile rejected: invalid charging_schedule"
-            )
+            self.history.record(EVENT, "SetChargingProfile", None, None, "SetChargingProfile rejected: invalid charging_schedule")
             return call_result.SetChargingProfile(
                 status=ChargingProfileStatusEnumType.rejected
             )
 
-        # Check if EVSE exists
-        if evse_id not in self.evses:
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] SetChargingProfile rejected: EVSE {evse_id} not found"
+        # Check if EVSE exists (0 is the whole station)
+        if evse_id != 0 and evse_id not in self.evses:
+            self.history.record(EVENT, "SetChargingProfile", evse_id, None, "SetChargingProfile rejected: EVSE {} not found", evse_id)
+            return call_result.SetChargingProfile(
+                status=ChargingProfileStatusEnumType.rejected
             )
+
+        purpose = charging_profile.get("charging_profile_purpose")
+        if (purpose == STATION_MAX and evse_id != 0) or (purpose == TX and evse_id == 0):
+            self.history.record(EVENT, "SetChargingProfile", evse_id, None, "SetChargingProfile rejected: {} not allowed on EVSE {}", purpose, evse_id)
             return call_result.SetChargingProfile(
                 status=ChargingProfileStatusEnumType.rejected
             )
 
+        if purpose == TX:
+            # A TxProfile only applies to the transaction running on its EVSE
+            transaction = self.transactions.get(evse_id)
+            transaction_id = charging_profile.get("transaction_id")
+            if transaction is None or transaction_id not in (None, transaction.transaction_id):
+                self.history.record(EVENT, "SetChargingProfile", evse_id, None, "SetChargingProfile rejected: no matching transaction on EVSE {}", evse_id)
+                return call_result.SetChargingProfile(
+                    status=ChargingProfileStatusEnumType.rejected
+                )
+
         # Save the profile
-        self.charging_profiles[evse_id] = charging_profile
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] Charging profile {profile_id} set for EVSE {evse_id}"
-        )
+        try:
+            error = self.charging_profiles.add(evse_id, charging_profile)
+        except (KeyError, TypeError, ValueError) as e:
+            error = f"invalid profile ({e})"
+        if error:
+            self.history.record(EVENT, "SetChargingProfile", None, None, "SetChargingProfile rejected: {}", error)
+            return call_result.SetChargingProfile(
+                status=ChargingProfileStatusEnumType.rejected
+            )
+        self.history.record(EVENT, "SetChargingProfile", evse_id, None, "Charging profile {} set for EVSE {}", profile_id, evse_id)
 
         # Save state
-        from .state import save_state
-        save_state(self)
+        from .state import mark_dirty
+        mark_dirty(self)
 
         return call_result.SetChargingProfile(
             status=ChargingProfileStatusEnumType.accepted
@@ -352,102 +407,128 @@ class CoreHandlers:
         charging_profile: dict = None,
         **kwargs
     ):
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << GetChargingProfiles (EVSE: {evse_id})"
-        )
+        self.history.record(RECEIVED, "GetChargingProfiles", evse_id, None, "EVSE: {}", evse_id)
 
         # Filter profiles based on request criteria
-        if not self.charging_profiles:
+        criteria = charging_profile or {}
+        profiles = self.charging_profiles.find(
+            evse_id=evse_id,
+            purpose=criteria.get("charging_profile_purpose"),
+            stack_level=criteria.get("stack_level"),
+            profile_ids=criteria.get("charging_profile_id"),
+        )
+        # Every profile is installed by the CSMS
+        if "CSO" not in criteria.get("charging_limit_source", ["CSO"]):
+            profiles = []
+        if not profiles:
             return call_result.GetChargingProfiles(
                 status=GetChargingProfileStatusEnumType.no_profiles
             )
 
-        # If evse_id is specified, send only that profile
-        if evse_id is not None:
-            if evse_id not in self.charging_profiles:
-                return call_result.GetChargingProfiles(
-                    status=GetChargingProfileStatusEnumType.no_profiles
-                )
-
-            # Send ReportChargingProfiles with the profile data
-            asyncio.create_task(
-                self.send_report_charging_profiles(
-                    request_id=request_id,
-                    evse_id=evse_id,
-                    charging_profile=self.charging_profiles[evse_id]
-                )
-            )
-
-            return call_result.GetChargingProfiles(
-                status=GetChargingProfileStatusEnumType.accepted
-            )
-
-        # If no evse_id specified, send all profiles
-        for eid, profile in self.charging_profiles.items():
-            asyncio.create_task(
-                self.send_report_charging_profiles(
-                    request_id=request_id,
-                    evse_id=eid,
-                    charging_profile=profile
-                )
-            )
+        # One ReportChargingProfiles per EVSE, sent after the response
+        by_evse = {}
+        for profile in profiles:
+            by_evse.setdefault(profile.evse_id, []).append(profile.data)
+        self._spawn_report(self._report_charging_profiles(request_id, by_evse))
 
         return call_result.GetChargingProfiles(
             status=GetChargingProfileStatusEnumType.accepted
         )
 
+    async def _report_charging_profiles(self, request_id, by_evse):
+        reports = list(by_evse.items())
+        try:
+            for index, (evse_id, profiles) in enumerate(reports):
+                await self.send_report_charging_profiles(
+                    request_id=request_id,
+                    evse_id=evse_id,
+                    charging_profiles=profiles,
+                    tbc=index < len(reports) - 1,
+                )
+        except Exception as e:
+            logging.error(f"ReportChargingProfiles {request_id} stopped: {e!r}")
+
     @on(Action.clear_charging_profile)
-    async def on_clear_charging_profile(self, charging_profile_id: int = None, **kwargs):
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << ClearChargingProfile"
+    async def on_clear_charging_profile(self, charging_profile_id: int = None, charging_profile_criteria: dict = None, **kwargs):
+        self.history.record(RECEIVED, "ClearChargingProfile")
+
+        # Without an id or criteria, every profile is cleared
+        criteria = charging_profile_criteria or {}
+        removed = self.charging_profiles.remove(
+            profile_id=charging_profile_id,
+            evse_id=criteria.get("evse_id"),
+            purpose=criteria.get("charging_profile_purpose"),
+            stack_level=criteria.get("stack_level"),
         )
-
-        if charging_profile_id is None:
-            self.charging_profiles.clear()
+        if not removed:
             return call_result.ClearChargingProfile(
-                status=ClearChargingProfileStatusEnumType.accepted
+                status=ClearChargingProfileStatusEnumType.unknown
             )
 
-        for evse_id, profile in self.charging_profiles.items():
-            if profile.get("id") == charging_profile_id:
-                del self.charging_profiles[evse_id]
-                return call_result.ClearChargingProfile(
-                    status=ClearChargingProfileStatusEnumType.accepted
-                )
-
+        from .state import mark_dirty
+        mark_dirty(self)
         return call_result.ClearChargingProfile(
-            status=ClearChargingProfileStatusEnumType.unknown
+            status=ClearChargingProfileStatusEnumType.accepted
+        )
+
+    @on(Action.get_composite_schedule)
+    async def on_get_composite_schedule(self, duration: int, evse_id: int, charging_rate_unit: str = None, **kwargs):
+        self.history.record(RECEIVED, "GetCompositeSchedule", evse_id, None, "EVSE: {}, Duration: {}", evse_id, duration)
+        if evse_id != 0 and evse_id not in self.evses:
+            return call_result.GetCompositeSchedule(status=GenericStatusEnumType.rejected)
+
+        unit = charging_rate_unit or "W"
+        start = get_clock().now()
+        periods = self.charging_profiles.composite(
+            evse_id, self.transactions.get(evse_id), start.timestamp(), duration
+        )
+        return call_result.GetCompositeSchedule(
+            status=GenericStatusEnumType.accepted,
+            schedule={
+                "evse_id": evse_id,
+                "duration": duration,
+                "schedule_start": start.isoformat(),
+                "charging_rate_unit": unit,
+                "charging_schedule_period": [
+                    {
+                        "start_period": offset,
+                        "limit": limit if unit == "W" else round(limit / (VOLTAGE * phases), 1),
+                        "number_phases": phases,
+                    }
+                    for offset, limit, phases in periods
+                ],
+            },
         )
 
     async def _firmware_update_process(self, request_id: int):
-        await asyncio.sleep(2) # Simulate time to start download
+        await get_clock().sleep(2) # Simulate time to start download
         await self.send_firmware_status_notification(FirmwareStatusEnumType.downloading, request_id)
-        await asyncio.sleep(10) # Simulate download time
+        await get_clock().sleep(10) # Simulate download time
         await self.send_firmware_status_notification(FirmwareStatusEnumType.downloaded, request_id)
-        await asyncio.sleep(2)
+        await get_clock().sleep(2)
         await self.send_firmware_status_notification(FirmwareStatusEnumType.installing, request_id)
-        await asyncio.sleep(10) # Simulate installation time
+        await get_clock().sleep(10) # Simulate installation time
         await self.send_firmware_status_notification(FirmwareStatusEnumType.installed, request_id)
 
     @on(Action.update_firmware)
     async def on_update_firmware(self, request_id: int, **kwargs):
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] << UpdateFirmware")
+        self.history.record(RECEIVED, "UpdateFirmware")
         asyncio.create_task(self._firmware_update_process(request_id))
         return call_result.UpdateFirmware(status=UpdateFirmwareStatusEnumType.accepted)
 
     async def _log_upload_process(self, request_id: int):
-        await asyncio.sleep(1) # Simulate time to start upload
+        await get_clock().sleep(1) # Simulate time to start upload
         await self.send_log_status_notification(UploadLogStatusEnumType.uploading, request_id)
-        await asyncio.sleep(5)  # Simulate upload time
+        await get_clock().sleep(5)  # Simulate upload time
         await self.send_log_status_notification(UploadLogStatusEnumType.uploaded, request_id)
 
     @on(Action.get_log)
     async def on_get_log(self, log_type: str, request_id: int, **kwargs):
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] << GetLog")
+        self.history.record(RECEIVED, "GetLog")
         asyncio.create_task(self._log_upload_process(request_id))
         return call_result.GetLog(status=LogStatusEnumType.accepted)
 
     @on(Action.data_transfer)
     async def on_data_transfer(self, vendor_id: str, **kwargs):
-        self.history.append(f"[{datetime.now(timezone.utc).isoformat()}] << DataTransfer")
+        self.history.record(RECEIVED, "DataTransfer")
         return call_result.DataTransfer(status=DataTransferStatusEnumType.accepted)
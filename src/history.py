@@ -0,0 +1,151 @@
+"""Event history of each Charge Point: a ring buffer of structured entries, formatted only when read."""
+import gzip
+import json
+import weakref
+from datetime import datetime, timezone
+
+from .clock import get_clock
+
+# Directions of a history entry
+SENT = ">>"
+RECEIVED = "<<"
+# Something the station did or decided, rather than a message
+EVENT = "--"
+
+DEFAULT_CAPACITY = 50
+
+
+def clock_offset():
+    """Returns what to add to a clock time to get the simulated epoch seconds."""
+    clock = get_clock()
+    return clock.now().timestamp() - clock.time()
+
+
+def describe(entry):
+    """Returns the message of an entry, formatting its arguments."""
+    _, _, _, _, _, message, args = entry
+    if message is None:
+        return ""
+    return message.format(*args) if args else message
+
+
+def format_entry(entry, offset):
+    """Formats an entry as a log line, as shown by the REPL `logs` command."""
+    moment, direction, action = entry[:3]
+    timestamp = datetime.fromtimestamp(moment + offset, timezone.utc).isoformat()
+    text = describe(entry)
+    if direction == EVENT:
+        return f"[{timestamp}] {text}"
+    if text:
+        return f"[{timestamp}] {direction} {action} ({text})"
+    return f"[{timestamp}] {direction} {action}"
+
+
+class History:
+    """
+    The last `capacity` events of a Charge Point, in a preallocated ring
+    buffer of (clock time, direction, action, EVSE id, transaction id,
+    message, args) tuples. Recording formats nothing: `message` is a
+    str.format template applied to `args` only when the history is read.
+    Entries pushed out of a full buffer go to the spill file, if any (see
+    `configure_history`).
+    """
+
+    __slots__ = ("charge_point_id", "_entries", "_next", "__weakref__")
+
+    def __init__(self, charge_point_id, capacity=None):
+        self.charge_point_id = charge_point_id
+        self._entries = [None] * (_capacity if capacity is None else capacity)
+        self._next = 0
+        if _spill is not None:
+            _spill.track(self)
+
+    def record(self, direction, action, evse_id=None, transaction_id=None, message=None, *args):
+        entries = self._entries
+        if not entries:
+            return
+        index = self._next
+        if _spill is not None and entries[index] is not None:
+            _spill.write(self.charge_point_id, entries[index])
+        entries[index] = (get_clock().time(), direction, action, evse_id, transaction_id, message, args)
+        self._next = (index + 1) % len(entries)
+
+    def entries(self):
+        """Returns the entries, oldest first."""
+        ordered = self._entries[self._next:] + self._entries[:self._next]
+        return [entry for entry in ordered if entry is not None]
+
+    def records(self):
+        """Returns the entries as dicts, oldest first, for exporters."""
+        offset = clock_offset()
+        return [entry_record(self.charge_point_id, entry, offset) for entry in self.entries()]
+
+    def __len__(self):
+        return sum(1 for entry in self._entries if entry is not None)
+
+    def __iter__(self):
+        # Log lines, oldest first
+        offset = clock_offset()
+        return iter([format_entry(entry, offset) for entry in self.entries()])
+
+
+def entry_record(charge_point_id, entry, offset):
+    moment, direction, action, evse_id, transaction_id = entry[:5]
+    return {
+        "timestamp": datetime.fromtimestamp(moment + offset, timezone.utc).isoformat(),
+        "cp_id": charge_point_id,
+        "direction": direction,
+        "action": action,
+        "evse_id": evse_id,
+        "transaction_id": transaction_id,
+        "message": describe(entry),
+    }
+
+
+class HistorySpill:
+    """
+    Gzip-compressed JSON lines file receiving the history entries that fall
+    out of the ring buffers, and every remaining entry on close, for
+    post-mortems. Opening an existing file appends a new gzip member.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._histories = weakref.WeakSet()
+
+    def track(self, history):
+        self._histories.add(history)
+
+    def write(self, charge_point_id, entry):
+        record = entry_record(charge_point_id, entry, clock_offset())
+        self._file.write(json.dumps(record, default=str) + "\n")
+
+    def close(self):
+        for history in list(self._histories):
+            for entry in history.entries():
+                self.write(history.charge_point_id, entry)
+        self._file.close()
+
+
+_capacity = DEFAULT_CAPACITY
+_spill = None
+
+
+def configure_history(capacity=DEFAULT_CAPACITY, spill_path=None):
+    """Sets the capacity of new histories and the file evicted entries spill to (None: dropped)."""
+    global _capacity, _spill
+    if capacity < 0:
+        raise ValueError("The history capacity cannot be negative")
+    close_history()
+    _capacity = capacity
+    if spill_path:
+        _spill = HistorySpill(spill_path)
+
+
+def close_history():
+    """Spills what the histories still hold and closes the spill file, if open."""
+    global _spill
+    if _spill is not None:
+        spill, _spill = _spill, None
+        spill.close()
@@ -0,0 +1,159 @@
+"""Open-loop load: EV sessions arriving on free EVSEs as a Poisson process."""
+import asyncio
+import logging
+import random
+import time
+
+from ocpp.v201.enums import ConnectorStatusEnumType
+
+from .clock import get_clock
+from .metrics import get_metrics
+from .repl import handlers
+from .scenario import sample
+
+# Random EVSEs tried per arrival before it counts as finding none free
+MAX_PROBES = 64
+
+
+class SessionGenerator:
+    """
+    Starts EV sessions at `rate` per second on average, with exponential
+    inter-arrival times, whatever the CSMS response times: a slow CSMS
+    piles up sessions instead of slowing the arrivals down.
+
+    Each session picks a random free EVSE of a booted station, then
+    authorizes, plugs in and charges. It charges at up to `power` W until
+    `energy` Wh are delivered, stays plugged in until `length` seconds have
+    passed, and departs. `length`, `energy` and `power` are constants or
+    distributions (see `scenario.sample`). An arrival that finds no free
+    EVSE is dropped, like a driver driving on. A session whose charging the
+    CSMS stopped first (RequestStopTransaction, or a rejected
+    TransactionEvent) counts as stopped rather than completed or failed.
+    """
+
+    def __init__(self, rate, length=1800.0, energy=20000.0, power=11000.0, seed=None):
+        if rate <= 0:
+            raise ValueError("The session rate must be positive")
+        self.rate = rate
+        self.length = length
+        self.energy = energy
+        self.power = power
+        self._rng = random.Random(seed)
+        self._stations = []
+        self._busy = set()
+        self._tasks = set()
+        self.arrived = 0
+        self.dropped = 0
+        self.completed = 0
+        self.stopped = 0
+        self.failed = 0
+
+    @property
+    def active(self):
+        return len(self._tasks)
+
+    def snapshot(self):
+        return {
+            "sessions_arrived": self.arrived,
+            "sessions_active": self.active,
+            "sessions_completed": self.completed,
+            "sessions_stopped": self.stopped,
+            "sessions_failed": self.failed,
+            "sessions_dropped": self.dropped,
+        }
+
+    async def run(self, stations):
+        """Generates sessions on the Charge Points of `stations` (id: ChargePoint) until cancelled."""
+        clock = get_clock()
+        next_arrival = clock.time()
+        try:
+            while True:
+                # Scheduled on absolute times: a late loop catches up instead of lowering the rate
+                next_arrival += self._rng.expovariate(self.rate)
+                delay = next_arrival - clock.time()
+                if delay > 0:
+                    await clock.sleep(delay)
+                self.arrived += 1
+                slot = self._pick_free_evse(stations)
+                if slot is None:
+                    self.dropped += 1
+                    continue
+                task = asyncio.create_task(self._session(*slot))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+    def _pick_free_evse(self, stations):
+        if len(self._stations) != len(stations):
+            # Stations only join the fleet, so the count tells when to refresh
+            self._stations = list(stations.values())
+        if not self._stations:
+            return None
+        for _ in range(MAX_PROBES):
+            charge_point = self._rng.choice(self._stations)
+            if not charge_point.boot_accepted.is_set():
+                continue
+            evse_id = self._rng.randint(1, len(charge_point.evses))
+            if (
+                evse_id in charge_point.transactions
+                or (charge_point.id, evse_id) in self._busy
+                or charge_point.evses[evse_id].status != ConnectorStatusEnumType.available
+            ):
+                continue
+            return charge_point, evse_id
+        return None
+
+    async def _session(self, charge_point, evse_id):
+        clock = get_clock()
+        metrics = get_metrics()
+        key = (charge_point.id, evse_id)
+        self._busy.add(key)
+        length = sample(self.length, self._rng)
+        energy = sample(self.energy, self._rng)
+        power = sample(self.power, self._rng)
+        started = time.perf_counter()
+        try:
+            await handlers.authorize(charge_point, f"LOAD-{charge_point.id}-{evse_id}")
+            await handlers.connect(charge_point, evse_id)
+            await handlers.charge(charge_point, evse_id)
+            transaction = charge_point.transactions[evse_id]
+            transaction.ev_power = power
+            # From the arrival, so time spent queued behind a slow CSMS counts
+            metrics.observe("session", "start", time.perf_counter() - started)
+
+            charging = min(length, energy / power * 3600 if power else length)
+            await clock.sleep(charging)
+            # The CSMS may have stopped the charging, or ended the transaction, meanwhile
+            stopped = charge_point.transactions.get(evse_id) is not transaction or transaction.meter_task is None
+            if not stopped:
+                await handlers.stop_charge(charge_point, evse_id)
+            await clock.sleep(length - charging)
+            await handlers.disconnect(charge_point, evse_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            metrics.record("session", "total", "failed", time.perf_counter() - started)
+            logging.info(f"{charge_point.id}: session on EVSE {evse_id} failed: {e!r}")
+            await self._release(charge_point, evse_id)
+        else:
+            if stopped:
+                self.stopped += 1
+                metrics.record("session", "total", "stopped", time.perf_counter() - started)
+            else:
+                self.completed += 1
+                metrics.record("session", "total", "ok", time.perf_counter() - started)
+        finally:
+            self._busy.discard(key)
+
+    @staticmethod
+    async def _release(charge_point, evse_id):
+        """Ends what is left of a failed session, so the EVSE becomes free again."""
+        if evse_id not in charge_point.transactions:
+            return
+        try:
+            await handlers.disconnect(charge_point, evse_id)
+        except Exception as e:
+            logging.info(f"{charge_point.id}: could not end the session on EVSE {evse_id}: {e!r}")
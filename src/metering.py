@@ -0,0 +1,211 @@
+"""Process-wide scheduler driving the MeterValues of every charging transaction."""
+import asyncio
+import collections
+import logging
+import math
+import random
+import time
+
+from .clock import get_clock
+
+METER_INTERVAL = 10.0
+
+# Messages carrying the samples: TransactionEvent(Updated) like SampledDataCtrlr,
+# MeterValues like AlignedDataCtrlr, or both
+METER_MESSAGES = ("both", "transaction", "standalone")
+
+
+class MeterHandle:
+    """Registration of one charging transaction in the meter scheduler."""
+
+    __slots__ = ("charge_point", "tx_key", "interval", "tick", "due", "last_sample", "samples", "task", "cancelled")
+
+    def __init__(self, charge_point, tx_key, now, interval=METER_INTERVAL):
+        self.charge_point = charge_point
+        self.tx_key = tx_key
+        self.interval = interval
+        self.tick = 0
+        self.due = now
+        self.last_sample = now
+        # Samples taken but not sent yet, until a batch is complete
+        self.samples = []
+        self.task = None
+        self.cancelled = False
+
+    def cancel(self):
+        """Stops the meter ticks, cancelling the one in flight (if any)."""
+        self.cancelled = True
+        if self.task is not None and not self.task.done() and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class MeterScheduler:
+    """
+    Hashed timing wheel owning the meter ticks of every active transaction.
+
+    A single task advances the wheel every `resolution` seconds of the
+    process clock (see `clock`), instead of one sleeping task per
+    transaction. Each transaction fires every
+    `interval` seconds, unless registered with its own, plus a uniform random `jitter`. The first tick is
+    either spread uniformly over the interval ("spread": smooth load) or
+    aligned on interval boundaries ("aligned": all transactions tick
+    together on the boundaries of the simulated wall clock, like
+    AlignedDataCtrlr, for deliberately bursty load). With `rate`, at most that many
+    ticks per real second are dispatched, whatever the clock speed, to
+    protect the CSMS; the rest wait in a FIFO backlog.
+
+    Every tick takes one energy sample. Once `batch` samples are taken,
+    they are sent together in the `messages` of the transaction: its
+    TransactionEvent(Updated), a standalone MeterValues, or both.
+    """
+
+    def __init__(self, interval=METER_INTERVAL, jitter=0.0, phase="spread", rate=0, messages="both", batch=1, resolution=0.1, wheel_size=1024, seed=None):
+        if phase not in ("spread", "aligned"):
+            raise ValueError(f"Unknown meter phase '{phase}'")
+        if messages not in METER_MESSAGES:
+            raise ValueError(f"Unknown meter messages '{messages}'")
+        if batch < 1:
+            raise ValueError("The meter batch must hold at least one sample")
+        if interval <= 0:
+            raise ValueError("The meter interval must be positive")
+        self.interval = interval
+        self.jitter = jitter
+        self.phase = phase
+        self.rate = rate
+        self.messages = messages
+        self.batch = batch
+        self.resolution = resolution
+        self._wheel = [[] for _ in range(wheel_size)]
+        self._backlog = collections.deque()
+        self._rng = random.Random(seed)
+        self._tokens = float(rate)
+        self._origin = None
+        self._cursor = 0
+        self._task = None
+        self.active = 0
+        self.dispatched = 0
+        self.skipped = 0
+
+    def _now(self):
+        return get_clock().time()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._origin = self._now()
+            self._cursor = 0
+            self._task = asyncio.create_task(self._run())
+
+    def _schedule(self, handle, due):
+        handle.due = due
+        handle.tick = max(math.ceil((due - self._origin) / self.resolution), self._cursor + 1)
+        self._wheel[handle.tick % len(self._wheel)].append(handle)
+
+    def register(self, charge_point, tx_key, interval=None):
+        """
+        Starts the meter ticks of a transaction and returns its handle. The
+        transaction ticks every `interval` seconds (None: the scheduler's);
+        changing `interval` on the handle applies from the next tick.
+        """
+        if interval is None:
+            interval = self.interval
+        elif interval <= 0:
+            raise ValueError("The meter interval must be positive")
+        self._ensure_running()
+        now = self._now()
+        handle = MeterHandle(charge_point, tx_key, now, interval)
+        if self.phase == "spread":
+            first = now + self._rng.uniform(0, handle.interval)
+        else:
+            first = now + handle.interval - get_clock().now().timestamp() % handle.interval
+        self._schedule(handle, first)
+        self.active += 1
+        return handle
+
+    def snapshot(self):
+        return {
+            "meter_active": self.active,
+            "meter_backlog": len(self._backlog),
+            "meter_dispatched": self.dispatched,
+            "meter_skipped": self.skipped,
+        }
+
+    async def _run(self):
+        clock = get_clock()
+        last = time.monotonic()
+        while True:
+            await clock.sleep(self.resolution)
+            now = self._now()
+            self._advance(int((now - self._origin) / self.resolution))
+            if self.rate:
+                real_now = time.monotonic()
+                # Room for at least one token, or rates below 1 would never dispatch
+                self._tokens = min(max(1.0, self.rate), self._tokens + (real_now - last) * self.rate)
+                last = real_now
+            self._dispatch_backlog(now)
+
+    def _advance(self, target_tick):
+        """Moves every handle due up to `target_tick` into the backlog."""
+        size = len(self._wheel)
+        while self._cursor < target_tick:
+            self._cursor += 1
+            index = self._cursor % size
+            slot = self._wheel[index]
+            if not slot:
+                continue
+            pending = []
+            for handle in slot:
+                if handle.cancelled:
+                    self.active -= 1
+                elif handle.tick <= self._cursor:
+                    self._backlog.append(handle)
+                else:
+                    pending.append(handle)
+            self._wheel[index] = pending
+
+    def _dispatch_backlog(self, now):
+        # One timestamp string for every transaction ticking now
+        timestamp = get_clock().timestamp() if self._backlog else None
+        while self._backlog:
+            if self.rate and self._tokens < 1:
+                return
+            handle = self._backlog.popleft()
+            if handle.cancelled:
+                self.active -= 1
+                continue
+            if self.rate:
+                self._tokens -= 1
+
+            if handle.task is not None and not handle.task.done():
+                # The previous tick is still waiting for the CSMS
+                self.skipped += 1
+            else:
+                handle.task = asyncio.create_task(handle.charge_point.meter_tick(handle, timestamp))
+                handle.task.add_done_callback(_log_tick_error)
+                self.dispatched += 1
+
+            jitter = self._rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+            # After a long backlog, restart from now rather than firing to catch up
+            self._schedule(handle, max(handle.due, now - handle.interval) + handle.interval + jitter)
+
+
+def _log_tick_error(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"Meter tick failed: {task.exception()!r}")
+
+
+_scheduler = None
+
+
+def configure_metering(**kwargs):
+    """Replaces the process-wide meter scheduler with one using the given settings."""
+    global _scheduler
+    _scheduler = MeterScheduler(**kwargs)
+    return _scheduler
+
+
+def get_meter_scheduler():
+    """Returns the process-wide meter scheduler, creating a default one if needed."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = MeterScheduler()
+    return _scheduler
@@ -0,0 +1,347 @@
+"""Process-wide latency histograms and counters, with a Prometheus text endpoint."""
+import asyncio
+import bisect
+import json
+import logging
+import threading
+
+
+def hdr_buckets(low=0.0001, high=600.0, sub_buckets=4):
+    """
+    Returns HDR-style bucket bounds: every power of two from `low` up to
+    `high` split into `sub_buckets` linear steps, so the relative error stays
+    the same from sub-millisecond answers to multi-minute timeouts.
+    """
+    bounds = []
+    base = low
+    while base < high:
+        step = base / sub_buckets
+        bounds.extend(float(f"{base + step * index:.6g}") for index in range(1, sub_buckets + 1))
+        base *= 2
+    return tuple(bounds)
+
+
+# Upper bounds in seconds; one more bucket counts everything above the last
+LATENCY_BUCKETS = hdr_buckets()
+
+# family: (label name, histogram name and help, counter name and help) in Prometheus
+FAMILIES = {
+    "phase": (
+        "phase",
+        "ocpp_sim_phase_seconds", "Time from opening the WebSocket to each connection phase.",
+        "ocpp_sim_phases_total", "Connection phases reached.",
+    ),
+    "call": (
+        "action",
+        "ocpp_sim_call_seconds", "Round trip of the CALLs sent to the CSMS.",
+        "ocpp_sim_calls_total", "CALLs sent to the CSMS, by outcome.",
+    ),
+    "handler": (
+        "action",
+        "ocpp_sim_handler_seconds", "Time spent handling the CALLs received from the CSMS.",
+        "ocpp_sim_handled_total", "CALLs received from the CSMS, by outcome.",
+    ),
+    "scenario": (
+        "step",
+        "ocpp_sim_scenario_step_seconds", "Duration of each scenario step.",
+        "ocpp_sim_scenario_steps_total", "Scenario steps run, by outcome.",
+    ),
+    "session": (
+        "stage",
+        "ocpp_sim_session_seconds", "Time from the arrival of an EV session to charging (start) and to its end (total).",
+        "ocpp_sim_sessions_total", "EV sessions ended, by outcome.",
+    ),
+    "queue": (
+        "action",
+        "ocpp_sim_queue_seconds", "Time outbound CALLs waited for the CALL in flight.",
+        "ocpp_sim_queued_total", "Outbound CALLs that had to wait, by outcome (sent, coalesced, dropped).",
+    ),
+    "csms_received": (
+        "action",
+        "ocpp_sim_csms_received_seconds", "Time the mock CSMS took to answer each CALL, response delay included.",
+        "ocpp_sim_csms_received_total", "CALLs received by the mock CSMS, by outcome.",
+    ),
+    "csms_command": (
+        "action",
+        "ocpp_sim_csms_command_seconds", "Round trip of the CALLs the mock CSMS sent to Charge Points.",
+        "ocpp_sim_csms_commands_total", "CALLs sent by the mock CSMS, by outcome.",
+    ),
+}
+
+
+def _family(family):
+    return FAMILIES.get(family) or (
+        "label", f"ocpp_sim_{family}_seconds", f"{family} latency.", f"ocpp_sim_{family}_total", f"{family} count.",
+    )
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram of latencies in seconds.
+
+    Observing costs one bisect, and histograms from several processes merge
+    by adding their bucket counts, so quantiles are estimated by linear
+    interpolation inside the bucket they fall in.
+    """
+
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Returns the estimated `q` quantile (0..1), or None when empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError("Cannot merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "count": self.count, "sum": self.sum, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data["buckets"])
+        histogram.counts = list(data["counts"])
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class Metrics:
+    """
+    Histograms and outcome counters of one process, grouped by family (see
+    FAMILIES) and label (a phase or an OCPP action).
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def histogram(self, family, label):
+        key = (family, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def observe(self, family, label, value):
+        self.histogram(family, label).observe(value)
+
+    def record(self, family, label, outcome, value=None):
+        """Counts one `outcome` (e.g. 'ok', 'call_error', 'timeout') and observes its latency, if any."""
+        key = (family, label, outcome)
+        self.counters[key] = self.counters.get(key, 0) + 1
+        if value is not None:
+            self.histogram(family, label).observe(value)
+
+    def snapshot(self):
+        """
+        Returns {"histograms": {family: {label: histogram dict}},
+        "counters": {family: {label: {outcome: count}}}}, picklable and
+        JSON-serializable.
+        """
+        histograms = {}
+        for (family, label), histogram in self.histograms.items():
+            histograms.setdefault(family, {})[label] = histogram.to_dict()
+        counters = {}
+        for (family, label, outcome), count in self.counters.items():
+            counters.setdefault(family, {}).setdefault(label, {})[outcome] = count
+        return {"histograms": histograms, "counters": counters}
+
+
+def merge_metrics(snapshots):
+    """Merges several `Metrics.snapshot()` results into one."""
+    histograms = {}
+    counters = {}
+    for snapshot in snapshots:
+        for family, labels in snapshot.get("histograms", {}).items():
+            for label, data in labels.items():
+                histogram = histograms.setdefault(family, {}).get(label)
+                if histogram is None:
+                    histograms[family][label] = Histogram.from_dict(data)
+                else:
+                    histogram.merge(Histogram.from_dict(data))
+        for family, labels in snapshot.get("counters", {}).items():
+            for label, outcomes in labels.items():
+                merged = counters.setdefault(family, {}).setdefault(label, {})
+                for outcome, count in outcomes.items():
+                    merged[outcome] = merged.get(outcome, 0) + count
+    return {
+        "histograms": {
+            family: {label: histogram.to_dict() for label, histogram in labels.items()}
+            for family, labels in histograms.items()
+        },
+        "counters": counters,
+    }
+
+
+def format_latencies(snapshot, family):
+    """Formats one family of a snapshot as 'label n=.. p50=..ms p95=..ms p99=..ms max=..ms' lines."""
+    lines = []
+    for label, data in snapshot.get("histograms", {}).get(family, {}).items():
+        histogram = Histogram.from_dict(data)
+        quantiles = " ".join(
+            f"{name}={histogram.quantile(q) * 1000:.0f}ms" for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        )
+        lines.append(f"  {family} {label}: n={histogram.count} {quantiles} max={histogram.max * 1000:.0f}ms")
+    return lines
+
+
+def summarize(snapshot):
+    """
+    Turns a fleet or metrics snapshot into a compact JSON-friendly summary:
+    the plain counters as they are, and per family and label the outcome
+    counts and latency percentiles in milliseconds instead of raw buckets.
+    """
+    summary = {key: value for key, value in snapshot.items() if key != "metrics"}
+    metrics = snapshot.get("metrics", {})
+    counters = metrics.get("counters", {})
+    for family, labels in metrics.get("histograms", {}).items():
+        for label, data in labels.items():
+            histogram = Histogram.from_dict(data)
+            entry = summary.setdefault(family, {}).setdefault(label, {})
+            entry["count"] = histogram.count
+            entry["mean_ms"] = round(histogram.sum / histogram.count * 1000, 3) if histogram.count else None
+            for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+                entry[name] = round(histogram.quantile(q) * 1000, 3) if histogram.count else None
+            entry["max_ms"] = round(histogram.max * 1000, 3)
+    for family, labels in counters.items():
+        for label, outcomes in labels.items():
+            summary.setdefault(family, {}).setdefault(label, {})["outcomes"] = dict(outcomes)
+    return summary
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(snapshot):
+    """
+    Renders a fleet or metrics snapshot in the Prometheus text format: the
+    plain counters as gauges, then a latency histogram and an outcome
+    counter per family.
+    """
+    lines = []
+    for key, value in snapshot.items():
+        if key != "metrics" and isinstance(value, (int, float)):
+            lines.append(f"# TYPE ocpp_sim_{key} gauge")
+            lines.append(f"ocpp_sim_{key} {value}")
+
+    metrics = snapshot.get("metrics", {})
+    for family, labels in metrics.get("histograms", {}).items():
+        label_name, name, help_text, _, _ = _family(family)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for label, data in labels.items():
+            selector = f'{label_name}="{_escape(label)}"'
+            cumulative = 0
+            for bound, count in zip(data["buckets"], data["counts"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{selector},le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{selector},le="+Inf"}} {data["count"]}')
+            lines.append(f"{name}_sum{{{selector}}} {data['sum']}")
+            lines.append(f"{name}_count{{{selector}}} {data['count']}")
+    for family, labels in metrics.get("counters", {}).items():
+        label_name, _, _, name, help_text = _family(family)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for label, outcomes in labels.items():
+            for outcome, count in outcomes.items():
+                lines.append(f'{name}{{{label_name}="{_escape(label)}",outcome="{outcome}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(host, port, provider):
+    """
+    Serves `provider()` (a fleet or metrics snapshot) over HTTP until
+    cancelled: /metrics in the Prometheus text format, /metrics.json as
+    the summary.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers: every request is answered the same way
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4"
+                body = render_prometheus(provider()).encode()
+            elif path == "/metrics.json":
+                status, content_type = "200 OK", "application/json"
+                body = json.dumps(summarize(provider())).encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
+
+
+def serve_metrics_in_thread(host, port, provider):
+    """Runs `serve_metrics` on its own event loop in a daemon thread, for processes without a loop."""
+    thread = threading.Thread(
+        target=asyncio.run,
+        args=(serve_metrics(host, port, provider),),
+        name="metrics-server",
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
+_metrics = None
+
+
+def get_metrics():
+    """Returns the process-wide metrics, creating them if needed."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def reset_metrics():
+    """Discards the process-wide metrics, e.g. between benchmark runs."""
+    global _metrics
+    _metrics = None
@@ -0,0 +1,76 @@
+"""Slotted models of the EVSE and transaction state of a Charge Point."""
+from ocpp.v201.enums import ConnectorStatusEnumType
+
+# Every EVSE has a single connector
+CONNECTOR_ID = 1
+
+
+class Evse:
+    """An EVSE and the status of its connector."""
+
+    __slots__ = ("status",)
+
+    def __init__(self, status=ConnectorStatusEnumType.available):
+        self.status = status
+
+    def __repr__(self):
+        return f"Evse(status={self.status.value})"
+
+    def to_record(self):
+        return {"status": self.status.value}
+
+    @classmethod
+    def from_record(cls, record):
+        if "status" in record:
+            return cls(ConnectorStatusEnumType(record["status"]))
+        # Migration from old connector-based structure
+        first_connector = next(iter(record["connectors"].values()))
+        return cls(ConnectorStatusEnumType(first_connector["status"]))
+
+
+class Transaction:
+    """
+    A transaction on an EVSE. `meter_task` is the meter scheduler handle
+    while charging; `is_charging` is what gets persisted, so charging
+    resumes after a restart.
+    """
+
+    __slots__ = ("transaction_id", "evse_id", "seq_no", "energy", "id_token", "remote_start_id",
+                 "pending_remote_start", "charging_since", "ev_power", "is_charging", "meter_task")
+
+    # Fields saved with the state, in record order
+    PERSISTED = ("transaction_id", "evse_id", "seq_no", "energy", "id_token", "remote_start_id",
+                 "pending_remote_start", "charging_since", "ev_power", "is_charging")
+
+    def __init__(self, transaction_id=None, evse_id=None, seq_no=0, energy=0, id_token=None, remote_start_id=None,
+                 pending_remote_start=False, charging_since=None, ev_power=None, is_charging=False):
+        self.transaction_id = transaction_id
+        self.evse_id = evse_id
+        self.seq_no = seq_no
+        self.energy = energy
+        self.id_token = id_token
+        self.remote_start_id = remote_start_id
+        self.pending_remote_start = pending_remote_start
+        # Timestamp of the first energy transfer, for relative charging profiles
+        self.charging_since = charging_since
+        # Maximum power the EV draws (W), None when unknown
+        self.ev_power = ev_power
+        self.is_charging = is_charging
+        self.meter_task = None
+
+    def __repr__(self):
+        return f"Transaction({self.transaction_id!r}, evse_id={self.evse_id}, seq_no={self.seq_no})"
+
+    def to_record(self):
+        """Returns the persisted fields as a dict, leaving out the unset ones."""
+        record = {}
+        for field in self.PERSISTED:
+            value = getattr(self, field)
+            if value is not None:
+                record[field] = value
+        return record
+
+    @classmethod
+    def from_record(cls, record):
+        # Older records may lack some fields: resume_transactions drops the unusable ones
+        return cls(**{field: record[field] for field in cls.PERSISTED if field in record})
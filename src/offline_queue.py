@@ -0,0 +1,102 @@
+"""Bounded queue of the messages a Charge Point sends while offline."""
+import asyncio
+import collections
+import logging
+
+from .state import mark_dirty
+
+# Actions queued while offline instead of failing; everything else fails fast
+QUEUED_ACTIONS = ("TransactionEvent", "MeterValues")
+
+
+class OfflineQueue:
+    """
+    FIFO of (action, payload) CALLs that could not be sent.
+
+    When full, the oldest message is dropped. Each message has a sequence
+    number, so the state store can persist it as its own record and only
+    write what was added or removed. Queued TransactionEvents are counted
+    per transaction id, for GetTransactionStatus.
+    """
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self._messages = collections.OrderedDict()
+        self._next_seq = 0
+        self._per_transaction = collections.Counter()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __bool__(self):
+        return bool(self._messages)
+
+    def append(self, action, payload):
+        if self.maxlen and len(self._messages) >= self.maxlen:
+            self._forget(*self._messages.popitem(last=False)[1])
+            self.dropped += 1
+        self._messages[self._next_seq] = (action, payload)
+        self._count(action, payload)
+        self._next_seq += 1
+
+    def peek(self):
+        return next(iter(self._messages.items()))
+
+    def remove(self, seq):
+        message = self._messages.pop(seq, None)
+        if message is not None:
+            self._forget(*message)
+
+    def has_messages(self, transaction_id=None):
+        """Whether messages are queued for a transaction, or at all without `transaction_id`."""
+        if transaction_id is None:
+            return bool(self._messages)
+        return self._per_transaction[transaction_id] > 0
+
+    @staticmethod
+    def _transaction_id(action, payload):
+        if action == "TransactionEvent":
+            return payload.get("transactionInfo", {}).get("transactionId")
+        return None
+
+    def _count(self, action, payload):
+        transaction_id = self._transaction_id(action, payload)
+        if transaction_id is not None:
+            self._per_transaction[transaction_id] += 1
+
+    def _forget(self, action, payload):
+        transaction_id = self._transaction_id(action, payload)
+        if transaction_id is not None:
+            self._per_transaction[transaction_id] -= 1
+            if self._per_transaction[transaction_id] <= 0:
+                del self._per_transaction[transaction_id]
+
+    def records(self):
+        """Returns {seq: [action, payload]} for the state store."""
+        return {seq: [action, payload] for seq, (action, payload) in self._messages.items()}
+
+    def restore(self, records):
+        """Reloads the messages saved by `records`, oldest first."""
+        for seq in sorted(records, key=int):
+            action, payload = records[seq]
+            self._messages[int(seq)] = (action, payload)
+            self._count(action, payload)
+        if self._messages:
+            self._next_seq = max(self._messages) + 1
+
+    async def drain(self, charge_point, rate):
+        """
+        Sends the queued messages in order, at most `rate` per second (0: no
+        limit). A message leaves the queue only once the CSMS answered it;
+        a lost connection stops the drain with the rest still queued.
+        """
+        if self._messages:
+            logging.info(f"{charge_point.id}: draining {len(self._messages)} offline messages")
+        while self._messages:
+            seq, (action, payload) = self.peek()
+            await charge_point.send_call(action, payload)
+            self.remove(seq)
+            mark_dirty(charge_point)
+            if rate:
+                await asyncio.sleep(1 / rate)
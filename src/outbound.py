@@ -0,0 +1,174 @@
+"""Per-Charge Point queue of the outbound CALLs waiting for their turn."""
+import asyncio
+import heapq
+import itertools
+import time
+
+from .metrics import get_metrics
+
+# Priorities of the waiting CALLs, lowest first
+TRANSACTION = 0
+METER = 1
+NOTIFICATION = 2
+
+PRIORITIES = {
+    "BootNotification": TRANSACTION,
+    "Authorize": TRANSACTION,
+    "TransactionEvent": TRANSACTION,
+    "MeterValues": METER,
+}
+
+# Stale by the time a newer one is due: dropped rather than waited for when the queue is full
+DROPPABLE = ("MeterValues", "Heartbeat")
+
+METER_VALUES_POLICIES = ("coalesce", "latest", "keep")
+
+DEFAULT_DEPTH = 100
+
+
+class Pending:
+    """A CALL waiting in an OutboundQueue; `future` gets its payload on its turn, or None."""
+
+    __slots__ = ("priority", "seq", "action", "payload", "future", "queued_at")
+
+    def __init__(self, priority, seq, action, payload, future):
+        self.priority = priority
+        self.seq = seq
+        self.action = action
+        self.payload = payload
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundQueue:
+    """
+    Gate of the outbound CALLs of a Charge Point. OCPP-J allows a single
+    CALL in flight, so the others wait here: transaction events first,
+    then meter values, then notifications, in order within a priority.
+
+    A MeterValues arriving while an older one for the same EVSE still
+    waits is merged into it: "coalesce" appends its samples to the waiting
+    message, "latest" replaces the waiting samples, "keep" queues both.
+
+    At most `maxsize` CALLs wait (0: no limit). A CALL arriving at a full
+    queue evicts the oldest waiting MeterValues or Heartbeat. If there is
+    none, it is dropped too if droppable; otherwise its sender waits for
+    room, pushing back on whatever produces the CALLs.
+    """
+
+    def __init__(self, maxsize=DEFAULT_DEPTH, meter_values_policy="coalesce"):
+        if meter_values_policy not in METER_VALUES_POLICIES:
+            raise ValueError(f"Unknown MeterValues policy '{meter_values_policy}'")
+        self.maxsize = maxsize
+        self.meter_values_policy = meter_values_policy
+        self._heap = []
+        self._seq = itertools.count()
+        # The waiting MeterValues of each EVSE, to merge newer ones into
+        self._meter_values = {}
+        # Senders waiting for room in a full queue
+        self._room = []
+        self.busy = False
+        self.depth = 0
+        self.blocked = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    async def acquire(self, action, payload):
+        """
+        Waits for the turn of a CALL and returns the payload to send, or
+        None when the CALL was merged into another one or dropped. A sender
+        given a payload must call `release` once done.
+        """
+        if not self.busy and not self.depth:
+            self.busy = True
+            return payload
+
+        metrics = get_metrics()
+        if action == "MeterValues" and self.meter_values_policy != "keep":
+            waiting = self._meter_values.get(payload.get("evseId"))
+            if waiting is not None:
+                if self.meter_values_policy == "coalesce":
+                    waiting.payload = {**waiting.payload, "meterValue": waiting.payload["meterValue"] + payload["meterValue"]}
+                else:
+                    waiting.payload = payload
+                self.coalesced += 1
+                metrics.record("queue", action, "coalesced")
+                return None
+
+        while self.maxsize and self.depth >= self.maxsize and not self._evict():
+            if action in DROPPABLE:
+                self.dropped += 1
+                metrics.record("queue", action, "dropped")
+                return None
+            room = asyncio.get_running_loop().create_future()
+            self._room.append(room)
+            self.blocked += 1
+            try:
+                await room
+            finally:
+                self.blocked -= 1
+                if room in self._room:
+                    self._room.remove(room)
+
+        if not self.busy and not self.depth:
+            self.busy = True
+            return payload
+        pending = Pending(PRIORITIES.get(action, NOTIFICATION), next(self._seq), action, payload, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, pending)
+        self.depth += 1
+        if action == "MeterValues":
+            self._meter_values.setdefault(payload.get("evseId"), pending)
+        try:
+            payload = await pending.future
+        except asyncio.CancelledError:
+            if not pending.future.cancelled() and pending.future.result() is not None:
+                # Cancelled after being given the turn: pass it on
+                self.release()
+            elif not pending.future.done() or pending.future.cancelled():
+                self._forget(pending)
+            raise
+        if payload is None:
+            metrics.record("queue", action, "dropped")
+        else:
+            metrics.record("queue", action, "sent", time.perf_counter() - pending.queued_at)
+        return payload
+
+    def release(self):
+        """Ends the CALL in flight, giving the turn to the first waiting one."""
+        while self._heap:
+            pending = heapq.heappop(self._heap)
+            if pending.future.done():
+                # Evicted or cancelled while waiting
+                continue
+            self._forget(pending)
+            pending.future.set_result(pending.payload)
+            return
+        self.busy = False
+
+    def _evict(self):
+        # Drops the oldest waiting droppable CALL; returns whether there was one
+        oldest = None
+        for pending in self._heap:
+            if pending.action in DROPPABLE and not pending.future.done() and (oldest is None or pending.seq < oldest.seq):
+                oldest = pending
+        if oldest is None:
+            return False
+        self._forget(oldest)
+        self.dropped += 1
+        oldest.future.set_result(None)
+        return True
+
+    def _forget(self, pending):
+        # Takes a CALL out of the depth and the MeterValues index, and wakes a sender waiting for room
+        self.depth -= 1
+        if pending.action == "MeterValues":
+            evse_id = pending.payload.get("evseId")
+            if self._meter_values.get(evse_id) is pending:
+                del self._meter_values[evse_id]
+        if self._room:
+            room = self._room.pop(0)
+            if not room.done():
+                room.set_result(None)
@@ -1,5 +1,4 @@
 """Handlers for REPL commands."""
-import asyncio
 import uuid
 
 from ocpp.v201.enums import (
@@ -8,30 +7,49 @@ from ocpp.v201.enums import (
     TriggerReasonEnumType,
 )
 
-from src.state import save_state
+from src.models import Transaction
+from src.state import mark_dirty
+
+
+class CommandError(Exception):
+    """A command that cannot run in the current state of the Charge Point."""
+
+
+_echo = True
+
+
+def set_echo(enabled):
+    """Turns the command output on or off; scenarios run the commands silently."""
+    global _echo
+    _echo = enabled
+
+
+def echo(message):
+    if _echo:
+        print(message)
 
 
 async def status(charge_point, *args):
     """Display status of EVSEs."""
-    print("--- EVSE Status ---")
+    echo("--- EVSE Status ---")
     for evse_id, evse_data in charge_point.evses.items():
         tx_info = ""
         if evse_id in charge_point.transactions:
             tx = charge_point.transactions[evse_id]
-            state = "Charging" if tx.get("is_charging") or "meter_task" in tx else "Occupied"
-            tx_info = f" (State: {state}, TxId: {tx['transaction_id']})"
-        print(f"EVSE {evse_id}: {evse_data['status'].value}{tx_info}")
-    print("-------------------")
+            state = "Charging" if tx.is_charging else "Occupied"
+            tx_info = f" (State: {state}, TxId: {tx.transaction_id})"
+        echo(f"EVSE {evse_id}: {evse_data.status.value}{tx_info}")
+    echo("-------------------")
 
 
 async def logs(charge_point, *args):
     """Display event history."""
     filter_term = args[0] if args else None
-    print("--- Event History ---")
+    echo("--- Event History ---")
     for event in charge_point.history:
         if not filter_term or filter_term.lower() in event.lower():
-            print(event)
-    print("---------------------")
+            echo(event)
+    echo("---------------------")
 
 
 async def connect(charge_point, evse_id_str):
@@ -39,59 +57,57 @@ async def connect(charge_point, evse_id_str):
     evse_id = int(evse_id_str)
 
     # Controlla se esiste già una transazione con remote start pending per questo EVSE
-    if evse_id in charge_point.transactions and charge_point.transactions[evse_id].get("pending_remote_start"):
+    if evse_id in charge_point.transactions and charge_point.transactions[evse_id].pending_remote_start:
         tx = charge_point.transactions[evse_id]
 
         # Cambia lo stato dell'EVSE a occupied
-        charge_point.evses[evse_id]["status"] = ConnectorStatusEnumType.occupied
+        charge_point.evses[evse_id].status = ConnectorStatusEnumType.occupied
         await charge_point.send_status_notification(evse_id, ConnectorStatusEnumType.occupied)
 
         # Invia TransactionEvent updated con trigger CablePluggedIn
-        tx["seq_no"] += 1
+        tx.seq_no += 1
         await charge_point.send_transaction_event(
             TransactionEventEnumType.updated,
-            tx["transaction_id"],
+            tx.transaction_id,
             TriggerReasonEnumType.cable_plugged_in,
-            tx["seq_no"],
+            tx.seq_no,
             evse_id=evse_id,
             connector_id=1
         )
 
         # Rimuovi il flag pending
-        del tx["pending_remote_start"]
+        tx.pending_remote_start = False
 
-        print(f"EVSE {evse_id} Occupied, remote start transaction {tx['transaction_id']} now connected.")
+        echo(f"EVSE {evse_id} Occupied, remote start transaction {tx.transaction_id} now connected.")
 
         # Avvia automaticamente la ricarica
-        tx["seq_no"] += 1
+        tx.seq_no += 1
         await charge_point.send_transaction_event(
             TransactionEventEnumType.updated,
-            tx["transaction_id"],
+            tx.transaction_id,
             TriggerReasonEnumType.charging_state_changed,
-            tx["seq_no"],
+            tx.seq_no,
             evse_id=evse_id,
             connector_id=1
         )
 
         # Cambia lo stato a unavailable durante la ricarica
-        charge_point.evses[evse_id]["status"] = ConnectorStatusEnumType.unavailable
+        charge_point.evses[evse_id].status = ConnectorStatusEnumType.unavailable
         await charge_point.send_status_notification(evse_id, ConnectorStatusEnumType.unavailable)
 
-        # Avvia il meter values sender
-        task = asyncio.create_task(charge_point.meter_values_sender(evse_id))
-        tx["meter_task"] = task
+        # Avvia l'invio dei meter values
+        charge_point.start_metering(evse_id)
 
-        print(f"Charging automatically started for transaction {tx['transaction_id']}.")
-        save_state(charge_point)
+        echo(f"Charging automatically started for transaction {tx.transaction_id}.")
+        mark_dirty(charge_point)
 
     else:
         # Comportamento normale: connessione senza remote start
         # Verifica se esiste già una transazione attiva (non pending) su questo EVSE
         if evse_id in charge_point.transactions:
-            print(f"Error: EVSE {evse_id} already has an active transaction.")
-            return
+            raise CommandError(f"EVSE {evse_id} already has an active transaction.")
 
-        charge_point.evses[evse_id]["status"] = ConnectorStatusEnumType.occupied
+        charge_point.evses[evse_id].status = ConnectorStatusEnumType.occupied
         await charge_point.send_status_notification(evse_id, ConnectorStatusEnumType.occupied)
         tx_id = str(uuid.uuid4())
 
@@ -99,102 +115,98 @@ async def connect(charge_point, evse_id_str):
             response = await charge_point.send_transaction_event(
                 TransactionEventEnumType.started, tx_id, TriggerReasonEnumType.cable_plugged_in, 0, evse_id=evse_id, connector_id=1
             )
+            if response is None:
+                raise CommandError("the CSMS rejected the TransactionEvent")
             # Solo se il TransactionEvent viene accettato, salviamo la transazione localmente
-            charge_point.transactions[evse_id] = {
-                "transaction_id": tx_id, "seq_no": 0, "energy": 0, "evse_id": evse_id
-            }
-            print(f"EVSE {evse_id} Occupied, transaction {tx_id} started.")
-            save_state(charge_point)
+            charge_point.transactions[evse_id] = Transaction(tx_id, evse_id)
+            echo(f"EVSE {evse_id} Occupied, transaction {tx_id} started.")
+            mark_dirty(charge_point)
         except Exception as e:
-            print(f"Error starting transaction: {e}")
             # Ripristina lo stato dell'EVSE se la transazione fallisce
-            charge_point.evses[evse_id]["status"] = ConnectorStatusEnumType.available
+            charge_point.evses[evse_id].status = ConnectorStatusEnumType.available
             await charge_point.send_status_notification(evse_id, ConnectorStatusEnumType.available)
+            raise CommandError(f"Error starting transaction: {e}") from e
 
 
 async def authorize(charge_point, id_token):
     """Authorize a transaction."""
     await charge_point.send_authorize(id_token)
-    print(f"Sent Authorize request for id_token: {id_token}")
+    echo(f"Sent Authorize request for id_token: {id_token}")
 
 
 async def event(charge_point, event_type, *description_parts):
     """Send a custom NotifyEvent message."""
     if not description_parts:
-        print("Usage: event <event_type> <description>")
-        return
+        raise CommandError("Usage: event <event_type> <description>")
     description = " ".join(description_parts)
     await charge_point.send_notify_event(event_type, description)
-    print(f"Sent NotifyEvent (Type: {event_type}, Description: '{description}')")
+    echo(f"Sent NotifyEvent (Type: {event_type}, Description: '{description}')")
 
 
 async def charge(charge_point, evse_id_str):
     """Start charging."""
     evse_id = int(evse_id_str)
     if evse_id not in charge_point.transactions:
-        print("Error: No active transaction on this EVSE.")
-        return
+        raise CommandError("No active transaction on this EVSE.")
 
     tx = charge_point.transactions[evse_id]
 
     # Verifica se c'è un remote start pending (non ancora connesso)
-    if tx.get("pending_remote_start"):
-        print("Error: Remote start is pending. Please connect the cable first using 'connect <evse_id>'.")
-        return
+    if tx.pending_remote_start:
+        raise CommandError("Remote start is pending. Please connect the cable first using 'connect <evse_id>'.")
 
     # Verifica se sta già caricando
-    if "meter_task" in tx:
-        print("Error: Already charging.")
-        return
+    if tx.meter_task is not None:
+        raise CommandError("Already charging.")
 
-    tx["seq_no"] += 1
+    tx.seq_no += 1
     await charge_point.send_transaction_event(
-        TransactionEventEnumType.updated, tx["transaction_id"], TriggerReasonEnumType.charging_state_changed, tx["seq_no"], evse_id=evse_id, connector_id=1
+        TransactionEventEnumType.updated, tx.transaction_id, TriggerReasonEnumType.charging_state_changed, tx.seq_no, evse_id=evse_id, connector_id=1
     )
-    task = asyncio.create_task(charge_point.meter_values_sender(evse_id))
-    tx["meter_task"] = task
-    print(f"Charging started for transaction {tx['transaction_id']}.")
-    save_state(charge_point)
+    charge_point.start_metering(evse_id)
+    echo(f"Charging started for transaction {tx.transaction_id}.")
+    mark_dirty(charge_point)
 
 
 async def stop_charge(charge_point, evse_id_str):
     """Stop charging."""
     evse_id = int(evse_id_str)
-    if evse_id in charge_point.transactions and "meter_task" in charge_point.transactions[evse_id]:
+    if evse_id in charge_point.transactions and charge_point.transactions[evse_id].meter_task is not None:
         tx = charge_point.transactions[evse_id]
-        tx["meter_task"].cancel()
-        del tx["meter_task"]
-        tx["seq_no"] += 1
+        meter_value = charge_point.stop_metering(evse_id)
+        tx.seq_no += 1
         await charge_point.send_transaction_event(
-            TransactionEventEnumType.updated, tx["transaction_id"], TriggerReasonEnumType.stop_authorized, tx["seq_no"], evse_id=evse_id, connector_id=1
+            TransactionEventEnumType.updated, tx.transaction_id, TriggerReasonEnumType.stop_authorized, tx.seq_no, evse_id=evse_id, connector_id=1,
+            meter_value=meter_value,
         )
-        print(f"Charging stopped for transaction {tx['transaction_id']}.")
-        save_state(charge_point)
+        echo(f"Charging stopped for transaction {tx.transaction_id}.")
+        mark_dirty(charge_point)
     else:
-        print("Error: Not charging.")
+        raise CommandError("Not charging.")
 
 
 async def disconnect(charge_point, evse_id_str):
     """Disconnect a vehicle."""
     evse_id = int(evse_id_str)
-    tx = charge_point.transactions.pop(evse_id, None)
+    tx = charge_point.transactions.get(evse_id)
     if tx:
-        if "meter_task" in tx:
-            tx["meter_task"].cancel()
-        tx["seq_no"] += 1
+        meter_value = charge_point.stop_metering(evse_id)
+        charge_point.transactions.pop(evse_id)
+        tx.seq_no += 1
         await charge_point.send_transaction_event(
-            TransactionEventEnumType.ended, tx["transaction_id"], TriggerReasonEnumType.ev_departed, tx["seq_no"], evse_id=evse_id, connector_id=1
+            TransactionEventEnumType.ended, tx.transaction_id, TriggerReasonEnumType.ev_departed, tx.seq_no, evse_id=evse_id, connector_id=1,
+            meter_value=meter_value,
         )
-        print(f"Transaction {tx['transaction_id']} ended.")
-    charge_point.evses[evse_id]["status"] = ConnectorStatusEnumType.available
+        echo(f"Transaction {tx.transaction_id} ended.")
+    charge_point.evses[evse_id].status = ConnectorStatusEnumType.available
     await charge_point.send_status_notification(evse_id, ConnectorStatusEnumType.available)
-    print(f"EVSE {evse_id} is now Available.")
-    save_state(charge_point)
+    echo(f"EVSE {evse_id} is now Available.")
+    mark_dirty(charge_point)
 
 
 async def quit(charge_point, *args):
     """Exit the application."""
-    print("Exiting...")
-    save_state(charge_point)
+    echo("Exiting...")
+    mark_dirty(charge_point)
     # This will cause the REPL loop to exit
     raise EOFError
@@ -0,0 +1,244 @@
+"""Replay of captured OCPP traffic against a CSMS, across many simulated Charge Points."""
+import asyncio
+import logging
+import time
+import uuid
+
+import websockets
+from ocpp.messages import MessageType
+
+from .capture import INBOUND, OUTBOUND, read_captures
+from .codec import get_codec
+from .metrics import format_latencies, get_metrics
+
+DEFAULT_ID_TEMPLATE = "{id}-R{copy}"
+# Fields ending with "-<Charge Point id>", like the serialNumber of BootNotification
+ID_SUFFIX_FIELDS = frozenset({"serialNumber"})
+
+
+class StationScript:
+    """
+    What one captured Charge Point did: the CALLs it sent, with their
+    capture times, and how it answered each action the CSMS called.
+    """
+
+    def __init__(self, cp_id):
+        self.cp_id = cp_id
+        # Capture time of its last frame, either way
+        self.end = None
+        self.calls = []
+        self.responses = {}
+        # Unique id of each CALL received from the CSMS, to its action
+        self._inbound = {}
+
+    def add(self, moment, direction, message):
+        self.end = moment
+        message_type = message[0]
+        if direction == OUTBOUND and message_type == MessageType.Call:
+            self.calls.append((moment, message[2], message[3]))
+        elif direction == INBOUND and message_type == MessageType.Call:
+            self._inbound[message[1]] = message[2]
+        elif direction == OUTBOUND and message[1] in self._inbound:
+            # The station's CallResult or CallError to a CSMS CALL
+            self.responses.setdefault(self._inbound.pop(message[1]), []).append(message)
+
+
+def load_scripts(paths):
+    """Reads capture files into a StationScript per Charge Point; returns them and the first capture time."""
+    codec = get_codec()
+    scripts = {}
+    start = None
+    for moment, direction, cp_id, frame in read_captures(paths):
+        if start is None:
+            start = moment
+        script = scripts.get(cp_id)
+        if script is None:
+            script = scripts[cp_id] = StationScript(cp_id)
+        script.add(moment, direction, codec.loads(frame))
+    return scripts, start
+
+
+class Rewriter:
+    """
+    Rewrites captured payloads for a replayed station: its new Charge Point
+    id replaces the captured one in strings equal to it and at the end of
+    the ID_SUFFIX_FIELDS, and each captured transaction id maps to a fresh one.
+    """
+
+    def __init__(self, old_id, new_id):
+        self.old_id = old_id
+        self.new_id = new_id
+        self.transaction_ids = {}
+
+    def __call__(self, value, key=None):
+        if isinstance(value, dict):
+            return {name: self(item, name) for name, item in value.items()}
+        if isinstance(value, list):
+            return [self(item) for item in value]
+        if isinstance(value, str):
+            if key == "transactionId":
+                new = self.transaction_ids.get(value)
+                if new is None:
+                    new = self.transaction_ids[value] = str(uuid.uuid4())
+                return new
+            if value == self.old_id:
+                return self.new_id
+            if key in ID_SUFFIX_FIELDS and value.endswith("-" + self.old_id):
+                return value[:-len(self.old_id)] + self.new_id
+        return value
+
+
+class ReplayStats:
+    """Counters of a replay."""
+
+    def __init__(self):
+        self.stations = 0
+        self.connected = 0
+        self.failed = 0
+        self.calls = 0
+        self.answered = 0
+        self.inbound = 0
+        self.started = time.monotonic()
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "stations": self.stations,
+            "connected": self.connected,
+            "failed": self.failed,
+            "calls": self.calls,
+            "answered": self.answered,
+            "inbound_calls": self.inbound,
+            "calls_per_s": round(self.calls / elapsed) if elapsed else 0,
+            "metrics": get_metrics().snapshot(),
+        }
+
+
+def format_replay(snapshot):
+    counters = " ".join(f"{key}={value}" for key, value in snapshot.items() if key != "metrics")
+    return "\n".join([counters, *format_latencies(snapshot.get("metrics", {}), "call")])
+
+
+async def send_frame(ws, frame):
+    # A bytes codec still sends OCPP-J text frames
+    if isinstance(frame, bytes):
+        await ws.send(frame, text=True)
+    else:
+        await ws.send(frame)
+
+
+async def replay_station(ws_url, station_id, script, start, speed, stats, timeout=30.0):
+    """
+    Replays the CALLs of `script` as `station_id`, each once the previous
+    one is answered (OCPP-J allows one at a time) and no earlier than its
+    capture time divided by `speed` (None: as fast as possible, then
+    disconnect).
+    """
+    codec = get_codec()
+    metrics = get_metrics()
+    rewrite = Rewriter(script.cp_id, station_id)
+    waiting = {}
+    answers = {action: 0 for action in script.responses}
+
+    async def respond(ws, message):
+        # Answer the CSMS like the captured station did, or with a CallError
+        unique_id, action = message[1], message[2]
+        captured = script.responses.get(action)
+        stats.inbound += 1
+        if captured:
+            response = captured[answers[action] % len(captured)]
+            answers[action] += 1
+            await send_frame(ws, codec.encode([response[0], unique_id, *rewrite(response[2:])]))
+        else:
+            await send_frame(ws, codec.encode([MessageType.CallError, unique_id, "NotImplemented", f"{action} was not captured", {}]))
+
+    async def receive(ws):
+        try:
+            async for frame in ws:
+                message = codec.loads(frame)
+                if message[0] == MessageType.Call:
+                    await respond(ws, message)
+                else:
+                    future = waiting.pop(message[1], None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            # Wake up the CALL in flight: the connection is gone
+            for future in waiting.values():
+                if not future.done():
+                    future.set_result(None)
+
+    try:
+        ws = await websockets.connect(f"{ws_url.rstrip('/')}/{station_id}", subprotocols=["ocpp2.0.1"], ping_interval=None)
+    except (OSError, websockets.InvalidHandshake) as e:
+        stats.failed += 1
+        logging.warning(f"{station_id}: could not connect: {e!r}")
+        return
+    stats.connected += 1
+    async with ws:
+        receiver = asyncio.create_task(receive(ws))
+        began = time.monotonic()
+        try:
+            for moment, action, payload in script.calls:
+                if speed is not None:
+                    delay = (moment - start) / speed - (time.monotonic() - began)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                unique_id = str(uuid.uuid4())
+                future = waiting[unique_id] = asyncio.get_running_loop().create_future()
+                sent = time.perf_counter()
+                await send_frame(ws, codec.encode([MessageType.Call, unique_id, action, rewrite(payload)]))
+                stats.calls += 1
+                try:
+                    response = await asyncio.wait_for(future, timeout)
+                except asyncio.TimeoutError:
+                    waiting.pop(unique_id, None)
+                    metrics.record("call", action, "timeout")
+                    continue
+                if response is None:
+                    metrics.record("call", action, "connection_lost")
+                    raise ConnectionError("connection lost")
+                stats.answered += 1
+                outcome = "ok" if response[0] == MessageType.CallResult else "call_error"
+                metrics.record("call", action, outcome, time.perf_counter() - sent)
+            if speed is not None:
+                # Stay online as long as the captured station did, answering the CSMS
+                await asyncio.sleep((script.end - start) / speed - (time.monotonic() - began))
+        except (ConnectionError, websockets.ConnectionClosed) as e:
+            stats.failed += 1
+            logging.warning(f"{station_id}: connection closed during the replay: {e!r}")
+        finally:
+            receiver.cancel()
+
+
+async def run_replay(ws_url, paths, speed=1.0, copies=1, id_template=DEFAULT_ID_TEMPLATE, stats=None, report_interval=10.0):
+    """
+    Replays capture files against `ws_url`: every captured Charge Point is
+    replayed `copies` times, as the ids `id_template` makes of its captured
+    id and the copy number, at `speed` times the captured pace (None: max).
+    """
+    scripts, start = load_scripts(paths)
+    stats = stats or ReplayStats()
+    tasks = []
+    for copy in range(1, copies + 1):
+        for cp_id, script in scripts.items():
+            if not script.calls:
+                continue
+            station_id = id_template.format(id=cp_id, copy=copy)
+            tasks.append(asyncio.create_task(replay_station(ws_url, station_id, script, start, speed, stats)))
+            stats.stations += 1
+
+    async def report():
+        while True:
+            await asyncio.sleep(report_interval)
+            print(format_replay(stats.snapshot()))
+
+    reporter = asyncio.create_task(report()) if report_interval else None
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+    return stats
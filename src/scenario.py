@@ -0,0 +1,283 @@
+"""Scenario engine: declarative step sequences run by every station of a fleet."""
+import asyncio
+import json
+import logging
+import random
+import time
+
+from ocpp.messages import MessageType
+
+from .clock import get_clock
+from .metrics import Histogram, get_metrics
+from .repl import handlers
+
+# The REPL commands a scenario may run, with the same arguments as typed in the REPL
+COMMANDS = {
+    "connect": handlers.connect,
+    "authorize": handlers.authorize,
+    "event": handlers.event,
+    "charge": handlers.charge,
+    "stop_charge": handlers.stop_charge,
+    "disconnect": handlers.disconnect,
+}
+
+DISTRIBUTIONS = ("uniform", "exponential", "normal", "randint", "choice")
+
+# Step failures logged per process; the rest are only counted
+MAX_LOGGED_FAILURES = 20
+
+
+class StepFailed(Exception):
+    """An expectation of a scenario step that the CSMS did not meet."""
+
+
+def check_value(value, where):
+    """Raises ValueError if `value` is neither a constant nor a valid distribution."""
+    if not isinstance(value, dict):
+        return
+    if len(value) != 1 or next(iter(value)) not in DISTRIBUTIONS:
+        raise ValueError(f"{where}: expected a constant or one of {', '.join(DISTRIBUTIONS)}, got {value!r}")
+    kind, params = next(iter(value.items()))
+    if kind == "exponential":
+        if not isinstance(params, (int, float)) or params <= 0:
+            raise ValueError(f"{where}: 'exponential' takes a positive mean")
+    elif kind == "choice":
+        if not isinstance(params, list) or not params:
+            raise ValueError(f"{where}: 'choice' takes a non-empty list")
+    elif not isinstance(params, list) or len(params) != 2:
+        raise ValueError(f"{where}: '{kind}' takes two numbers")
+    elif kind == "randint" and not all(isinstance(param, int) and not isinstance(param, bool) for param in params):
+        raise ValueError(f"{where}: 'randint' takes two integers")
+
+
+def parse_distribution(text):
+    """
+    Parses a distribution given on the command line: a number, or
+    'kind:param[,param]' such as 'exponential:1800' or 'uniform:600,3600'.
+    """
+    kind, _, params = str(text).partition(":")
+    if not params:
+        value = float(kind)
+    else:
+        numbers = [float(param) for param in params.split(",")]
+        if kind == "randint":
+            # random.randint() only takes integers
+            numbers = [int(number) if number.is_integer() else number for number in numbers]
+        value = {kind: numbers[0] if kind == "exponential" else numbers}
+    check_value(value, f"'{text}'")
+    return value
+
+
+def sample(value, rng):
+    """
+    Draws a value from a step field: constants are returned as they are;
+    {"uniform": [a, b]}, {"exponential": mean}, {"normal": [mean, stdev]}
+    (never below 0), {"randint": [a, b]} and {"choice": [...]} are sampled.
+    """
+    if not isinstance(value, dict):
+        return value
+    kind, params = next(iter(value.items()))
+    if kind == "uniform":
+        return rng.uniform(*params)
+    if kind == "exponential":
+        return rng.expovariate(1 / params)
+    if kind == "normal":
+        return max(0.0, rng.gauss(*params))
+    if kind == "randint":
+        return rng.randint(*params)
+    return rng.choice(params)
+
+
+def lookup(payload, path):
+    """Follows a dotted path ('idTokenInfo.status', 'getVariableResult.0.attributeStatus') into a payload."""
+    value = payload
+    for key in path.split("."):
+        if isinstance(value, list):
+            value = value[int(key)]
+        else:
+            value = value[key]
+    return value
+
+
+class Scenario:
+    """
+    A parsed scenario file.
+
+    Every station runs `steps` in order, `repeat` times, once its first
+    BootNotification is accepted. A step is one of:
+
+    - {"sleep": seconds}: the seconds may be a distribution;
+    - {"command": "connect", "args": [1]}: runs a REPL command. String
+      args are formatted with {cp_id}, {index} and {iteration}, and any
+      arg may be a distribution;
+    - {"expect": "Authorize", "path": "idTokenInfo.status", "equals": "Accepted"}:
+      asserts on the last response to that action. "in": [...] checks
+      membership instead, and "call_error": true/false whether the CSMS
+      answered with a CallError.
+
+    Any step may have a "probability" of running (default 1) and a
+    "name". A failed step stops the iteration, or the station's whole
+    run with "on_failure": "stop".
+    """
+
+    def __init__(self, definition):
+        if not isinstance(definition, dict) or not isinstance(definition.get("steps"), list):
+            raise ValueError("A scenario needs a list of 'steps'")
+        self.name = definition.get("name", "scenario")
+        self.repeat = int(definition.get("repeat", 1))
+        self.on_failure = definition.get("on_failure", "continue")
+        if self.on_failure not in ("continue", "stop"):
+            raise ValueError(f"Unknown on_failure '{self.on_failure}'")
+        self.start_delay = definition.get("start_delay", 0)
+        check_value(self.start_delay, "start_delay")
+        self.steps = [self._parse_step(index, step) for index, step in enumerate(definition["steps"])]
+        self.failures_logged = 0
+
+    @staticmethod
+    def _parse_step(index, step):
+        where = f"step {index + 1}"
+        if not isinstance(step, dict):
+            raise ValueError(f"{where}: expected an object, got {step!r}")
+        step = dict(step)
+        probability = step.get("probability", 1)
+        if not 0 <= probability <= 1:
+            raise ValueError(f"{where}: probability must be between 0 and 1")
+
+        if "sleep" in step:
+            check_value(step["sleep"], where)
+            step["kind"] = "sleep"
+        elif "command" in step:
+            if step["command"] not in COMMANDS:
+                raise ValueError(f"{where}: unknown command '{step['command']}' (one of {', '.join(COMMANDS)})")
+            step.setdefault("args", [])
+            for arg in step["args"]:
+                check_value(arg, where)
+            step["kind"] = "command"
+        elif "expect" in step:
+            if not any(key in step for key in ("equals", "in", "call_error")):
+                raise ValueError(f"{where}: an expect step needs 'equals', 'in' or 'call_error'")
+            step["kind"] = "expect"
+        else:
+            raise ValueError(f"{where}: expected 'sleep', 'command' or 'expect'")
+
+        detail = step.get("command") or step.get("expect") or ""
+        step.setdefault("name", f"{index + 1}:{step['kind']} {detail}".rstrip())
+        return step
+
+    async def run(self, charge_point, index, seed=None):
+        """Runs every iteration of the scenario on `charge_point`; returns when done or stopped."""
+        rng = random.Random(f"{seed}:{charge_point.id}") if seed is not None else random.Random()
+        metrics = get_metrics()
+        await charge_point.boot_accepted.wait()
+        delay = sample(self.start_delay, rng)
+        if delay:
+            await get_clock().sleep(delay)
+
+        for iteration in range(self.repeat):
+            context = {"cp_id": charge_point.id, "index": index, "iteration": iteration}
+            failed = False
+            for step in self.steps:
+                if rng.random() >= step.get("probability", 1):
+                    metrics.record("scenario", step["name"], "skipped")
+                    continue
+                started = time.perf_counter()
+                try:
+                    await self._run_step(charge_point, step, context, rng)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    metrics.record("scenario", step["name"], "failed", time.perf_counter() - started)
+                    self._log_failure(charge_point, step, e)
+                    failed = True
+                    break
+                metrics.record("scenario", step["name"], "ok", time.perf_counter() - started)
+            metrics.record("scenario", "iteration", "failed" if failed else "ok")
+            if failed and self.on_failure == "stop":
+                return
+
+    async def _run_step(self, charge_point, step, context, rng):
+        kind = step["kind"]
+        if kind == "sleep":
+            await get_clock().sleep(sample(step["sleep"], rng))
+        elif kind == "command":
+            args = []
+            for arg in step["args"]:
+                arg = sample(arg, rng)
+                args.append(arg.format(**context) if isinstance(arg, str) else str(arg))
+            # Commands need the CSMS: wait out any reconnection
+            await charge_point.boot_accepted.wait()
+            await COMMANDS[step["command"]](charge_point, *args)
+        else:
+            self._check_expectation(charge_point, step)
+
+    @staticmethod
+    def _check_expectation(charge_point, step):
+        action = step["expect"]
+        response = charge_point.last_responses.get(action)
+        if response is None:
+            raise StepFailed(f"no {action} response yet")
+        is_error = response.message_type_id == MessageType.CallError
+        if "call_error" in step and is_error != step["call_error"]:
+            detail = f": {response.error_code}" if is_error else ""
+            raise StepFailed(f"{action} {'was' if is_error else 'was not'} a CallError{detail}")
+        if "equals" not in step and "in" not in step:
+            return
+        if is_error:
+            raise StepFailed(f"{action} was a CallError: {response.error_code}")
+        path = step.get("path")
+        try:
+            value = lookup(response.payload, path) if path else response.payload
+        except (KeyError, IndexError, ValueError):
+            raise StepFailed(f"{action} response has no '{path}'")
+        if "equals" in step and value != step["equals"]:
+            raise StepFailed(f"{action} {path or 'payload'} is {value!r}, expected {step['equals']!r}")
+        if "in" in step and value not in step["in"]:
+            raise StepFailed(f"{action} {path or 'payload'} is {value!r}, expected one of {step['in']!r}")
+
+    def _log_failure(self, charge_point, step, error):
+        if self.failures_logged < MAX_LOGGED_FAILURES:
+            logging.warning(f"{charge_point.id}: scenario step '{step['name']}' failed: {error}")
+        elif self.failures_logged == MAX_LOGGED_FAILURES:
+            logging.warning("Further scenario step failures are only counted")
+        self.failures_logged += 1
+
+
+def load_scenario(path):
+    """Loads a scenario from a JSON file, or YAML (.yaml/.yml) when PyYAML is installed."""
+    with open(path) as f:
+        text = f.read()
+    if str(path).endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAML scenarios need PyYAML (pip install pyyaml)")
+        definition = yaml.safe_load(text)
+    else:
+        definition = json.loads(text)
+    return Scenario(definition)
+
+
+def count_failures(snapshot):
+    """Returns the failed scenario steps of a fleet snapshot."""
+    steps = snapshot.get("metrics", {}).get("counters", {}).get("scenario", {})
+    return sum(outcomes.get("failed", 0) for label, outcomes in steps.items() if label != "iteration")
+
+
+def format_results(snapshot):
+    """Formats the per-step outcomes and latencies of a fleet snapshot as table lines."""
+    metrics = snapshot.get("metrics", {})
+    counters = metrics.get("counters", {}).get("scenario", {})
+    histograms = metrics.get("histograms", {}).get("scenario", {})
+    lines = [f"{'step':<32} {'ok':>8} {'failed':>8} {'skipped':>8} {'p50':>9} {'p99':>9}"]
+    for label, outcomes in counters.items():
+        if label in histograms:
+            histogram = Histogram.from_dict(histograms[label])
+            p50 = f"{histogram.quantile(0.5) * 1000:.0f}ms"
+            p99 = f"{histogram.quantile(0.99) * 1000:.0f}ms"
+        else:
+            p50 = p99 = "-"
+        lines.append(
+            f"{label:<32} {outcomes.get('ok', 0):>8} {outcomes.get('failed', 0):>8} "
+            f"{outcomes.get('skipped', 0):>8} {p50:>9} {p99:>9}"
+        )
+    return lines
@@ -1,5 +1,3 @@
-from datetime import datetime, timezone
-
 from ocpp.v201 import call
 from ocpp.v201.enums import (
     ConnectorStatusEnumType,
@@ -11,49 +9,41 @@ from ocpp.v201.enums import (
     TriggerReasonEnumType,
 )
 
+from .clock import get_clock
+from .history import RECEIVED, SENT
+
 
 class ChargePointSenderMixin:
     async def send_status_notification(self, evse_id: int, status: ConnectorStatusEnumType):
         request = call.StatusNotification(
-            timestamp=datetime.now(timezone.utc).isoformat(),
+            timestamp=get_clock().timestamp(),
             connector_status=status,
             evse_id=evse_id,
             connector_id=1,
         )
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] >> StatusNotification (EvseId: {evse_id}, ConnectorId: 1, Status: {status})"
-        )
+        self.history.record(SENT, "StatusNotification", evse_id, None, "EvseId: {}, ConnectorId: 1, Status: {}", evse_id, status)
         await self.call(request)
 
     async def send_authorize(self, id_token: str):
         request = call.Authorize(
             id_token={"id_token": id_token, "type": "ISO14443"})
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()
-                }] >> Authorize (IdToken: {id_token})"
-        )
+        self.history.record(SENT, "Authorize", None, None, "IdToken: {}", id_token)
         response = await self.call(request)
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] << Authorize Response ({
-                response.id_token_info['status']})"
-        )
+        self.history.record(RECEIVED, "Authorize", None, None, "{}", response.id_token_info["status"])
 
     async def send_transaction_event(self, event_type: TransactionEventEnumType, transaction_id: str, trigger_reason: TriggerReasonEnumType, seq_no: int, evse_id: int = 1, connector_id: int = 1, meter_value: list = None):
         evse = {"id": evse_id, "connectorId": connector_id}
 
         request = call.TransactionEvent(
             event_type=event_type,
-            timestamp=datetime.now(timezone.utc).isoformat(),
+            timestamp=get_clock().timestamp(),
             trigger_reason=trigger_reason,
             seq_no=seq_no,
             transaction_info={"transaction_id": transaction_id},
             evse=evse,
             meter_value=meter_value,
         )
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] >> TransactionEvent (Type: {
-                event_type}, TxId: {transaction_id})"
-        )
+        self.history.record(SENT, "TransactionEvent", evse_id, transaction_id, "Type: {}, TxId: {}", event_type, transaction_id)
 
         try:
             response = await self.call(request)
@@ -62,27 +52,33 @@ class ChargePointSenderMixin:
             # Server rejected the transaction (CallError or other exception)
             import logging
             logging.warning(f"TransactionEvent rejected by server: {e}")
-            self.history.append(
-                f"[{datetime.now(timezone.utc).isoformat()}] << TransactionEvent REJECTED: {e}"
-            )
+            self.history.record(RECEIVED, "TransactionEvent", None, None, "REJECTED: {}", e)
+            return None
+
+    async def send_templated_transaction_event(self, template, timestamp: str, seq_no: int, meter_value: list = None):
+        """Sends a TransactionEvent rendered from a prebuilt template."""
+        self.history.record(
+            SENT, "TransactionEvent", template.evse_id, template.transaction_id,
+            "Type: {}, TxId: {}", template.event_type, template.transaction_id,
+        )
+        try:
+            return await self.call_payload("TransactionEvent", template.render(timestamp, seq_no, meter_value))
+        except Exception as e:
+            import logging
+            logging.warning(f"TransactionEvent rejected by server: {e}")
+            self.history.record(RECEIVED, "TransactionEvent", None, None, "REJECTED: {}", e)
             return None
 
     async def send_firmware_status_notification(self, status: FirmwareStatusEnumType, request_id: int):
         request = call.FirmwareStatusNotification(
             status=status, request_id=request_id)
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat(
-            )}] >> FirmwareStatusNotification (Status: {status})"
-        )
+        self.history.record(SENT, "FirmwareStatusNotification", None, None, "Status: {}", status)
         await self.call(request)
 
     async def send_log_status_notification(self, status: LogStatusEnumType, request_id: int):
         request = call.LogStatusNotification(
             status=status, request_id=request_id)
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()
-                }] >> LogStatusNotification (Status: {status})"
-        )
+        self.history.record(SENT, "LogStatusNotification", None, None, "Status: {}", status)
         await self.call(request)
 
     async def send_meter_values(self, evse_id: int, meter_value: list):
@@ -90,20 +86,23 @@ class ChargePointSenderMixin:
             evse_id=evse_id,
             meter_value=meter_value,
         )
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] >> MeterValues (EvseId: {evse_id})"
-        )
+        self.history.record(SENT, "MeterValues", evse_id, None, "EvseId: {}", evse_id)
         response = await self.call(request)
         return response
 
+    async def send_templated_meter_values(self, template, meter_value: list):
+        """Sends a MeterValues rendered from a prebuilt template."""
+        self.history.record(SENT, "MeterValues", template.evse_id, None, "EvseId: {}", template.evse_id)
+        return await self.call_payload("MeterValues", template.render(meter_value))
+
     async def send_notify_event(self, event_type: str, description: str):
         request = call.NotifyEvent(
-            generated_at=datetime.now(timezone.utc).isoformat(),
+            generated_at=get_clock().timestamp(),
             seq_no=0,  # In a real implementation, this should be managed
             event_data=[
                 {
                     "eventId": 0,  # In a real implementation, this should be managed
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "timestamp": get_clock().timestamp(),
                     "trigger": "Delta",
                     "actualValue": description,
                     "eventNotificationType": EventNotificationEnumType.custom_monitor,
@@ -112,20 +111,30 @@ class ChargePointSenderMixin:
                 }
             ],
         )
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()
-                }] >> NotifyEvent (Type: {event_type})"
-        )
+        self.history.record(SENT, "NotifyEvent", None, None, "Type: {}", event_type)
         await self.call(request)
 
-    async def send_report_charging_profiles(self, request_id: int, evse_id: int, charging_profile: dict, source: str = "CSO"):
+    async def send_notify_report(self, request_id: int, generated_at: str, seq_no: int, report_data: list, tbc: bool = False):
+        """Sends one part of a device model report; `report_data` is already camelCase."""
+        payload = {"requestId": request_id, "generatedAt": generated_at, "seqNo": seq_no, "reportData": report_data}
+        if tbc:
+            payload["tbc"] = True
+        self.history.record(
+            SENT, "NotifyReport", None, None, "RequestId: {}, SeqNo: {}, {} variables, tbc: {}",
+            request_id, seq_no, len(report_data), tbc,
+        )
+        await self.call_payload("NotifyReport", payload)
+
+    async def send_report_charging_profiles(self, request_id: int, evse_id: int, charging_profiles: list, source: str = "CSO", tbc: bool = False):
         request = call.ReportChargingProfiles(
             request_id=request_id,
             charging_limit_source=source,
             evse_id=evse_id,
-            charging_profile=[charging_profile],
+            charging_profile=charging_profiles,
+            tbc=tbc,
         )
-        self.history.append(
-            f"[{datetime.now(timezone.utc).isoformat()}] >> ReportChargingProfiles (RequestId: {request_id}, EvseId: {evse_id}, ProfileId: {charging_profile.get('id', 'unknown')})"
+        self.history.record(
+            SENT, "ReportChargingProfiles", evse_id, None, "RequestId: {}, EvseId: {}, ProfileIds: {}",
+            request_id, evse_id, [profile.get("id", "unknown") for profile in charging_profiles],
         )
         await self.call(request)
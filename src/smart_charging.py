@@ -0,0 +1,293 @@
+"""Charging profiles and their composite schedule, as the limit the EVSEs charge at."""
+import bisect
+from datetime import datetime, timezone
+
+from .clock import get_clock
+
+# Power when no profile limits an EVSE (W)
+DEFAULT_LIMIT = 9999
+VOLTAGE = 230
+# OCPP default when a period does not set numberPhases
+DEFAULT_PHASES = 3
+RECURRENCY_SECONDS = {"Daily": 86400, "Weekly": 7 * 86400}
+# Seconds of composite schedule compiled ahead of time
+HORIZON = 86400
+
+STATION_MAX = "ChargingStationMaxProfile"
+EXTERNAL = "ChargingStationExternalConstraints"
+TX_DEFAULT = "TxDefaultProfile"
+TX = "TxProfile"
+
+
+def parse_time(value):
+    """Parses an OCPP date-time into epoch seconds, or None."""
+    if not value:
+        return None
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def format_time(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+
+def to_watts(limit, unit, phases):
+    return limit * VOLTAGE * phases if unit.upper() == "A" else limit
+
+
+class Profile:
+    """A stored charging profile, with its first schedule parsed for evaluation."""
+
+    __slots__ = ("evse_id", "data", "installed_at", "id", "stack_level", "purpose", "kind",
+                 "recurrency", "valid_from", "valid_to", "transaction_id", "start", "duration",
+                 "unit", "offsets", "periods")
+
+    def __init__(self, evse_id, data, installed_at):
+        self.evse_id = evse_id
+        self.data = data
+        self.installed_at = installed_at
+        self.id = data["id"]
+        self.stack_level = data.get("stack_level", 0)
+        self.purpose = data.get("charging_profile_purpose")
+        self.kind = data.get("charging_profile_kind", "Absolute")
+        self.recurrency = RECURRENCY_SECONDS.get(data.get("recurrency_kind"))
+        self.valid_from = parse_time(data.get("valid_from"))
+        self.valid_to = parse_time(data.get("valid_to"))
+        self.transaction_id = data.get("transaction_id")
+        schedule = data["charging_schedule"][0]
+        self.start = parse_time(schedule.get("start_schedule"))
+        self.duration = schedule.get("duration")
+        self.unit = schedule.get("charging_rate_unit", "W")
+        periods = sorted(schedule["charging_schedule_period"], key=lambda period: period.get("start_period", 0))
+        self.offsets = [period.get("start_period", 0) for period in periods]
+        self.periods = [
+            (to_watts(period["limit"], self.unit, period.get("number_phases") or DEFAULT_PHASES),
+             period.get("number_phases") or DEFAULT_PHASES)
+            for period in periods
+        ]
+
+    def schedule_start(self, now, tx_start):
+        """Returns when the schedule running at `now` started, or None if none is."""
+        if self.kind == "Relative":
+            return tx_start
+        start = self.start if self.start is not None else (self.valid_from or self.installed_at)
+        if self.kind == "Recurring" and self.recurrency and now >= start:
+            start += (now - start) // self.recurrency * self.recurrency
+        return start
+
+    def limit_at(self, now, tx_start):
+        """Returns the (W, phases) of the period active at `now`, or None."""
+        if self.valid_from is not None and now < self.valid_from:
+            return None
+        if self.valid_to is not None and now >= self.valid_to:
+            return None
+        start = self.schedule_start(now, tx_start)
+        if start is None or now < start:
+            return None
+        elapsed = now - start
+        if self.duration is not None and elapsed >= self.duration:
+            return None
+        index = bisect.bisect_right(self.offsets, elapsed) - 1
+        return self.periods[index] if index >= 0 else None
+
+    def boundaries(self, begin, end, tx_start):
+        """Yields the times in [begin, end) at which this profile's limit may change."""
+        for moment in (self.valid_from, self.valid_to):
+            if moment is not None:
+                yield moment
+        start = self.schedule_start(begin, tx_start)
+        if start is None:
+            return
+        while start < end:
+            for offset in self.offsets:
+                yield start + offset
+            if self.duration is not None:
+                yield start + self.duration
+            if self.kind != "Recurring" or not self.recurrency:
+                return
+            start += self.recurrency
+            yield start
+
+
+class CompiledSchedule:
+    """The composite limit of one EVSE over [start, end): boundaries and their limits, for bisect."""
+
+    __slots__ = ("key", "start", "end", "times", "limits")
+
+    def __init__(self, key, start, end, times, limits):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.times = times
+        self.limits = limits
+
+    def limit_at(self, now):
+        return self.limits[bisect.bisect_right(self.times, now) - 1]
+
+
+class ChargingProfiles:
+    """
+    The charging profiles of a Charge Point, indexed by EVSE and purpose
+    (each list sorted by descending stack level).
+
+    The limit of an EVSE at any time is the composite schedule of OCPP
+    2.0.1: the lowest of the ChargingStationMaxProfile and the
+    ChargingStationExternalConstraints of the station, and the TxProfile
+    of the running transaction or else the TxDefaultProfile of the EVSE
+    (or of the station). Within a purpose, the valid profile with the
+    highest stack level wins. The station maximum caps every EVSE on its
+    own rather than their sum.
+
+    The composite schedule of each EVSE is compiled for HORIZON seconds at
+    a time, so a meter tick only bisects the precomputed boundaries.
+    """
+
+    def __init__(self, records=None):
+        self._profiles = {}
+        self._index = {}
+        self._compiled = {}
+        self._version = 0
+        for key, record in (records or {}).items():
+            if "profile" in record:
+                self._store(Profile(record["evse_id"], record["profile"], record.get("installed_at", 0)))
+            else:
+                # Older state kept a single profile per EVSE, keyed by EVSE id
+                self._store(Profile(int(key), record, 0))
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def __iter__(self):
+        return iter(self._profiles.values())
+
+    def records(self):
+        """Returns the profiles as state records, keyed by profile id."""
+        return {
+            str(profile.id): {"evse_id": profile.evse_id, "profile": profile.data, "installed_at": profile.installed_at}
+            for profile in self._profiles.values()
+        }
+
+    def add(self, evse_id, data):
+        """
+        Installs a profile, replacing the one with the same id. Returns an
+        error message instead if it conflicts with another profile.
+        """
+        profile = Profile(evse_id, data, get_clock().now().timestamp())
+        for other in self._index.get((evse_id, profile.purpose), ()):
+            if (
+                other.id != profile.id
+                and other.stack_level == profile.stack_level
+                and other.transaction_id == profile.transaction_id
+            ):
+                return f"profile {other.id} has the same purpose and stack level"
+        self._discard(profile.id)
+        self._store(profile)
+        self._changed()
+        return None
+
+    def remove(self, profile_id=None, evse_id=None, purpose=None, stack_level=None):
+        """Removes the profiles matching every given criterion; returns how many."""
+        removed = [profile.id for profile in self.find(evse_id, purpose, stack_level, None if profile_id is None else [profile_id])]
+        for profile_id in removed:
+            self._discard(profile_id)
+        if removed:
+            self._changed()
+        return len(removed)
+
+    def find(self, evse_id=None, purpose=None, stack_level=None, profile_ids=None):
+        """Returns the profiles matching every given criterion."""
+        return [
+            profile for profile in self._profiles.values()
+            if (evse_id is None or profile.evse_id == evse_id)
+            and (purpose is None or profile.purpose == purpose)
+            and (stack_level is None or profile.stack_level == stack_level)
+            and (profile_ids is None or profile.id in profile_ids)
+        ]
+
+    def limit(self, evse_id, transaction=None, now=None):
+        """Returns the composite limit of an EVSE in W."""
+        now = get_clock().now().timestamp() if now is None else now
+        key = self._key(evse_id, transaction)
+        compiled = self._compiled.get(evse_id)
+        if compiled is None or compiled.key != key or not compiled.start <= now < compiled.end:
+            compiled = self._compiled[evse_id] = self._compile(evse_id, transaction, key, now, now + HORIZON)
+        return compiled.limit_at(now)[0]
+
+    def composite(self, evse_id, transaction, start, duration):
+        """
+        Returns the composite schedule of an EVSE from `start` for
+        `duration` seconds as [(start offset, W, phases)], one per change.
+        """
+        compiled = self._compile(evse_id, transaction, None, start, start + duration)
+        return [(int(moment - start), limit, phases) for moment, (limit, phases) in zip(compiled.times, compiled.limits)]
+
+    def _store(self, profile):
+        self._profiles[profile.id] = profile
+        stack = self._index.setdefault((profile.evse_id, profile.purpose), [])
+        stack.append(profile)
+        stack.sort(key=lambda other: -other.stack_level)
+
+    def _discard(self, profile_id):
+        profile = self._profiles.pop(profile_id, None)
+        if profile is not None:
+            self._index[(profile.evse_id, profile.purpose)].remove(profile)
+
+    def _changed(self):
+        self._version += 1
+        self._compiled.clear()
+
+    def _key(self, evse_id, transaction):
+        if not transaction:
+            return (self._version, None, None)
+        return (self._version, transaction.transaction_id, transaction.charging_since)
+
+    def _stacks(self, evse_id, transaction):
+        """Returns the profile stacks that apply to an EVSE (0: the station), each in priority order."""
+        transaction_id = transaction.transaction_id if transaction else None
+        external = list(self._index.get((0, EXTERNAL), ()))
+        tx_defaults = list(self._index.get((0, TX_DEFAULT), ()))
+        tx_profiles = []
+        if evse_id:
+            external = sorted(external + self._index.get((evse_id, EXTERNAL), []), key=lambda profile: -profile.stack_level)
+            # The default of the EVSE overrides the one of the station
+            tx_defaults = self._index.get((evse_id, TX_DEFAULT), []) + tx_defaults
+            if transaction_id is not None:
+                tx_profiles = [
+                    profile for profile in self._index.get((evse_id, TX), ())
+                    if profile.transaction_id in (None, transaction_id)
+                ]
+        # The transaction limit: its TxProfile, else the default
+        return [self._index.get((0, STATION_MAX), []), external, tx_profiles + tx_defaults]
+
+    @staticmethod
+    def _stack_limit(profiles, now, tx_start):
+        # Stacks are in priority order: the first profile active now sets the limit
+        for profile in profiles:
+            limit = profile.limit_at(now, tx_start)
+            if limit is not None:
+                return limit
+        return None
+
+    def _compile(self, evse_id, transaction, key, start, end):
+        tx_start = parse_time(transaction.charging_since) if transaction else None
+        stacks = self._stacks(evse_id, transaction)
+        moments = {start}
+        for profiles in stacks:
+            for profile in profiles:
+                moments.update(moment for moment in profile.boundaries(start, end, tx_start) if start < moment < end)
+
+        times = []
+        limits = []
+        for moment in sorted(moments):
+            limit = None
+            for profiles in stacks:
+                stack_limit = self._stack_limit(profiles, moment, tx_start)
+                if stack_limit is not None and (limit is None or stack_limit[0] < limit[0]):
+                    limit = stack_limit
+            limit = limit or (DEFAULT_LIMIT, DEFAULT_PHASES)
+            if not limits or limits[-1] != limit:
+                times.append(moment)
+                limits.append(limit)
+        return CompiledSchedule(key, start, end, times, limits)
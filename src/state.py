@@ -1,48 +1,277 @@
 """State management for the charge point."""
-import copy
+import asyncio
 import json
 import logging
 import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
-from ocpp.v201.enums import ConnectorStatusEnumType
+from .codec import get_codec
 
+STATE_DB = "charge_point_state.db"
+# Single-station state file used before the SQLite store; imported once
 STATE_FILE = "charge_point_state.json"
 
+RECORD_KINDS = ("evses", "transactions", "charging_profiles", "offline_queue", "variables")
 
-def save_state(charge_point):
-    """Saves the state of the charge point to a JSON file."""
-    evses_to_save = copy.deepcopy(charge_point.evses)
-    for evse in evses_to_save.values():
-        evse["status"] = evse["status"].value
-
-    transactions_to_save = {}
-    for tx_key, tx_data in charge_point.transactions.items():
-        serializable_tx = tx_data.copy()
-        is_charging = "meter_task" in serializable_tx
-        if is_charging:
-            del serializable_tx["meter_task"]
-        serializable_tx["is_charging"] = is_charging
-        transactions_to_save[tx_key] = serializable_tx
-
-    state = {
-        "evses": evses_to_save,
-        "transactions": transactions_to_save,
-        "charging_profiles": charge_point.charging_profiles,
-    }
-
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, indent=4)
-    logging.info(f"State saved to {STATE_FILE}")
-
-
-def load_state():
-    """Loads the charge point state from a JSON file, if it exists."""
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r") as f:
-                logging.info(f"Loading state from {STATE_FILE}")
-                return json.load(f)
-        except json.JSONDecodeError:
-            logging.error(f"Error reading {STATE_FILE}. Starting with a fresh state.")
+
+class StateStore:
+    """
+    Per-Charge Point state in a SQLite database in WAL mode.
+
+    Every EVSE, transaction and charging profile is its own row, keyed by
+    (cp_id, kind, key). Saving a Charge Point only writes the rows whose
+    content changed since the last committed save, and all the database
+    work runs on a dedicated thread so the event loop never blocks on disk I/O.
+    """
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-store")
+        self._conn = None
+        # Last committed serialized version of each record, per Charge Point
+        self._written = {}
+        self._executor.submit(self._open).result()
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " cp_id TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL,"
+            " PRIMARY KEY (cp_id, kind, key)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def _read(self, cp_id):
+        return self._conn.execute(
+            "SELECT kind, key, data FROM records WHERE cp_id = ?", (cp_id,)
+        ).fetchall()
+
+    def _write(self, cp_id, records):
+        # Runs on the store thread, in save order, diffing against what is committed
+        previous = self._written.get(cp_id, {})
+        upserts = [
+            (cp_id, kind, key, data)
+            for (kind, key), data in records.items()
+            if previous.get((kind, key)) != data
+        ]
+        deletes = [(cp_id, kind, key) for kind, key in previous if (kind, key) not in records]
+        if not upserts and not deletes:
+            return
+        with self._conn:
+            if upserts:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO records (cp_id, kind, key, data) VALUES (?, ?, ?, ?)",
+                    upserts,
+                )
+            if deletes:
+                self._conn.executemany(
+                    "DELETE FROM records WHERE cp_id = ? AND kind = ? AND key = ?", deletes
+                )
+        # Only once committed: after a failed write, the next save writes the rows again
+        self._written[cp_id] = records
+
+    def load(self, cp_id):
+        """Returns the saved state of one Charge Point, or None if it has none."""
+        rows = self._executor.submit(self._read, cp_id).result()
+        if not rows:
             return None
-    return None
+
+        codec = get_codec()
+        state = {kind: {} for kind in RECORD_KINDS}
+        written = {}
+        for kind, key, data in rows:
+            state[kind][key] = codec.loads(data)
+            written[(kind, key)] = data
+        self._written[cp_id] = written
+        return state
+
+    def save(self, cp_id, records):
+        """
+        Schedules the write of the records that changed since the last
+        committed save; returns the future of the write.
+        """
+        future = self._executor.submit(self._write, cp_id, records)
+        future.add_done_callback(_log_write_error)
+        return future
+
+    def flush(self):
+        """Blocks until every scheduled write has been committed."""
+        self._executor.submit(lambda: None).result()
+
+    def close(self):
+        self._executor.submit(self._conn.close).result()
+        self._executor.shutdown()
+
+
+def _log_write_error(future):
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Error writing state: {error}")
+
+
+_store = None
+
+
+def open_store(path=STATE_DB):
+    """Opens the process-wide state store (once) and returns it."""
+    global _store
+    if _store is None:
+        _store = StateStore(path)
+    return _store
+
+
+def close_store():
+    """Flushes and closes the process-wide state store, if open."""
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
+
+
+def serialize_state(charge_point):
+    """
+    Serializes each EVSE, transaction, charging profile, offline queued
+    message and variable set on the station as its own JSON record.
+    """
+    dumps = get_codec().dumps
+    records = {}
+    for evse_id, evse in charge_point.evses.items():
+        records[("evses", str(evse_id))] = dumps(evse.to_record())
+
+    for tx_key, transaction in charge_point.transactions.items():
+        records[("transactions", str(tx_key))] = dumps(transaction.to_record())
+
+    for key, record in charge_point.charging_profiles.records().items():
+        records[("charging_profiles", key)] = dumps(record)
+
+    for seq, message in charge_point.offline_queue.records().items():
+        records[("offline_queue", str(seq))] = dumps(message)
+
+    for key, value in charge_point.device_model.records().items():
+        records[("variables", key)] = dumps(value)
+    return records
+
+
+def save_state(charge_point):
+    """
+    Saves the changed parts of the charge point state to the state store;
+    returns the future of the write, or None if the station isn't persisted.
+    """
+    if not charge_point.persist:
+        return None
+
+    return open_store().save(charge_point.id, serialize_state(charge_point))
+
+
+class StateFlusher:
+    """
+    Coalesces state saves: Charge Points are only marked dirty, and a
+    background task saves each dirty one at most once per `interval`.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._dirty = {}
+        self._task = None
+
+    def mark_dirty(self, charge_point):
+        self._dirty[charge_point.id] = charge_point
+
+    def flush(self):
+        """Saves every dirty Charge Point now."""
+        dirty, self._dirty = self._dirty, {}
+        for charge_point in dirty.values():
+            save_state(charge_point)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stops the background task and saves what is still dirty."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+
+_flusher = None
+
+
+def start_flusher(interval=1.0):
+    """Starts the process-wide state flusher on the running event loop."""
+    global _flusher
+    if _flusher is None:
+        _flusher = StateFlusher(interval)
+        _flusher.start()
+    return _flusher
+
+
+async def stop_flusher():
+    """Stops the process-wide state flusher, saving every dirty Charge Point."""
+    global _flusher
+    if _flusher is not None:
+        await _flusher.stop()
+        _flusher = None
+
+
+def mark_dirty(charge_point):
+    """
+    Records that the charge point state changed. The state flusher saves it
+    on its next tick; without a running flusher it is saved immediately.
+    """
+    if not charge_point.persist:
+        return
+
+    if _flusher is None:
+        save_state(charge_point)
+    else:
+        _flusher.mark_dirty(charge_point)
+
+
+def load_state(cp_id):
+    """Loads the state of one charge point from the state store, if it exists."""
+    state = open_store().load(cp_id)
+    if state is not None:
+        logging.info(f"Loading state of {cp_id} from {open_store().path}")
+    return state
+
+
+def read_state_file():
+    """
+    Reads the legacy single-station JSON state file, if any. Only the
+    station of `run` may import it; see `retire_state_file`.
+    """
+    if not os.path.exists(STATE_FILE):
+        return None
+    try:
+        with open(STATE_FILE, "r") as f:
+            logging.info(f"Importing state from {STATE_FILE}")
+            state = json.load(f)
+    except json.JSONDecodeError:
+        logging.error(f"Error reading {STATE_FILE}. Starting with a fresh state.")
+        return None
+    return state
+
+
+def retire_state_file(charge_point):
+    """
+    Saves the state imported from the legacy state file to the store and,
+    once it is written, renames the file so it's imported only once.
+    """
+    future = save_state(charge_point)
+    if future is None or future.exception() is not None:
+        logging.error(f"The state imported from {STATE_FILE} was not saved; keeping the file")
+        return
+    os.replace(STATE_FILE, f"{STATE_FILE}.imported")
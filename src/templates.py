@@ -0,0 +1,68 @@
+"""Prebuilt OCPP payloads for the messages sent on every meter tick."""
+from ocpp.v201.enums import (
+    MeasurandEnumType,
+    ReadingContextEnumType,
+    TransactionEventEnumType,
+    TriggerReasonEnumType,
+)
+
+
+class MeterValuesTemplate:
+    """
+    The camelCase payload of MeterValues for one EVSE, built once.
+
+    Only the timestamp and the energy register change between ticks, so a
+    tick costs two small dicts instead of the dataclass serialization and
+    camelCase conversion done by `ChargePoint.call`.
+    """
+
+    __slots__ = ("evse_id", "_sample")
+
+    def __init__(self, evse_id, context=ReadingContextEnumType.sample_periodic):
+        self.evse_id = evse_id
+        self._sample = {
+            "context": context.value,
+            "measurand": MeasurandEnumType.energy_active_import_register.value,
+            "unitOfMeasure": {"unit": "Wh"},
+        }
+
+    def sample(self, timestamp, energy):
+        """Returns the meterValue entry of one energy sample."""
+        return {"timestamp": timestamp, "sampledValue": [{"value": energy, **self._sample}]}
+
+    def meter_value(self, timestamp, energy):
+        """Returns the meterValue list of one energy sample."""
+        return [self.sample(timestamp, energy)]
+
+    def render(self, meter_value):
+        return {"evseId": self.evse_id, "meterValue": meter_value}
+
+
+class TransactionEventTemplate:
+    """The camelCase payload of TransactionEvent for one transaction, built once."""
+
+    __slots__ = ("transaction_id", "evse_id", "event_type", "_base")
+
+    def __init__(
+        self,
+        transaction_id,
+        evse_id,
+        connector_id=1,
+        event_type=TransactionEventEnumType.updated,
+        trigger_reason=TriggerReasonEnumType.meter_value_periodic,
+    ):
+        self.transaction_id = transaction_id
+        self.evse_id = evse_id
+        self.event_type = event_type
+        self._base = {
+            "eventType": event_type.value,
+            "triggerReason": trigger_reason.value,
+            "transactionInfo": {"transactionId": transaction_id},
+            "evse": {"id": evse_id, "connectorId": connector_id},
+        }
+
+    def render(self, timestamp, seq_no, meter_value=None):
+        payload = {**self._base, "timestamp": timestamp, "seqNo": seq_no}
+        if meter_value is not None:
+            payload["meterValue"] = meter_value
+        return payload
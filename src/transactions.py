@@ -0,0 +1,50 @@
+"""Transactions keyed by EVSE, indexed by transaction id."""
+from collections.abc import MutableMapping
+
+
+class TransactionRegistry(MutableMapping):
+    """
+    The transactions of one Charge Point, a dict of EVSE id to Transaction,
+    keeping an index by transaction id up to date for RequestStopTransaction
+    and GetTransactionStatus.
+    """
+
+    def __init__(self):
+        self._transactions = {}
+        # transaction_id: evse_id
+        self._index = {}
+
+    def __getitem__(self, evse_id):
+        return self._transactions[evse_id]
+
+    def __setitem__(self, evse_id, transaction):
+        self._unindex(evse_id)
+        self._transactions[evse_id] = transaction
+        if transaction.transaction_id is not None:
+            self._index[transaction.transaction_id] = evse_id
+
+    def __delitem__(self, evse_id):
+        self._unindex(evse_id)
+        del self._transactions[evse_id]
+
+    def __iter__(self):
+        return iter(self._transactions)
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def __contains__(self, evse_id):
+        return evse_id in self._transactions
+
+    def get(self, evse_id, default=None):
+        # Called on every meter tick: skip the MutableMapping indirection
+        return self._transactions.get(evse_id, default)
+
+    def evse_of(self, transaction_id):
+        """Returns the EVSE id of a transaction, or None."""
+        return self._index.get(transaction_id)
+
+    def _unindex(self, evse_id):
+        transaction = self._transactions.get(evse_id)
+        if transaction is not None and self._index.get(transaction.transaction_id) == evse_id:
+            del self._index[transaction.transaction_id]